@@ -18,9 +18,12 @@ from ..api.exceptions import *
 from ..config import APPNAME_UC, APPVER, AppConfig, AccessConfig
 from ..config.helpers import DictItemProxy, EncodingListItemProxy
 from ..email.util import IDX_MAX
+from ..search import MASK_TAGS
 from ..util.asyncio import async_run_in_thread
 from ..util.dumbcode import *
+from ..util.mailpile import tag_quote, tag_unquote
 from ..util.sendmail import ServerAndSender, SendingProgress
+from ..util.sharedmem import unshare
 from ..workers.importer import ImportWorker
 from ..workers.metadata import MetadataWorker
 from ..workers.storage import StorageWorkers
@@ -66,6 +69,9 @@ main app worker. Hints:
        'ttf': 'font/ttf',
        'woff': 'font/woff'}
 
+    # Counts for these searches come straight from the tag counters
+    TAG_COUNT_RE = re.compile(r'^(?:in|tag):([^\s@]+)( -(?:in|tag):read)?$')
+
     DEFAULT_CRONTAB = """\
 # This is the schedule for moggie updates, checking mail, unsnoozing
 # snoozed messages, things like that.
@@ -217,6 +223,8 @@ main app worker. Hints:
                 aes_keys,
                 notify=notify_url,
                 name='metadata',
+                cache_mb=self.config.get(
+                    self.config.GENERAL, 'metadata_cache_mb', fallback=None),
                 log_level=log_level).connect()
 
         if self.search is None:
@@ -227,6 +235,8 @@ main app worker. Hints:
                 aes_keys,
                 notify=notify_url,
                 name='search',
+                cache_mb=self.config.get(
+                    self.config.GENERAL, 'search_cache_mb', fallback=None),
                 log_level=log_level).connect()
 
         if missing_metadata and self.metadata and self.storage:
@@ -273,6 +283,10 @@ main app worker. Hints:
                 search_worker=self.search,
                 metadata_worker=self.metadata,
                 notify=notify_url,
+                memory_mb=self.config.get(
+                    self.config.GENERAL, 'import_memory_mb', fallback=None),
+                parsers=self.config.get(
+                    self.config.GENERAL, 'import_parsers', fallback=None),
                 name='importer',
                 log_level=log_level).connect()
 
@@ -711,6 +725,15 @@ main app worker. Hints:
         # Will raise ValueError or NameError if access denied
         roles, tag_ns, scope_s = access.grants(ctx, AccessConfig.GRANT_READ)
 
+        def _unshared(s_result):
+            # Shared memory references are only meaningful to our workers
+            # and expire, and msgpack replies carry raw bytes; clients
+            # always get plain dumb-encoded strings.
+            s_result['hits'] = unshare(s_result['hits'])
+            for tag, (comment, iset) in (s_result.get('tags') or {}).items():
+                s_result['tags'][tag] = (comment, unshare(iset, compress=128))
+            return s_result
+
         loop = asyncio.get_event_loop()
         async def perform_search():
             terms = api_request['terms']
@@ -725,7 +748,7 @@ main app worker. Hints:
                 mask_tags=api_request.get('mask_tags'),
                 with_tags=(not api_request.get('only_ids', False)))
             if api_request.get('uncooked'):
-                return s_result
+                return _unshared(s_result)
             s_metadata = (
                 await self.metadata.with_caller(conn_id).async_metadata(
                     loop,
@@ -736,9 +759,10 @@ main app worker. Hints:
                     threads=api_request.get('threads', False),
                     skip=api_request['skip'],
                     limit=api_request['limit'],
+                    version=s_result.get('version'),
                     raw=True))
             s_metadata['metadata'] = list(s_metadata['metadata'])
-            return (s_result, s_metadata)
+            return (_unshared(s_result), s_metadata)
 
         api_request['skip'] = api_request.get('skip') or 0
         api_request['limit'] = api_request.get('limit', None)
@@ -761,7 +785,21 @@ main app worker. Hints:
         loop = asyncio.get_event_loop()
         async def perform_counts():
             counts = {}
+            tag_counts = None
             for terms in api_request['terms_list']:
+                tc = (not scope_s) and self.TAG_COUNT_RE.match(terms)
+                if tc:
+                    if tag_counts is None:
+                        tag_counts = (await self.search.with_caller(conn_id)
+                            .async_tag_counts(loop, tag_namespace=tag_ns)
+                            )['tags']
+                    # Mirror the default masking done by the search worker
+                    masked = not any(t in terms for t in MASK_TAGS)
+                    tag = tag_unquote(tag_quote('in:' + tc.group(1)))
+                    col = (2 if masked else 0) + (1 if tc.group(2) else 0)
+                    counts[terms] = tag_counts.get(tag, [0, 0, 0, 0])[col]
+                    continue
+
                 result = await self.search.with_caller(conn_id).async_search(
                     loop, terms,
                     tag_namespace=tag_ns,
@@ -59,13 +59,16 @@ class MessagePart(dict):
         boundary = b'\n--' + bytes(boundary, 'latin-1')
         body_beg = self.hend + 2*len(self.eol)
         body_end = len(buf)
+        eol, eol_len = self.eol, len(self.eol)
 
-        last_b = 0
+        # Note: We walk the buffer using offsets, instead of slicing it;
+        #       slicing would copy the rest of the message for each part.
+        pos = 0
         bounds = []
         stop = False
         while not stop:
             # Find the beginning of our next boundary string
-            b = buf.find(boundary)
+            b = buf.find(boundary, pos)
             if b < 0:
                 break
 
@@ -75,15 +78,14 @@ class MessagePart(dict):
             if buf[e:e+2] == b'--':
                 stop = True
                 e += 2
-            while (e < len(buf)) and buf[e] in b' \t':
+            while (e < body_end) and buf[e] in b' \t':
                 e += 1
-            if buf[e:e+len(self.eol)] == self.eol:
-                e += len(self.eol)
+            if buf[e:e+eol_len] == eol:
+                e += eol_len
 
-            bounds.append((b+last_b, e+last_b))
+            bounds.append((b, e))
             # Rewind slightly, in case our input has incorrect whitespace.
-            last_b += (e-2)
-            buf = buf[(e-2):]
+            pos = e-2
 
         begs = [body_beg] + [e for b,e in bounds]
         ends = [b for b,e in bounds] + [body_end]
@@ -693,3 +695,26 @@ Trailing garbage!
         print('Perf: %.2fs/1k %d-byte e-mail (vs. %.2fs/1k)'
             % (t2-t1, len(msg2), t1-t0))
 
+    # Large messages with many attachments; this used to be quadratic.
+    b64_line = base64.b64encode(bytes(range(0, 57))) + b'\r\n'
+    for parts in (50, 500):
+        body = b64_line * ((50 * 1024 * 1024) // (parts * len(b64_line)))
+        msg3 = b'\r\n'.join([
+                b'From: bre@example.org',
+                b'Content-Type: multipart/mixed; boundary="=-=bound=-="',
+                b'', b'Preamble']
+            + [b'--=-=bound=-=\r\nContent-Type: application/octet-stream'
+               b'\r\nContent-Transfer-Encoding: base64\r\n\r\n' + body
+               for i in range(0, parts)]
+            + [b'--=-=bound=-=--', b''])
+
+        t0 = time.time()
+        p3 = parse_message(msg3).with_structure()
+        t1 = time.time()
+        assert(len(p3['_PARTS']) == parts + 2)
+        assert(p3._find_parts('=-=bound=-=')
+            == p3._find_parts_re('=-=bound=-='))
+
+        print('Perf: %.3fs to find %d parts in %d-byte e-mail'
+            % (t1-t0, parts, len(msg3)))
+
@@ -0,0 +1,3 @@
+# Messages with these tags are hidden from searches by default, and are
+# counted separately (as not visible) by the search engine.
+MASK_TAGS = ('in:trash', 'in:junk', 'in:hidden')
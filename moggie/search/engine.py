@@ -37,19 +37,23 @@
 #
 import copy
 import logging
+import numpy
 import os
 import struct
 import random
 import re
 import threading
 import time
+import zlib
 
+from . import MASK_TAGS
 from .dates import ts_to_keywords
 from .versions import version_to_keywords
 from ..util.dumbcode import *
 from ..util.intset import IntSet
 from ..util.mailpile import msg_id_hash, tag_quote, tag_unquote
 from ..util.wordblob import wordblob_search, create_wordblob, update_wordblob
+from ..util.wordblob import WordblobIndex
 from ..storage.records import RecordFile, RecordStore
 
 
@@ -72,70 +76,197 @@ def explain_ops(ops):
 
 class PostingListBucket:
     """
-    A PostingListBucket is an unsorted sequence of binary packed
-    (keyword, comment, IntSet) tuples.
+    A PostingListBucket is a sequence of binary packed (keyword, comment,
+    IntSet) tuples, preceded by a directory sorted by keyword so lookups
+    are a binary search and updates can splice a single entry in place.
+
+    The directory is a MAGIC marker, a count and then (offset, keyword
+    length, comment length, IntSet length) for each entry, where offsets
+    are relative to the start of the data that follows the directory.
+
+    Buckets in the older unsorted format (no directory) are still readable
+    and get converted the first time they are modified.
     """
     DEFAULT_COMPRESS = None  #16*1024
 
+    MAGIC = b'\x00\x00\xff\xffPLB2'
+    DIR_COUNT = '<I'
+    DIR_ENTRY = '<IHHI'
+    DIR_DTYPE = numpy.dtype([
+        ('ofs', '<u4'), ('kw_ln', '<u2'), ('c_ln', '<u2'), ('iset_ln', '<u4')])
+    DIR_BEG = len(MAGIC) + struct.calcsize(DIR_COUNT)
+    DIR_ENTRY_SIZE = struct.calcsize(DIR_ENTRY)
+
     def __init__(self, blob, deleted=None, compress=None):
         self.blob = blob
         self.compress = self.DEFAULT_COMPRESS if (compress is None) else compress
         self.deleted = deleted
 
-    def __iter__(self):
-        beg = 0
-        while beg < len(self.blob):
-            kw_ln, c_ln, iset_ln = struct.unpack('<HHI', self.blob[beg:beg+8])
-            yield self.blob[beg+8:beg+8+kw_ln]
-            beg += 8 + kw_ln + c_ln + iset_ln
+    def _is_sorted(self):
+        return (self.blob[:len(self.MAGIC)] == self.MAGIC)
 
-    def items(self, decode=True):
+    def _count(self):
+        return struct.unpack_from(self.DIR_COUNT, self.blob, len(self.MAGIC))[0]
+
+    def _data_beg(self, count):
+        return self.DIR_BEG + count * self.DIR_ENTRY_SIZE
+
+    def _entry(self, i):
+        return struct.unpack_from(
+            self.DIR_ENTRY, self.blob, self.DIR_BEG + i * self.DIR_ENTRY_SIZE)
+
+    def _unsorted_entries(self):
         beg = 0
-        decode = dumb_decode if decode else (lambda b: b)
         while beg < len(self.blob):
             kw_ln, c_ln, iset_ln = struct.unpack('<HHI', self.blob[beg:beg+8])
             cbeg = beg + 8 + kw_ln
             end = cbeg + c_ln + iset_ln
+            yield (self.blob[beg+8:cbeg],
+                   self.blob[cbeg:cbeg+c_ln],
+                   self.blob[cbeg+c_ln:end])
+            beg = end
+
+    def _sorted_entries(self):
+        count = self._count()
+        data_beg = self._data_beg(count)
+        for i in range(0, count):
+            ofs, kw_ln, c_ln, iset_ln = self._entry(i)
+            kbeg = data_beg + ofs
+            cbeg = kbeg + kw_ln
+            ibeg = cbeg + c_ln
+            yield (bytes(self.blob[kbeg:cbeg]),
+                   bytes(self.blob[cbeg:ibeg]),
+                   bytes(self.blob[ibeg:ibeg+iset_ln]))
+
+    def _entries(self):
+        if self._is_sorted():
+            return self._sorted_entries()
+        return self._unsorted_entries()
 
-            kw = self.blob[beg+8:cbeg]
-            bcomment = self.blob[cbeg:cbeg+c_ln]
-            iset_blob = self.blob[cbeg+c_ln:end]
+    def __iter__(self):
+        for kw, bcomment, iset_blob in self._entries():
+            yield kw
+
+    def items(self, decode=True):
+        decode = dumb_decode if decode else (lambda b: b)
+        for kw, bcomment, iset_blob in self._entries():
             yield (kw, bcomment, decode(iset_blob))
 
-            beg = end
+    def _bsearch(self, bkeyword):
+        """
+        Returns (position, found) for a keyword in a sorted bucket.
+        """
+        count = self._count()
+        data_beg = self._data_beg(count)
+        lo, hi = 0, count
+        with memoryview(self.blob) as mv:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                ofs, kw_ln, c_ln, iset_ln = self._entry(mid)
+                kw = bytes(mv[data_beg+ofs:data_beg+ofs+kw_ln])
+                if kw == bkeyword:
+                    return mid, True
+                elif kw < bkeyword:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        return lo, False
 
-    def _find_iset(self, kw):
+    def _find_iset(self, kw, decode=True):
         bkeyword = kw if isinstance(kw, bytes) else bytes(kw, 'utf-8')
+        decode = dumb_decode if decode else (lambda b: b)
 
-        beg = 0
-        iset = None
-        bcomment = b''
-        chunks = []
-        while beg < len(self.blob):
-            kw_ln, c_ln, iset_ln = struct.unpack('<HHI', self.blob[beg:beg+8])
-            cbeg = beg + 8 + kw_ln
-            end = cbeg + c_ln + iset_ln
-
-            kw = self.blob[beg+8:cbeg]
-            if kw != bkeyword:
-                chunks.append(self.blob[beg:end])
+        if not self._is_sorted():
+            for kw, bcomment, iset_blob in self._unsorted_entries():
+                if kw == bkeyword:
+                    return bkeyword, bcomment, decode(iset_blob)
+            return bkeyword, b'', None
+
+        pos, found = self._bsearch(bkeyword)
+        if not found:
+            return bkeyword, b'', None
+        ofs, kw_ln, c_ln, iset_ln = self._entry(pos)
+        cbeg = self._data_beg(self._count()) + ofs + kw_ln
+        ibeg = cbeg + c_ln
+        return (bkeyword,
+            bytes(self.blob[cbeg:ibeg]),
+            decode(bytes(self.blob[ibeg:ibeg+iset_ln])))
+
+    def _make_sorted(self):
+        if self._is_sorted():
+            if not isinstance(self.blob, bytearray):
+                self.blob = bytearray(self.blob)
+            return
+
+        entries = sorted(self._unsorted_entries())
+        directory = []
+        data = []
+        ofs = 0
+        for kw, bcomment, iset_blob in entries:
+            directory.append(struct.pack(self.DIR_ENTRY,
+                ofs, len(kw), len(bcomment), len(iset_blob)))
+            data.extend((kw, bcomment, iset_blob))
+            ofs += len(kw) + len(bcomment) + len(iset_blob)
+        self.blob = bytearray(b''.join(
+            [self.MAGIC, struct.pack(self.DIR_COUNT, len(entries))]
+            + directory + data))
+
+    def _shift_offsets(self, count, after, delta):
+        if count and delta:
+            directory = numpy.frombuffer(self.blob,
+                dtype=self.DIR_DTYPE, count=count, offset=self.DIR_BEG)
+            offsets = directory['ofs']
+            moved = (offsets > after)
+            offsets[moved] = offsets[moved].astype(numpy.int64) + delta
+            del directory, offsets
+
+    def _splice(self, bkeyword, bcomment, iset_blob):
+        """
+        Replace, insert or (if iset_blob is None) remove a single entry,
+        without rebuilding the rest of the bucket.
+        """
+        self._make_sorted()
+        count = self._count()
+        data_beg = self._data_beg(count)
+        pos, found = self._bsearch(bkeyword)
+        dpos = self.DIR_BEG + pos * self.DIR_ENTRY_SIZE
+
+        if found:
+            ofs, kw_ln, c_ln, iset_ln = self._entry(pos)
+            beg = data_beg + ofs
+            end = beg + kw_ln + c_ln + iset_ln
+            if iset_blob is None:
+                del self.blob[beg:end]
+                self._shift_offsets(count, ofs, -(end - beg))
+                del self.blob[dpos:dpos + self.DIR_ENTRY_SIZE]
+                count -= 1
             else:
-                bcomment = self.blob[cbeg:cbeg+c_ln]
-                iset_blob = self.blob[cbeg+c_ln:end]
-                iset = dumb_decode(iset_blob)
-
-            beg = end
-
-        return chunks, bkeyword, bcomment, iset
+                record = bcomment + iset_blob
+                self.blob[beg+kw_ln:end] = record
+                self._shift_offsets(count, ofs, len(record) - (c_ln + iset_ln))
+                struct.pack_into(self.DIR_ENTRY, self.blob, dpos,
+                    ofs, kw_ln, len(bcomment), len(iset_blob))
+
+        elif iset_blob is not None:
+            ofs = len(self.blob) - data_beg
+            self.blob.extend(bkeyword + bcomment + iset_blob)
+            self.blob[dpos:dpos] = struct.pack(self.DIR_ENTRY,
+                ofs, len(bkeyword), len(bcomment), len(iset_blob))
+            count += 1
+
+        if count:
+            struct.pack_into(self.DIR_COUNT, self.blob, len(self.MAGIC), count)
+        else:
+            self.blob = b''
 
     def remove(self, keyword):
-        chunks, bkeyword, bcomment, iset = self._find_iset(keyword)
+        bkeyword, bcomment, iset = self._find_iset(keyword)
         if iset is not None:
-            self.blob = b''.join(chunks)
+            self._splice(bkeyword, None, None)
         return bcomment, iset
 
     def add(self, keyword, ints, comment=b''):
-        chunks, bkeyword, bcomment, iset = self._find_iset(keyword)
+        bkeyword, bcomment, iset = self._find_iset(keyword)
 
         if iset is None:
             iset = IntSet()
@@ -144,35 +275,33 @@ class PostingListBucket:
         if self.deleted is not None:
             iset -= self.deleted
 
-        self.set(keyword, iset, bcomment, bkeyword, chunks)
+        self.set(keyword, iset, bcomment, bkeyword)
+        return iset
 
     def set_comment(self, keyword, comment):
         bcomment = comment
         if not isinstance(bcomment, bytes):
             bcomment = bytes(bcomment, 'utf-8')
-        chunks, bkeyword, ocomment, iset = self._find_iset(keyword)
-        self.set(keyword, iset, bcomment, bkeyword, chunks)
+        bkeyword, ocomment, iset = self._find_iset(keyword)
+        self.set(keyword, iset, bcomment, bkeyword)
 
-    def set(self, keyword, iset, comment=b'', bkeyword=None, chunks=None):
+    def set(self, keyword, iset, comment=b'', bkeyword=None):
         bcomment = b''
-        if not (bkeyword and chunks):
-            chunks, bkeyword, bcomment, _ = self._find_iset(keyword)
+        if not bkeyword:
+            bkeyword, bcomment, _ = self._find_iset(keyword)
 
         bcomment = comment or bcomment or b''
         if not isinstance(bcomment, bytes):
             bcomment = bytes(bcomment, 'utf-8')
 
-        iset_blob = dumb_encode_bin(iset, compress=self.compress)
         if bcomment or iset:
-            chunks.append(struct.pack(
-                '<HHI', len(bkeyword), len(bcomment), len(iset_blob)))
-            chunks.append(bkeyword)
-            chunks.append(bcomment)
-            chunks.append(iset_blob)
-        self.blob = b''.join(chunks)
-
-    def get(self, keyword, with_comment=False):
-        chunks, bkeyword, bcomment, iset = self._find_iset(keyword)
+            iset_blob = dumb_encode_bin(iset, compress=self.compress)
+            self._splice(bkeyword, bcomment, iset_blob)
+        else:
+            self._splice(bkeyword, None, None)
+
+    def get(self, keyword, with_comment=False, decode=True):
+        bkeyword, bcomment, iset = self._find_iset(keyword, decode=decode)
         if with_comment:
             return (bcomment, iset)
         return iset
@@ -183,9 +312,10 @@ class SearchEngine:
     This is a keyword based search engine, which maps keywords to integers.
 
     Note: Performance depends on integers being relatively small (allocated
-    sequentially from zero, hundreds of thousands to a few million items -
-    larger valuse than that will require a redesign of our IntSet. We can
-    cross that bridge when we come to it.
+    sequentially from zero). Posting lists are stored using compact IntSet
+    containers, so rare keywords stay small on disk no matter how large the
+    IDs get, but search results are still bitmaps in RAM sized to fit the
+    highest ID.
     """
     DEFAULTS = {
         'partial_list_len': 1000000,
@@ -196,22 +326,32 @@ class SearchEngine:
         'l1_keywords': 512000,
         'l2_buckets': 40 * 1024 * 1024}
 
+    # Runtime tunables; unlike the DEFAULTS, these are not persisted.
+    RECORD_CACHE_BYTES = 32 * 1024 * 1024
+    BATCH_WRITE_BYTES = 8 * 1024 * 1024
+
     IDX_CONFIG = 0
     IDX_PART_SPACE = 1
     IDX_EMAIL_SPACE_1 = 2
     IDX_EMAIL_SPACE_2 = 3
     IDX_EMAIL_SPACE_3 = 4
+    IDX_TAG_COUNTS = 5
+    IDX_TAG_COUNTS_MOVED = 6
     IDX_HISTORY_STATUS = 1000
     IDX_HISTORY_START = 1001
     IDX_HISTORY_END = 2000
     IDX_MAX_RESERVED = 2000
 
+    # Messages with these tags are counted separately (as not visible)
+    COUNT_MASK_TAGS = MASK_TAGS
+
     IGNORE_SPECIAL_KW_RE = re.compile(r'(^\d+|[:@%"\'<>?!\._-]+)')
     IGNORE_NONLATIN_RE = re.compile(r'(^\d+|[\s:@%"\'<>?!\._-]+|'
         + '[^\u0000-\u007F\u0080-\u00FF\u0100-\u017F\u0180-\u024F])')
 
     def __init__(self, workdir,
-            name='search', encryption_keys=None, defaults=None, maxint=1):
+            name='search', encryption_keys=None, defaults=None, maxint=1,
+            cache_bytes=None):
 
         self.records = RecordStore(os.path.join(workdir, name), name,
             salt=None, # FIXME: This must be set, OR ELSE
@@ -224,16 +364,22 @@ class SearchEngine:
         self.config = copy.copy(self.DEFAULTS)
         if defaults:
             self.config.update(defaults)
+        created = False
         try:
             self.config.update(self.records[self.IDX_CONFIG])
         except (KeyError, IndexError):
             self.records[self.IDX_CONFIG] = self.config
+            created = True
         logging.debug('Search engine config: %s' % (self.config,))
+        self.records.cache.max_bytes = (
+            self.RECORD_CACHE_BYTES if (cache_bytes is None) else cache_bytes)
+        self.batch_write_bytes = self.BATCH_WRITE_BYTES
 
         try:
             self.part_spaces = [self.records[self.IDX_PART_SPACE], set()]
         except (KeyError, IndexError):
             self.part_spaces = [bytes(), set()]
+        self.part_indexes = []  # Built on demand, see candidates()
 
         try:
             self.email_spaces = [
@@ -246,6 +392,13 @@ class SearchEngine:
                 bytes(), set(), ('to', bytes()), ('from', bytes())]
 
         self.history = self.records.get(self.IDX_HISTORY_STATUS) or {'ver': 1}
+        # Older indexes lack tag counters, they get built on first use.
+        self.tag_counters = self.records.get(self.IDX_TAG_COUNTS)
+        if created and (self.tag_counters is None):
+            self.tag_counters = {}
+        self.tag_counts_moved = dict(
+            (ns, [IntSet(ids) for ids in moved]) for ns, moved
+            in (self.records.get(self.IDX_TAG_COUNTS_MOVED) or {}).items())
         self.l1_begin = self.IDX_MAX_RESERVED + 1
         self.l2_begin = self.l1_begin + self.config['l1_keywords']
         self.maxint = maxint
@@ -254,6 +407,7 @@ class SearchEngine:
 
         # Profiling...
         self.profileB = self.profile1 = self.profile2 = self.profile3 = 0
+        self.profileM = self.profileR = 0
 
         # Someday, these might be configurable/pluggable?
 
@@ -329,6 +483,288 @@ class SearchEngine:
                             kw = kw.split('@')[0]
                             yield (kw, (comment, dumb_decode(iset) or no_hits))
 
+    def _iter_l1_tags(self):
+        # Yields (keyword, encoded IntSet) for every L1 in: keyword,
+        # including the in:@ns "all mail" keywords of each namespace.
+        for idx in range(self.l1_begin, self.l2_begin):
+            with self.lock:
+                if idx not in self.records:
+                    return
+                plb = PostingListBucket(self.records.get(idx, cache=True))
+                for kw, comment, iset in plb.items(decode=False):
+                    kw = str(kw, 'utf-8')
+                    if kw[:3] == 'in:':
+                        yield (kw, iset)
+
+    def _tag_ns(self, kw):
+        return kw.split('@', 1)[1] if ('@' in kw) else ''
+
+    def _count_refs(self, ns):
+        return (self._ns('in:read', ns),
+            [self._ns(tag, ns) for tag in self.COUNT_MASK_TAGS])
+
+    def _count_vector(self, iset, read, masked):
+        unread = IntSet.Sub(iset, read)
+        return [
+            iset.count(),
+            unread.count(),
+            IntSet.Sub(iset, masked).count(),
+            IntSet.Sub(unread, masked, clone=True).count()]
+
+    def recount_tags(self):
+        """
+        Rebuild the tag counters from scratch, by decoding every tag.
+        """
+        with self.lock:
+            refs = {}
+            counters = {}
+            for kw, iset in self._iter_l1_tags():
+                ns = self._tag_ns(kw)
+                if ns not in refs:
+                    rkw, mkws = self._count_refs(ns)
+                    refs[ns] = (self[rkw], IntSet.Or(*[self[k] for k in mkws]))
+                iset = dumb_decode(iset)
+                if iset:
+                    counters[kw] = self._count_vector(iset, *refs[ns])
+            self.tag_counters = counters
+            self.tag_counts_moved = {}
+            self._save_tag_counts()
+            return counters
+
+    def _save_tag_counts(self, moved=True):
+        self.records[self.IDX_TAG_COUNTS] = self.tag_counters
+        if moved:
+            # Few messages move between settlements, and plain lists are
+            # much cheaper to encode than sparse IntSets.
+            self.records[self.IDX_TAG_COUNTS_MOVED] = dict(
+                (ns, [list(ids) for ids in moved]) for ns, moved
+                in self.tag_counts_moved.items())
+
+    def _counting(self, kw):
+        return (self.tag_counters is not None) and (kw[:3] == 'in:')
+
+    def _note_tag_change(self, changes, kw, iset, oset):
+        # Remember which messages were added to or removed from each tag
+        # touched by an operation, for _update_tag_counts(). Only the net
+        # change is kept, not copies of the tags themselves.
+        if not self._counting(kw):
+            return
+        iset = iset if (iset is not None) else IntSet()
+        oset = oset if (oset is not None) else IntSet()
+        added = IntSet.Sub(oset, iset)
+        removed = IntSet.Sub(iset, oset)
+        if kw in changes:
+            p_added, p_removed = changes[kw]
+            changes[kw] = [
+                IntSet.Or(IntSet.Sub(p_added, removed),
+                          IntSet.Sub(added, p_removed)),
+                IntSet.Or(IntSet.Sub(p_removed, added),
+                          IntSet.Sub(removed, p_added))]
+        else:
+            changes[kw] = [added, removed]
+
+    def _members(self, iset_blob, ids):
+        # Return which of the ids (an IntSet) are in an encoded IntSet,
+        # without decoding the whole thing if we can avoid it.
+        if (not iset_blob) or (not ids):
+            return IntSet()
+        if iset_blob[:1] == b'z':
+            iset_blob = zlib.decompress(iset_blob[1:])
+        if iset_blob[:1] == IntSet.ENC_BIN:
+            ints = ids.to_numpy()
+            return IntSet.from_numpy(
+                ints[IntSet.GatherBinary(iset_blob[1:], ints)])
+        return IntSet.And(dumb_decode(iset_blob), ids)
+
+    def _tag_members(self, kw, ids, changes=None):
+        # If the tag just changed, we already know about some of the ids
+        # and only need to look up the rest.
+        known = IntSet()
+        if changes and (kw in changes):
+            added, removed = changes[kw]
+            known = IntSet.And(added, ids)
+            ids = IntSet.Sub(ids, IntSet.Or(added, removed))
+            if not ids:
+                return known
+        plb = PostingListBucket(self.records.get(self.keyword_index(kw)) or b'')
+        return IntSet.Or(known, self._members(plb.get(kw, decode=False), ids))
+
+    def _tags_members(self, kws, ids, changes=None):
+        return IntSet.Or(IntSet(), *[
+            self._tag_members(kw, ids, changes) for kw in kws])
+
+    def _update_tag_counts(self, changes):
+        """
+        Update the tag counters to reflect a set of changes, as recorded
+        by _note_tag_change().
+
+        Only tags which changed get updated, and only by considering the
+        messages which were added or removed. When messages become read
+        or unread, masked or unmasked, the counts of every other tag they
+        have would change too; finding those tags is expensive, so instead
+        we note which messages moved and what their old state was, and
+        settle up later (see _settle_tag_counts). Until then, counts are
+        calculated as if the moved messages were still in their old state.
+        """
+        if (self.tag_counters is None) or not changes:
+            return
+        with self.lock:
+            namespaces = {}
+            for kw, diff in changes.items():
+                namespaces.setdefault(self._tag_ns(kw), {})[kw] = diff
+
+            saw_moves = False
+            for ns, ns_changes in namespaces.items():
+                rkw, mkws = self._count_refs(ns)
+                moved, m_read, m_masked = self.tag_counts_moved.get(ns) or (
+                    IntSet(), IntSet(), IntSet())
+
+                # Note the old state of any messages which just moved.
+                diffs = [ns_changes.get(kw) for kw in [rkw] + mkws]
+                changed = IntSet.Or(IntSet(), *[
+                    IntSet.Or(*d) for d in diffs if d is not None])
+                changed -= moved
+                if changed:
+                    def _before(iset, diff):
+                        if diff is None:
+                            return iset
+                        return IntSet.Or(IntSet.Sub(iset, diff[0]), diff[1])
+                    read = self._tag_members(rkw, changed, ns_changes)
+                    read_before = IntSet.And(
+                        _before(read, diffs[0]), changed)
+                    masks = [(self._tag_members(kw, changed, ns_changes), diff)
+                        for kw, diff in zip(mkws, diffs[1:])]
+                    masked = IntSet.Or(IntSet(), *[m for m, d in masks])
+                    masked_before = IntSet.And(IntSet.Or(IntSet(),
+                        *[_before(m, d) for m, d in masks]), changed)
+                    changed = IntSet.Or(
+                        IntSet.Sub(read, read_before),
+                        IntSet.Sub(read_before, read),
+                        IntSet.Sub(masked, masked_before),
+                        IntSet.Sub(masked_before, masked))
+                    if changed:
+                        moved |= changed
+                        m_read |= IntSet.And(read_before, changed)
+                        m_masked |= IntSet.And(masked_before, changed)
+                        self.tag_counts_moved[ns] = [moved, m_read, m_masked]
+                        saw_moves = True
+
+                # Adjust the counts of the tags which changed, treating
+                # moved messages as if they had their old state.
+                def _state(ids):
+                    read = self._tag_members(rkw, ids, ns_changes)
+                    masked = self._tags_members(mkws, ids, ns_changes)
+                    if moved:
+                        read = IntSet.Or(IntSet.Sub(read, moved),
+                            IntSet.And(m_read, ids))
+                        masked = IntSet.Or(IntSet.Sub(masked, moved),
+                            IntSet.And(m_masked, ids))
+                    return read, masked
+
+                for kw, (added, removed) in ns_changes.items():
+                    if kw not in self.tag_counters:
+                        iset = self[kw]
+                        if iset:
+                            self.tag_counters[kw] = self._count_vector(
+                                iset, *_state(iset))
+                        continue
+                    ids = IntSet.Or(added, removed)
+                    if not ids:
+                        continue
+                    read, masked = _state(ids)
+                    a = self._count_vector(added, read, masked)
+                    r = self._count_vector(removed, read, masked)
+                    counts = [c + ca - cr for c, ca, cr
+                        in zip(self.tag_counters[kw], a, r)]
+                    if counts[0] > 0:
+                        self.tag_counters[kw] = counts
+                    else:
+                        self.tag_counters.pop(kw, None)
+
+            self._save_tag_counts(moved=saw_moves)
+
+    def _settle_tag_counts(self):
+        """
+        Adjust the tag counters for messages which have become read or
+        unread, masked or unmasked, since we last checked.
+
+        This has to look at every tag in the namespace, but tags whose
+        counts show they cannot contain any of the moved messages are
+        skipped, and the rest are probed without decoding them fully.
+        """
+        if (self.tag_counters is None) or not self.tag_counts_moved:
+            return
+        with self.lock:
+            for ns, (moved, m_read, m_masked) in self.tag_counts_moved.items():
+                rkw, mkws = self._count_refs(ns)
+                read = self._tag_members(rkw, moved)
+                masked = self._tags_members(mkws, moved)
+                moved = IntSet.Or(
+                    IntSet.Sub(read, m_read),
+                    IntSet.Sub(m_read, read),
+                    IntSet.Sub(masked, m_masked),
+                    IntSet.Sub(m_masked, masked))
+                if not moved:
+                    continue
+
+                # Which of the [total, unread, visible, visible unread]
+                # counts could include the moved messages?
+                unread = IntSet.Sub(moved, m_read)
+                was_read = IntSet.And(moved, m_read)
+                classes = (
+                    bool(IntSet.Sub(unread, m_masked)),
+                    bool(IntSet.And(unread, m_masked)),
+                    bool(IntSet.Sub(was_read, m_masked)),
+                    bool(IntSet.And(was_read, m_masked)))
+                def _may_overlap(c):
+                    return any(w and n for w, n in zip(classes, (
+                        c[3], c[1] - c[3], c[2] - c[3],
+                        c[0] - c[1] - c[2] + c[3])))
+
+                for kw, iset_blob in self._iter_l1_tags():
+                    if ((kw not in self.tag_counters)
+                            or (self._tag_ns(kw) != ns)
+                            or not _may_overlap(self.tag_counters[kw])):
+                        continue
+                    iset = self._members(iset_blob, moved)
+                    if iset:
+                        b = self._count_vector(iset, m_read, m_masked)
+                        a = self._count_vector(iset, read, masked)
+                        self.tag_counters[kw] = [c - cb + ca
+                            for c, cb, ca in zip(self.tag_counters[kw], b, a)]
+
+            self.tag_counts_moved = {}
+            self._save_tag_counts()
+
+    def tag_counts(self, tag_namespace=''):
+        """
+        Return the current message counts for each tag, without searching.
+
+        Counts are lists of [total, unread, visible, visible unread], where
+        visible messages are those not tagged with any of COUNT_MASK_TAGS.
+        The totals for each namespace are reported separately.
+        """
+        with self.lock:
+            if self.tag_counters is None:
+                self.recount_tags()
+            else:
+                self._settle_tag_counts()
+            tags = {}
+            namespaces = {}
+            for kw, counts in self.tag_counters.items():
+                ns = self._tag_ns(kw)
+                if tag_namespace and (ns != tag_namespace):
+                    continue
+                tag = kw.split('@', 1)[0]
+                if tag == 'in:':
+                    namespaces[ns] = list(counts)
+                elif ns == tag_namespace:
+                    tags[tag_unquote(tag)] = list(counts)
+            return {
+                'version': self.get_version(),
+                'tags': tags,
+                'namespaces': namespaces}
+
     def iter_byte_keywords(self, min_hits=1, ignore_re=None):
         for i in range(self.l2_begin, len(self.records)):
             try:
@@ -351,7 +787,7 @@ class SearchEngine:
                 pass
 
     def create_part_space(self, min_hits=0, ignore_re=IGNORE_NONLATIN_RE):
-        self.part_spaces[0] = create_wordblob(self.iter_byte_keywords(
+        blob = create_wordblob(self.iter_byte_keywords(
                 min_hits=(min_hits or self.config['partial_min_hits']),
                 ignore_re=ignore_re),
             shortest=self.config['partial_shortest'],
@@ -359,7 +795,10 @@ class SearchEngine:
             maxlen=self.config['partial_list_len'],
             lru=True)
         with self.lock:
+            self.part_spaces[0] = blob
             self.records[self.IDX_PART_SPACE] = self.part_spaces[0]
+            if self.part_indexes:
+                self.part_indexes[0].update(self.part_spaces[0])
             return self.part_spaces[0]
 
     def part_space_count(self, term, min_hits):
@@ -386,7 +825,8 @@ class SearchEngine:
         else:
             counter = self.part_space_count
 
-        updating = set(terms) | spaces[1]
+        with self.lock:
+            updating, spaces[1] = set(terms) | spaces[1], set()
         adding = set()
         removing = set()
         ignoring = set()
@@ -410,18 +850,19 @@ class SearchEngine:
                 blacklist |= wset
                 adding -= wset
 
-        if adding or removing:
-            spaces[0] = update_wordblob(adding, spaces[0],
-                blacklist=blacklist,
-                shortest=self.config['partial_shortest'],
-                longest=self.config['partial_longest'],
-                maxlen=self.config['partial_list_len'],
-                lru=True)
-            # FIXME: This becomes expensive if update batches are small!
-            self.records[self.IDX_PART_SPACE] = spaces[0]
-
-        spaces[1] = set()
-        return spaces[0]
+        with self.lock:
+            if adding or removing:
+                spaces[0] = update_wordblob(adding, spaces[0],
+                    blacklist=blacklist,
+                    shortest=self.config['partial_shortest'],
+                    longest=self.config['partial_longest'],
+                    maxlen=self.config['partial_list_len'],
+                    lru=True)
+                # FIXME: This becomes expensive if update batches are small!
+                self.records[self.IDX_PART_SPACE] = spaces[0]
+                if (spaces is self.part_spaces) and self.part_indexes:
+                    self.part_indexes[0].update(spaces[0])
+            return spaces[0]
 
     def add_static_terms(self, wordlist, spaces=None):
         if spaces is None:
@@ -459,7 +900,13 @@ class SearchEngine:
             spaces = self.part_spaces
         blobs = [spaces[0]]
         blobs.extend(blob for blob, words in spaces[2:])
-        clist = wordblob_search(keyword, blobs, max_results)
+        indexes = None
+        if spaces is self.part_spaces:
+            with self.lock:
+                indexes = self.part_indexes
+                while len(indexes) < len(blobs):
+                    indexes.append(WordblobIndex(blobs[len(indexes)]))
+        clist = wordblob_search(keyword, blobs, max_results, indexes=indexes)
         return [prefix+c for c in clist[:max_results]]
 
     def _empty_l1_idx(self):
@@ -542,7 +989,6 @@ class SearchEngine:
         new_kw = self._ns(new_kw, tag_namespace)
         kw_pos, kw_idx = self.records.keys[self.records.hash_key(kw)]
         with self.lock:
-            self.records.cache = {}  # Drop cache
             plb = PostingListBucket(self.records.get(kw_idx) or b'')
             bcom, iset = plb.remove(kw)
             plb.set(new_kw, iset, comment=bcom)
@@ -550,6 +996,18 @@ class SearchEngine:
             self.records.set_key(new_kw, kw_idx)
             self.records.del_key(kw)
 
+            if self.tag_counters is not None:
+                self._settle_tag_counts()
+                refs = set()
+                for ns in (self._tag_ns(kw), self._tag_ns(new_kw)):
+                    rkw, mkws = self._count_refs(ns)
+                    refs |= set([rkw] + mkws)
+                if (kw in refs) or (new_kw in refs):
+                    self.tag_counters = None
+                elif kw in self.tag_counters:
+                    self.tag_counters[new_kw] = self.tag_counters.pop(kw)
+                self._save_tag_counts()
+
     def rename_tag(self, tag, new_tag, tag_namespace=''):
         return self.rename_l1(tag, new_tag, tag_namespace)
 
@@ -661,6 +1119,7 @@ class SearchEngine:
         slot = version = None
         cset_all = IntSet()
         changes = []
+        tag_changes = {}
         mutations = 0
         with self.lock:
             for mset, op_kw_list in mlist:
@@ -692,6 +1151,7 @@ class SearchEngine:
                             plb.set(kw, oset)
                             self.records[idx] = plb.blob
                             mutations += 1
+                            self._note_tag_change(tag_changes, kw, iset, oset)
 
                             # Only keep history and report results regarding the
                             # mutation itself, to save space (zeros compress well)
@@ -709,6 +1169,7 @@ class SearchEngine:
                                 dumb_encode_asc(iset, compress=256),
                                 dumb_encode_asc(oset, compress=256)])
 
+            self._update_tag_counts(tag_changes)
             if record_history:
                 # Allocate slot while still locked, then release.
                 slot, version = self._allocate_history_slot()
@@ -731,7 +1192,8 @@ class SearchEngine:
             'changed': cset_all,
             ('history' if record_history else 'changes'): changes}
 
-    def profile_updates(self, which, oc, bc, t0, t1, t2, t3):
+    def profile_updates(self, which, oc, bc, t0, t1, t2, t3,
+            messages=0, records=0):
         p1 = int((t1 - t0) * 1000)
         p2 = int((t2 - t1) * 1000)
         p3 = int((t3 - t2) * 1000)
@@ -739,10 +1201,23 @@ class SearchEngine:
         self.profile1 += p1
         self.profile2 += p2
         self.profile3 += p3
+        self.profileM += messages
+        self.profileR += records
+        bpm = (bc // messages) if messages else 0
         logging.debug(
-            'Profiling(%s): prep/write/update .. now(%d/%d=%d/%d/%d) total(%d=%d/%d/%d)'
-            % (which, (bc-oc), bc, p1, p2, p3,
-               self.profileB, self.profile1, self.profile2, self.profile3))
+            ('Profiling(%s): prep/write/update .. now(%d/%d=%d/%d/%d, '
+             '%d recs, %d B/msg) total(%d=%d/%d/%d, %d recs, %d B/msg)')
+            % (which, (bc-oc), bc, p1, p2, p3, records, bpm,
+               self.profileB, self.profile1, self.profile2, self.profile3,
+               self.profileR, self.profileB // max(1, self.profileM)))
+        return {
+            'bytes': bc,
+            'bytes_delta': bc - oc,
+            'records': records,
+            'bytes_per_msg': bpm,
+            'ms_prep': p1,
+            'ms_write': p2,
+            'ms_update': p3}
 
     def del_results(self, results, tag_namespace='', touch=True):
         """
@@ -754,19 +1229,22 @@ class SearchEngine:
         t1 = time.time()
         bc = 0
         modified = IntSet()
+        tag_changes = {}
         for idx, kw in sorted(kw_idx_list):
             with self.lock:
                 plb = PostingListBucket(self.records.get(idx) or b'')
                 plb.deleted = IntSet(copy=self.deleted)
                 plb.deleted |= keywords[kw]
-                plb.add(kw, [])
+                before = plb.get(kw) if self._counting(kw) else None
+                after = plb.add(kw, [])
+                self._note_tag_change(tag_changes, kw, before, after)
                 self.records[idx] = plb.blob
                 if (not plb.blob) and (idx < self.l2_begin):
-                    self.records.cache = {}
                     self.records.del_key(kw)
                 else:
                     bc += len(plb.blob)
             modified |= keywords[kw]
+        self._update_tag_counts(tag_changes)
         self.touch(modified)
         t2 = time.time()
         self.update_terms(keywords)
@@ -778,28 +1256,55 @@ class SearchEngine:
             prefer_l1=None, tag_namespace='', touch=True):
         """
         Add a list (or iterable) of results (ids, keywords) to the index.
+
+        Keywords are grouped by bucket, so each record is read and written
+        at most once per batch. Updated records are buffered and written
+        out in index order whenever the buffer exceeds
+        self.batch_write_bytes, which is also when the lock gets released to
+        let searches through.
         """
         t0 = time.time()
         (kw_idx_list, keywords, hits) = self._prep_results(
             results, prefer_l1, tag_namespace, touch, True)
+        buckets = {}
+        for idx, kw in kw_idx_list:
+            buckets.setdefault(idx, []).append(kw)
         t1 = time.time()
+
         oc = 0
         bc = 0
-        for idx, kw in sorted(kw_idx_list):
+        tag_changes = {}
+        max_pending = self.batch_write_bytes
+        bucket_order = sorted(buckets, reverse=True)
+        while bucket_order:
             with self.lock:
-                plb = PostingListBucket(self.records.get(idx) or b'')
-                oc += len(plb.blob)
+                pending = []
+                pending_bytes = 0
+                while bucket_order and (pending_bytes < max_pending):
+                    idx = bucket_order.pop(-1)
+                    plb = PostingListBucket(self.records.get(idx) or b'')
+                    oc += len(plb.blob)
 
-                plb.deleted = self.deleted
-                plb.add(kw, keywords[kw])
-                self.records[idx] = plb.blob
-            bc += len(plb.blob)
+                    plb.deleted = self.deleted
+                    for kw in buckets[idx]:
+                        before = plb.get(kw) if self._counting(kw) else None
+                        after = plb.add(kw, keywords[kw])
+                        self._note_tag_change(tag_changes, kw, before, after)
+                    pending.append((idx, plb.blob))
+                    pending_bytes += len(plb.blob)
 
+                for idx, blob in pending:
+                    self.records[idx] = blob
+            bc += pending_bytes
+
+        self._update_tag_counts(tag_changes)
         t2 = time.time()
-        self.part_spaces[1] |= set(keywords.keys())
-        self.profile_updates(
-            '+%d' % len(kw_idx_list), oc, bc, t0, t1, t2, time.time())
-        return {'keywords': len(keywords), 'hits': hits}
+        with self.lock:
+            self.part_spaces[1] |= set(keywords.keys())
+        profile = self.profile_updates(
+            '+%d' % len(kw_idx_list), oc, bc, t0, t1, t2, time.time(),
+            messages=len(hits), records=len(buckets))
+        return {'keywords': len(keywords), 'hits': hits, 'profile': profile}
 
     def __getitem__(self, keyword):
         idx = self.keyword_index(keyword)
@@ -823,11 +1328,81 @@ class SearchEngine:
             ids = []
         return [i for i in ids if 0 <= i <= self.maxint]
 
+    def _search_op(self, op, terms, tag_ns):
+        def _flat(terms, first):
+            # Nested operations of the same kind can be evaluated as one
+            # n-ary operation; for SUB this only holds for the first term.
+            for i, t in enumerate(terms):
+                if (op == IntSet.And) and isinstance(t, list):
+                    yield from _flat(t, False)
+                elif (isinstance(t, tuple) and (len(t) > 1) and (t[0] == op)
+                        and ((op != IntSet.Sub) or (first and i == 0))):
+                    yield from _flat(t[1:], first and (i == 0))
+                else:
+                    yield t
+        terms = list(_flat(terms, True))
+
+        # Note: self._search() always returns a fresh IntSet which nobody
+        # else holds a reference to, so we can work in place (clone=True)
+        # instead of copying the bitmaps at every node of the tree.
+        if op == IntSet.And:
+            clip = None
+            leaves, subtrees = [], []
+            for t in terms:
+                if (t == IntSet.All) and not tag_ns:
+                    clip = self.maxint
+                elif isinstance(t, (tuple, list)):
+                    subtrees.append(t)
+                else:
+                    leaves.append(t)
+            if not (leaves or subtrees):
+                return IntSet.All(self.maxint)
+
+            # Fetch the plain keywords first and start with the smallest,
+            # so we can often skip evaluating the rest of the tree.
+            result = None
+            for iset in sorted(
+                    (self._search(t, tag_ns) for t in leaves),
+                    key=lambda i: i.count()):
+                if result is None:
+                    result = iset
+                else:
+                    result = IntSet.And(result, iset, clone=True)
+                if not result:
+                    return result
+            for t in subtrees:
+                iset = self._search(t, tag_ns)
+                if result is None:
+                    result = iset
+                else:
+                    result = IntSet.And(result, iset, clone=True)
+                if not result:
+                    return result
+            if clip is not None:
+                result.clip(clip)
+            return result
+
+        elif op == IntSet.Sub:
+            result = self._search(terms[0], tag_ns)
+            for t in terms[1:]:
+                if not result:
+                    break
+                result = IntSet.Sub(result, self._search(t, tag_ns), clone=True)
+            return result
+
+        elif op == IntSet.Or:
+            # Accumulate into the largest set, so nothing needs to grow.
+            isets = sorted(
+                (self._search(t, tag_ns) for t in terms),
+                key=len, reverse=True)
+            return IntSet.Or(*isets, clone=True)
+
+        return op(*[self._search(t, tag_ns) for t in terms])
+
     def _search(self, term, tag_ns):
         if isinstance(term, tuple):
             if len(term) > 1:
-                op = term[0]
-                return op(*[self._search(t, tag_ns) for t in term[1:]])
+                return self._search_op(term[0], term[1:], tag_ns)
             else:
                 return IntSet()
 
@@ -846,7 +1421,7 @@ class SearchEngine:
                return self[term]
 
         if isinstance(term, list):
-            return IntSet.And(*[self._search(t, tag_ns) for t in term])
+            return self._search_op(IntSet.And, term, tag_ns)
 
         if term == IntSet.All:
             if tag_ns:
@@ -898,7 +1473,7 @@ class SearchEngine:
         with self.lock:
             rv = self._search(ops, tag_namespace)
             if mask_deleted:
-                rv = IntSet.Sub(rv, self.deleted)
+                rv = IntSet.Sub(rv, self.deleted, clone=True)
         if explain:
             rv = (tag_namespace, ops, rv)
         return rv
@@ -988,6 +1563,39 @@ if __name__ == '__main__':
     _assert(pl.get('hello') is None)
     _assert(len(pl.blob), 0)
 
+    # Old-style unsorted buckets are readable, and upgraded on write
+    old_style = b''.join(
+        struct.pack('<HHI', len(k), len(c), len(i)) + k + c + i
+        for k, c, i in (
+            (b'world', b'', dumb_encode_bin(IntSet([3]))),
+            (b'hello', b'hi', dumb_encode_bin(IntSet([1, 2])))))
+    pl = PostingListBucket(old_style)
+    _assert(list(pl), [b'world', b'hello'])
+    _assert(pl.get('hello', with_comment=True), (b'hi', IntSet([1, 2])))
+    pl.add('iceland', [4])
+    _assert(pl.blob[:len(pl.MAGIC)], pl.MAGIC)
+    _assert(list(pl), [b'hello', b'iceland', b'world'])
+    _assert(pl.get('hello', with_comment=True), (b'hi', IntSet([1, 2])))
+
+    # Splicing entries in and out keeps the directory consistent
+    expected = {}
+    for i in range(0, 500):
+        kw = 'kw%d' % random.randint(0, 50)
+        if random.randint(0, 3) == 0:
+            pl.remove(kw)
+            expected.pop(kw, None)
+        else:
+            ints = [random.randint(0, 1000) for j in range(0, i % 7)]
+            pl.add(kw, ints)
+            if ints or kw in expected:
+                expected[kw] = expected.get(kw, set()) | set(ints)
+    for kw, ints in expected.items():
+        _assert(pl.get(kw), ints)
+    for kw in (b'hello', b'iceland', b'world'):
+        _assert(pl.get(kw) is not None)
+    _assert(list(pl), sorted(list(pl)))
+    _assert(len(list(pl)), len(expected) + 3)
+
     # Create a mini search engine...
     def mk_se():
         k = b'1234123412349999'
@@ -1008,7 +1616,21 @@ if __name__ == '__main__':
         (5, ['in:inbox', 'please'])],
         tag_namespace='work')
 
-    se.deleted |= 0
+    # Tiny write buffer: every record gets flushed separately
+    se.batch_write_bytes = 1
+    rv = se.add_results([
+        (6, ['batched', 'batch%d' % i]) for i in range(0, 50)] + [
+        (7, ['batched', 'batch%d' % i]) for i in range(0, 50, 2)])
+    se.batch_write_bytes = se.BATCH_WRITE_BYTES
+    _assert(rv['profile']['records'] <= rv['keywords'])
+    _assert(rv['profile']['bytes_per_msg'] > 0)
+    _assert(list(se.search('batched')), [6, 7])
+    _assert(list(se.search('batch48')), [6, 7])
+    _assert(list(se.search('batch49')), [6])
+    se.del_results([([6, 7], ['batched'] + ['batch%d' % i for i in range(0, 50)])])
+    _assert(list(se.search('batched')), [])
+
+    se.deleted |= [0, 6, 7]
     _assert(list(se.search(IntSet.All)), [1, 2, 3, 4, 5])
 
     _assert(3 in se.search('please'))
@@ -1045,6 +1667,18 @@ if __name__ == '__main__':
     _assert(3 not in se.search('in:inbox'))
     _assert(4 in se.search('in:testing'))
 
+    # Nested and n-ary operations
+    _assert(list(se.search(
+            (IntSet.And, (IntSet.Or, 'hello', 'iceland', 'notfound'), 'world'))),
+        [1])
+    _assert(list(se.search(
+            (IntSet.Sub, (IntSet.Sub, IntSet.All, 'hello'), 'in:testing'))),
+        [3, 5])
+    _assert(list(se.search(
+            (IntSet.And, IntSet.All, ['hello', (IntSet.Or, 'world', 'ell')]))),
+        [1, 2])
+    _assert(list(se.search((IntSet.And, 'notfound', (IntSet.Or, 'hello')))), [])
+
     mr = se.mutate([
         (IntSet([4, 3]), [('-', 'in:testing'), (IntSet.Or, 'in:inbox')]),
         ], record_history='Testing')
@@ -1078,6 +1712,41 @@ if __name__ == '__main__':
     se.add_results([(4, ['in:testempty'])])
     _assert(4 in se.search('in:testempty'))
 
+    # Tag counts are kept up to date as we go, and match a recount
+    se.mutate([(IntSet([4]), [('+', 'in:read')])])
+    se.mutate([(IntSet([3]), [('+', 'in:trash')])])
+    _assert(se.tag_counts()['tags']['in:outbox'], [2, 1, 1, 0])
+    _assert(se.tag_counts()['tags']['in:testempty'], [1, 0, 1, 0])
+    _assert(se.tag_counts('work')['tags'], {'in:inbox': [1, 1, 1, 1]})
+    _assert(se.tag_counts('work')['namespaces'], {'work': [1, 1, 1, 1]})
+    _assert('in:inbox' not in se.tag_counts()['tags'])
+    counts = dict(se.tag_counters)
+    _assert(se.recount_tags(), counts)
+
+    # Random changes to tags, read and masked state stay consistent too
+    rnd = random.Random(0)
+    se.add_results([(i, ['in:inbox']) for i in range(1, 8)],
+        tag_namespace='rnd')
+    for i in range(0, 50):
+        msgs = IntSet(rnd.sample(range(1, 8), rnd.randint(1, 3)))
+        se.mutate([(msgs, [
+                (rnd.choice('+-'), rnd.choice(
+                    ['in:read', 'in:trash', 'in:junk', 'in:inbox', 'in:rnd']))
+                for j in range(0, rnd.randint(1, 3))])],
+            tag_namespace='rnd')
+        if i % 10 == 0:
+            se.add_results([(rnd.randint(1, 7), ['in:read', 'in:added'])],
+                tag_namespace='rnd')
+            se.del_results([(rnd.randint(1, 7), ['in:inbox'])],
+                tag_namespace='rnd')
+        if i % 7 == 0:
+            se._settle_tag_counts()
+            counts = dict(se.tag_counters)
+            _assert(se.recount_tags(), counts)
+    se._settle_tag_counts()
+    counts = dict(se.tag_counters)
+    _assert(se.recount_tags(), counts)
+
     print('Tests pass OK (1/3)')
 
     for round in range(0, 2):
@@ -1092,6 +1761,7 @@ if __name__ == '__main__':
         _assert(4 in se.search('in:outbox'))
         _assert(4 in se.search('in:OUTBOX'))
         _assert(4 not in se.search('in:inbox'))
+        _assert(se.tag_counts()['tags']['in:outbox'], [2, 1, 1, 0])
 
         # Enable and test partial word searches
         se.create_part_space(min_hits=1)
@@ -1129,10 +1799,49 @@ if __name__ == '__main__':
         se.add_dictionary_terms('/usr/share/dict/words')
         _assert('additional' in se.candidates('addit*', 20))
 
-        se.records.compact()
+        hello = list(se.search('hello'))
+        chunks = sorted(se.records.chunks)
+        for progress in se.records.compact_incrementally(chunks=chunks):
+            pass
+        _assert(list(se.search('hello')), hello)
         print('Tests pass OK (%d/3)' % (round+2,))
 
     #import time
     #time.sleep(10)
   finally:
     se.delete_everything(True, False, True)
+
+  import sys
+  if 'benchmark' in sys.argv[1:]:
+    # Marking a single message as read should only cost work proportional
+    # to the tags that message has, not to the size of every tag.
+    bse = SearchEngine('/tmp', name='se-bench', defaults={'l2_buckets': 10240})
+    try:
+        rnd = random.Random(0)
+        count = 500000
+        bse.touch = lambda *args, **kwargs: []  # Versioning is irrelevant
+        bse.mutate([
+            (IntSet(rnd.sample(range(1, count), count // 10)),
+                [('+', 'in:tag%d' % t)])
+            for t in range(0, 100)] + [
+            (IntSet(list(range(1, count, 2))), [('+', 'in:read')]),
+            (IntSet(list(range(1, count, 50))), [('+', 'in:trash')])])
+        del bse.touch
+
+        t0 = time.time()
+        bse.recount_tags()
+        t1 = time.time()
+        toggles = 100
+        for i in range(0, toggles):
+            msg = IntSet([rnd.randint(1, count)])
+            bse.mutate([(msg, [('+', 'in:read')])])
+            bse.mutate([(msg, [('-', 'in:read')])])
+        t2 = time.time()
+        bse.tag_counts()
+        t3 = time.time()
+        print(('Recounting %d tags: %.1fms, read toggle: %.2fms,'
+               ' settling counts: %.1fms')
+            % (len(bse.tag_counters), 1000 * (t1 - t0),
+               1000 * (t2 - t1) / (2 * toggles), 1000 * (t3 - t2)))
+    finally:
+        bse.delete_everything(True, False, True)
@@ -26,13 +26,15 @@ import logging
 import os
 import random
 import re
+import threading
 import time
 import traceback
 import hashlib
 
 from ..email.headers import parse_header
+from ..storage.records import RecordCache
 from ..util.dumbcode import from_json, to_json
-from ..util.spambayes import Classifier
+from ..util.spambayes import Classifier, TokenStore
 
 DEFAULT_NEW_FILTER_SCRIPT = """\
 # These are the default moggie filter rules. Edit to taste!
@@ -254,6 +256,12 @@ class AutoTagger:
     DEF_CLASSIFIER = 'spambayes'
     DEF_TRAINING_AUTO = True
 
+    # Taggers with more tokens than this keep them in a binary TokenStore
+    TOKEN_STORE_MIN = 10000
+
+    # Estimated bytes used by a cached obfuscated keyword, plus its length
+    OBFUSCATED_SIZE = 128
+
     SKIP_RE = re.compile(
         '(^\\d+$'
         '|^.{0,3}$'
@@ -275,6 +283,11 @@ class AutoTagger:
         self.ham_ids = []
         self.info = {}
 
+        # An optional cache of obfuscated keywords, which the FilterEngine
+        # shares between all its taggers.
+        self.obfuscated = None
+        self.obfuscated_lock = None
+
     def from_json(self, raw_json):
         self.info = info = from_json(raw_json)
         self.tag = info.pop('tag')
@@ -285,7 +298,8 @@ class AutoTagger:
         self.training_auto = bool(info.pop('training_auto', self.DEF_TRAINING_AUTO))
         self.trained_version = info.pop('trained_version', 0)
         self.classifier_type = info.pop('classifier', self.DEF_CLASSIFIER)
-        self.classifier.load(info.pop('data', []))
+        if 'tokens' not in info:
+            self.classifier.load(info.pop('data', []))
         return self
 
     def to_json(self):
@@ -298,10 +312,39 @@ class AutoTagger:
             'threshold': self.threshold,
             'training_auto': self.training_auto,
             'trained_version': self.trained_version,
-            'classifier': self.classifier_type,
-            'data': list(self.classifier)})
+            'classifier': self.classifier_type})
+        if 'tokens' not in info:
+            info['data'] = list(self.classifier)
         return to_json(info)
 
+    def tokens_path(self, fpath):
+        return os.path.join(os.path.dirname(fpath), self.info['tokens'])
+
+    def load_tokens(self, fpath):
+        """
+        If our classifier data lives in a TokenStore, load it. The fpath
+        is the path of our JSON file, which the TokenStore lives next to.
+        """
+        if 'tokens' in self.info:
+            self.classifier.load_store(TokenStore(self.tokens_path(fpath)))
+        return self
+
+    def save_tokens(self, fpath):
+        """
+        Save our classifier data to a TokenStore, if it is large enough
+        to benefit. Returns True if to_json() should omit the data.
+        """
+        wordinfo = self.classifier.wordinfo
+        if not isinstance(wordinfo, TokenStore):
+            if len(wordinfo) < self.TOKEN_STORE_MIN:
+                self.info.pop('tokens', None)
+                return False
+            self.classifier.wordinfo = TokenStore.FromItems(wordinfo.items())
+            self.info['tokens'] = (
+                os.path.basename(fpath).rsplit('.', 1)[0] + '.atok')
+        self.classifier.save_store(self.tokens_path(fpath))
+        return True
+
     @classmethod
     def MakeSearchObject(self, context=None, terms=None):
         from ..api.requests import RequestSearch
@@ -326,12 +369,36 @@ class AutoTagger:
     def obfuscate(self, keywords):
         if not self.salt:
             return keywords
-        def _obfu(kw):
-            if (':' not in kw) or (kw[:8] == 'subject:'):
-                kw = hashlib.sha1(bytes(kw, 'utf-8') + self.salt)
-                kw = kw.hexdigest()[:12]
-            return kw
-        return [_obfu(kw) for kw in keywords]
+        salt, cache = self.salt, self.obfuscated
+        def _hash(kw):
+            return hashlib.sha1(bytes(kw, 'utf-8') + salt).hexdigest()[:12]
+        if cache is None:
+            return [
+                (_hash(kw) if ((':' not in kw) or (kw[:8] == 'subject:'))
+                 else kw)
+                for kw in keywords]
+
+        obfuscated = []
+        with self.obfuscated_lock:
+            for kw in keywords:
+                if (':' not in kw) or (kw[:8] == 'subject:'):
+                    key = (salt, kw)
+                    obfu = cache.get(key)
+                    if obfu is None:
+                        obfu = _hash(kw)
+                        cache.set(key, obfu, len(kw) + self.OBFUSCATED_SIZE)
+                    kw = obfu
+                obfuscated.append(kw)
+        return obfuscated
+
+    @classmethod
+    def prepare_keywords(cls, keywords):
+        """
+        Filter and normalize keywords for classification or training;
+        the result can be passed to classify_many() for any tagger.
+        """
+        keywords = [k.lower() for k in keywords if not cls.SKIP_RE.match(k)]
+        return keywords, [k for k in keywords if ':' in k]
 
     def is_known(self, _id):
         return (_id in self.spam_ids) or (_id in self.ham_ids)
@@ -362,6 +429,34 @@ class AutoTagger:
                 if p <= (0.5 - delta) or p >= (0.5 + delta):
                     return p
 
+    def classify_many(self, prepared):
+        """
+        Classify many messages at once, returning a list of ranks. The
+        input should be a list of prepare_keywords() results. This gives
+        the same results as calling classify() on each, but faster.
+        """
+        if not self.is_trained():
+            return [0.5] * len(prepared)
+
+        ranks = [None] * len(prepared)
+        for which, minkw, confidence in (
+                (1, 3, self.threshold),
+                (0, 0, 0)):
+            todo = [i for i, r in enumerate(ranks)
+                if (r is None) and (len(prepared[i][which]) >= minkw)]
+            if not todo:
+                continue
+            delta = confidence / 2.0
+            obfuscated = [self.obfuscate(prepared[i][which]) for i in todo]
+            if self.classifier.use_chi_squared_combining:
+                probs = self.classifier.chi2_spamprobs(obfuscated)
+            else:
+                probs = [self.classifier.classify(o) for o in obfuscated]
+            for i, p in zip(todo, probs):
+                if p <= (0.5 - delta) or p >= (0.5 + delta):
+                    ranks[i] = p
+        return ranks
+
     def learn(self, _id, keywords, is_spam=True):
         set_yes = self.spam_ids if is_spam else self.ham_ids
         set_no = self.ham_ids if is_spam else self.spam_ids
@@ -456,8 +551,12 @@ class FilterRule:
 
 
 class FilterEngine:
+    # Default memory budget for the obfuscated keyword cache
+    OBFUSCATED_BYTES = 16 * 1024 * 1024
+
     def __init__(self,
             moggie=None, encryption_keys=None,
+            obfuscated_bytes=None,
             mock_os=None, mock_open=None, mock_exc=None):
         self.moggie = moggie
         self.aes_keys = encryption_keys
@@ -468,6 +567,8 @@ class FilterEngine:
         self.filter_dirs = []
         self.writable_dirs = []
         self.autotaggers = {}
+        self.obfuscated = RecordCache(obfuscated_bytes or self.OBFUSCATED_BYTES)
+        self.obfuscated_lock = threading.Lock()
         self.logged = set()
         self.pys = {
             'DEFAULT': FilterRule.Load(DEFAULT_NEW_FILTER_SCRIPT, self)}
@@ -532,15 +633,36 @@ class FilterEngine:
     def load_autotagger(self, fpath):
         with self.open(fpath, 'rb') as fd:
             json_data = fd.read()
-        at = AutoTagger().from_json(json_data)
-        self.autotaggers[at.tag] = (fpath, at)
+        at = AutoTagger().from_json(json_data).load_tokens(fpath)
+        self._add_autotagger(fpath, at)
         logging.info('[import] Loaded autotagging rules for %s: %s'
             % (at.tag, fpath))
 
+    def _add_autotagger(self, fpath, at):
+        at.obfuscated = self.obfuscated
+        at.obfuscated_lock = self.obfuscated_lock
+        self.autotaggers[at.tag] = (fpath, at)
+
+    def unload_autotaggers(self):
+        """
+        Forget all loaded autotaggers and release their caches; the next
+        call to load() will load them again from disk.
+        """
+        for fpath, at in self.autotaggers.values():
+            self.loaded.pop(fpath, None)
+        self.autotaggers = {}
+        self.release_caches()
+
+    def release_caches(self):
+        with self.obfuscated_lock:
+            self.obfuscated.clear()
+
     def save_autotagger(self, tag):
         # FIXME: This should encrypt the contents!
         try:
             fpath, at = self.autotaggers[tag]
+            if self.os is os:
+                at.save_tokens(fpath)  # Requires a real filesystem
             dump = at.to_json()
             with self.open(fpath, 'w') as fd:
                 fd.write(dump)
@@ -563,7 +685,7 @@ class FilterEngine:
                 if not self.os.path.exists(fpath):
                     break
             if fpath:
-                self.autotaggers[tag] = (fpath, at)
+                self._add_autotagger(fpath, at)
                 if not self.save_autotagger(tag):
                     del self.autotaggers[tag]
                     return None
@@ -571,6 +693,20 @@ class FilterEngine:
                 return None
         return self.autotaggers[tag][1]
 
+    def classify_many(self, tags, keyword_lists):
+        """
+        Classify many messages against many autotaggers, in one pass.
+        Returns a dictionary of tag -> list of ranks, omitting any tags
+        which lack autotaggers.
+        """
+        prepared = [AutoTagger.prepare_keywords(kws) for kws in keyword_lists]
+        results = {}
+        for tag in tags:
+            at = self.get_autotagger(tag, create=False)
+            if at is not None:
+                results[tag] = at.classify_many(prepared)
+        return results
+
     def filter(self, tag_namespace, keywords, metadata, parsed_email,
             which=None):
         if which is not None:
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import mmap
 import time
@@ -44,9 +45,11 @@ class FileMap(mmap.mmap):
 class FileStorage(BaseStorage, MailboxStorageMixin):
     def __init__(self,
             relative_to=None, metadata=None,
-            ask_secret=None, set_secret=None):
+            ask_secret=None, set_secret=None,
+            offset_index_dir=None):
         self.metadata = metadata
         self.relative_to = relative_to
+        self.offset_index_dir = offset_index_dir
         self.ask_secret = ask_secret
         self.set_secret = set_secret
         if isinstance(self.relative_to, str):
@@ -59,6 +62,18 @@ class FileStorage(BaseStorage, MailboxStorageMixin):
     def RegisterFormat(cls, fmt):
         FORMATS[fmt.TAG] = fmt
 
+    def offset_index_path(self, path):
+        """
+        Return where a mailbox format may keep an index of message
+        offsets within the file at path, or None if we don't do that.
+        """
+        if not self.offset_index_dir:
+            return None
+        if isinstance(path, str):
+            path = path.encode('utf-8')
+        name = hashlib.blake2b(path, digest_size=16).hexdigest()
+        return os.path.join(self.offset_index_dir, name + '.idx')
+
     def relpath(self, path):
         if self.relative_to:
             return os.path.relpath(path, self.relative_to)
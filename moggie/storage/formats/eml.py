@@ -39,7 +39,7 @@ class FormatEml(FormatMbox):
 
         return 0, len(self.container)
 
-    def iter_email_offsets(self, skip=0, deleted=False):
+    def iter_email_offsets(self, skip=0, deleted=False, reverse=False):
         obj = self.container
         try:
             hend, hdrs = quick_msgparse(obj, 0)
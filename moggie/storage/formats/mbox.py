@@ -6,14 +6,26 @@
 # FIXME: Instead of throwing KeyError if our range is geborked, search
 #        for the message, like the Maildir does?
 #
+# Finding where messages begin and end means scanning the entire file,
+# which is slow for large mailboxes. So if our parent tells us where, we
+# keep a sidecar index of message offsets (and header hashes). If the
+# file is unchanged the index is used as-is, if it has grown we verify
+# the first and last messages and only scan the new tail, and if it was
+# modified in-place (deletions) we verify each message's headers.
+#
 import copy
+import hashlib
 import logging
 import email.utils
+import struct
+import tempfile
 import time
 import traceback
 import os
 import re
 
+from array import array
+
 # FIXME: We really should use the MboxExporter.MboxTransform to escape
 #        From lines and preserve other useful metadata, before writing to
 #        the mbox.
@@ -49,6 +61,10 @@ From: nobody <deleted@example.org>\r\n\
 (deleted)\r\n"""
     DELETED_FILLER = b"                                                    \r\n"
 
+    OFFSET_INDEX_MAGIC = b'MBXOFS01'
+    OFFSET_INDEX_HEADER = struct.Struct('=8sQQQQ')  # magic,ino,size,mtime,n
+    OFFSET_INDEX_MIN_BYTES = 1024 * 1024
+
     @classmethod
     def IsEmail(cls, buffer):
         eol = b'\r\n' if b'\r\n' in buffer[:128] else b'\n'
@@ -171,13 +187,14 @@ From: nobody <deleted@example.org>\r\n\
         # FIXME: Do we trust super() here?  Think not... hmm.
         return super().__setitem__(key, value)
 
-    def iter_email_offsets(self, skip=0, deleted=False):
+    @classmethod
+    def _hdrs_hash(cls, hdrs):
+        return int.from_bytes(
+            hashlib.blake2b(hdrs, digest_size=8).digest(), 'little')
+
+    def _scan_email_offsets(self, beg=0, rank=0):
         obj = self.container
-        beg = 0
-        end = 0
-        rank = 0
-        delmark = self.DELETED_MARKER
-        needs_compacting = 0
+        end = beg
         try:
             while end < len(obj):
                 hend, hdrs = quick_msgparse(obj, beg)
@@ -187,15 +204,136 @@ From: nobody <deleted@example.org>\r\n\
                 if end < 0:
                     end = len(obj)-1
 
+                yield beg, hend, end+1, hdrs, rank
+
+                beg = end+1
+        except (ValueError, TypeError):
+            return
+
+    def _offset_index_path(self):
+        if ((len(self.path) == 1)
+                and hasattr(self.parent, 'offset_index_path')
+                and (len(self.container) >= self.OFFSET_INDEX_MIN_BYTES)):
+            return self.parent.offset_index_path(self.path[0])
+        return None
+
+    def _load_offset_index(self, ipath, st):
+        hdr = self.OFFSET_INDEX_HEADER
+        try:
+            with open(ipath, 'rb') as fd:
+                magic, ino, size, mtime, count = hdr.unpack(fd.read(hdr.size))
+                offsets = array('Q')
+                offsets.frombytes(fd.read(3 * count * offsets.itemsize))
+        except (OSError, struct.error, ValueError):
+            return None
+        if ((magic != self.OFFSET_INDEX_MAGIC)
+                or (ino != st.st_ino)
+                or (size > st.st_size)
+                or (len(offsets) != 3 * count)):
+            return None
+        return offsets, size, mtime
+
+    def _save_offset_index(self, ipath, st, offsets):
+        try:
+            os.makedirs(os.path.dirname(ipath), mode=0o700, exist_ok=True)
+            # A unique temporary file, in case we are listing the same
+            # mailbox from more than one thread at a time.
+            tfd, tpath = tempfile.mkstemp(dir=os.path.dirname(ipath))
+            try:
+                with open(tfd, 'wb') as fd:
+                    fd.write(self.OFFSET_INDEX_HEADER.pack(
+                        self.OFFSET_INDEX_MAGIC,
+                        st.st_ino, st.st_size, st.st_mtime_ns,
+                        len(offsets) // 3))
+                    offsets.tofile(fd)
+                os.replace(tpath, ipath)
+            except:
+                os.remove(tpath)
+                raise
+        except OSError as e:
+            logging.debug('Failed to save offset index %s: %s' % (ipath, e))
+
+    def _offset_ok(self, offsets, i):
+        obj = self.container
+        beg, end, hhash = offsets[3*i:3*i+3]
+        if obj[beg:beg+5] != b'From ':
+            return False
+        if obj[beg:beg+len(self.DELETED_MARKER)] == self.DELETED_MARKER:
+            return True
+        if (end < len(obj)) and (obj[end-1:end+5] != b'\nFrom '):
+            return False
+        try:
+            return (self._hdrs_hash(quick_msgparse(obj, beg)[1]) == hhash)
+        except TypeError:
+            return False
+
+    def _indexed_offsets(self, ipath):
+        """
+        Return an array of (beg, end, header hash) triplets for every
+        message in the mailbox, loading, validating and extending our
+        persistent index as necessary.
+        """
+        st = os.stat(self.path[0])
+        loaded = self._load_offset_index(ipath, st)
+        if loaded:
+            offsets, size, mtime = loaded
+            count = len(offsets) // 3
+            if (size == st.st_size) and (mtime == st.st_mtime_ns):
+                return offsets
+            elif size == st.st_size:
+                # Modified in place, this happens when we delete messages.
+                valid = 0
+                while (valid < count) and self._offset_ok(offsets, valid):
+                    valid += 1
+            elif count and (self._offset_ok(offsets, 0)
+                    and self._offset_ok(offsets, count-1)):
+                # Grown: assume new mail was appended. The last message's
+                # end may have moved, so we rescan it too.
+                valid = count - 1
+            else:
+                valid = 0
+            logging.debug('Offset index for %s: %d/%d valid, scanning from %d'
+                % (self.path[0], valid, count, offsets[3*valid-2] if valid else 0))
+        else:
+            offsets, valid = array('Q'), 0
+
+        beg = offsets[3*valid - 2] if valid else 0
+        del offsets[3*valid:]
+        for b, he, e, hdrs, rank in self._scan_email_offsets(beg, valid):
+            offsets.extend((b, e, self._hdrs_hash(hdrs)))
+        self._save_offset_index(ipath, st, offsets)
+        return offsets
+
+    def _iter_indexed_offsets(self, offsets, reverse=False):
+        obj = self.container
+        count = len(offsets) // 3
+        for i in (range(count-1, -1, -1) if reverse else range(count)):
+            beg, end = offsets[3*i], offsets[3*i+1]
+            hend, hdrs = quick_msgparse(obj, beg)
+            yield beg, hend, end, hdrs, i+1
+
+    def iter_email_offsets(self, skip=0, deleted=False, reverse=False):
+        obj = self.container
+        delmark = self.DELETED_MARKER
+        needs_compacting = 0
+        try:
+            ipath = self._offset_index_path()
+            if ipath:
+                iterator = self._iter_indexed_offsets(
+                    self._indexed_offsets(ipath), reverse=reverse)
+            elif reverse:
+                iterator = reversed(list(self._scan_email_offsets()))
+            else:
+                iterator = self._scan_email_offsets()
+
+            for beg, hend, end, hdrs, rank in iterator:
                 if (not deleted) and obj[beg:beg+len(delmark)] == delmark:
                     needs_compacting += 1
                 elif skip > 0:
                     skip -= 1
                 else:
-                    yield beg, hend, end+1, hdrs, rank
-
-                beg = end+1
-        except (ValueError, TypeError):
+                    yield beg, hend, end, hdrs, rank
+        except (OSError, ValueError, TypeError):
             return
         finally:
             if needs_compacting and self.parent:
@@ -212,9 +350,8 @@ From: nobody <deleted@example.org>\r\n\
         lts = 0
         try:
             if iterator is None:
-                iterator = self.iter_email_offsets(
-                    skip=(0 if reverse else skip))
-            if reverse:
+                iterator = self.iter_email_offsets(skip=skip, reverse=reverse)
+            elif reverse:
                 iterator = reversed(list(iterator))
                 if skip:
                     iterator = list(iterator)[skip:]
@@ -286,7 +423,35 @@ From: nobody <deleted@example.org>\r\n\
 
 
 if __name__ == "__main__":
-    import os, sys
+    import os, sys, tempfile
+    from ..files import FileStorage
+
+    # Test the offset index: it should match a full scan, also after
+    # appending and deleting messages.
+    with tempfile.TemporaryDirectory() as tdir:
+        tmbox = os.path.join(tdir, 'test.mbx')
+        def _msg(i):
+            return (b'From x Mon Jan  1 00:00:00 2024\r\nFrom: x@example.org'
+                b'\r\nDate: Mon, 1 Jan 2024 00:00:00 +0000\r\nSubject: %d'
+                b'\r\n\r\n%s\r\n' % (i, b'Hello world\r\n' * 1000))
+        def _offsets(fs, **kwargs):
+            return list(fs.get_mailbox(tmbox).iter_email_offsets(**kwargs))
+        with open(tmbox, 'wb') as fd:
+            fd.write(b''.join(_msg(i) for i in range(200)))
+        plain = FileStorage()
+        indexed = FileStorage(offset_index_dir=os.path.join(tdir, 'idx'))
+        assert(_offsets(plain) == _offsets(indexed) == _offsets(indexed))
+        assert(_offsets(indexed, reverse=True, skip=3)
+            == list(reversed(_offsets(plain)))[3:])
+        with open(tmbox, 'ab') as fd:
+            fd.write(_msg(200))
+        assert(_offsets(plain) == _offsets(indexed))
+        mbox = indexed.get_mailbox(tmbox)
+        beg, hend, end, hdrs, rank = _offsets(indexed)[5]
+        del mbox[mbox.RangeToKey(beg, _data=hdrs)]
+        mbox.container.flush()
+        assert(_offsets(plain) == _offsets(indexed))
+        assert(len(_offsets(indexed)) == 200)
 
     tmbox = b'/tmp/test.mbx'
     os.system(b'cp /home/bre/Mail/mailpile/2013-08.mbx '+tmbox)
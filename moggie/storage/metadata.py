@@ -8,6 +8,8 @@ import zlib
 
 from mmap import mmap, ACCESS_WRITE
 
+import numpy
+
 from .records import RecordStore
 from ..email.metadata import Metadata
 from ..util.dumbcode import dumb_decode, dumb_encode_asc, dumb_encode_bin
@@ -45,6 +47,7 @@ class IntColumn:
         self.minsize = minsize
         self.zero = struct.pack('I', 0)
         self.int_size = len(self.zero)
+        self.np_view = None
 
         if not os.path.exists(filepath):
             with open(filepath, 'wb') as fd:
@@ -54,13 +57,40 @@ class IntColumn:
             self.ranking = mmap(fd.fileno(), 0, access=ACCESS_WRITE)
 
     def close(self):
+        self.np_view = None
         self.ranking.close()
 
     def flush(self):
+        self.np_view = None
         self.ranking.close()
         with open(self.filepath, 'rb+') as fd:
             self.ranking = mmap(fd.fileno(), 0, access=ACCESS_WRITE)
 
+    def array(self):
+        """
+        Return a zero-copy numpy view of the column. Values are stored
+        relative to the baseline, with zero meaning "not set". The view
+        is invalidated whenever the column grows.
+        """
+        if self.np_view is None:
+            self.np_view = numpy.memmap(self.filepath,
+                dtype=numpy.dtype('I'), mode='r+',
+                shape=(len(self.ranking) // self.int_size,))
+        return self.np_view
+
+    def gather(self, idxs):
+        """
+        Return the raw values for a numpy array of indexes, reading
+        zero for any index beyond the end of the column.
+        """
+        arr = self.array()
+        inside = (idxs < len(arr))
+        if inside.all():
+            return arr[idxs]
+        rv = numpy.zeros(len(idxs), dtype=arr.dtype)
+        rv[inside] = arr[idxs[inside]]
+        return rv
+
     def __contains__(self, idx):
         if not isinstance(idx, int):
             return False
@@ -70,15 +100,16 @@ class IntColumn:
             return False
 
     def values(self):
-        _fmt = 'I' * (len(self.ranking) // self.int_size)
-        return struct.unpack(_fmt, self.ranking)
+        return self.array().tolist()
 
     def __iter__(self):
-        return (i for (i, v) in enumerate(self.values()) if v > 0)
+        return iter(numpy.flatnonzero(self.array()).tolist())
 
     def items(self, grep=None):
         if grep is None:
-            return ((i, v) for (i, v) in enumerate(self.values()) if v > 0)
+            arr = self.array()
+            idxs = numpy.flatnonzero(arr)
+            return zip(idxs.tolist(), arr[idxs].tolist())
         else:
             return ((i, v) for (i, v) in enumerate(self.values()) if grep(v))
 
@@ -96,6 +127,7 @@ class IntColumn:
         beg = idx * self.int_size
         end = beg + self.int_size
         while end > len(self.ranking):
+            self.np_view = None
             self.ranking.close()
             with open(self.filepath, 'rb+') as fd:
                 fd.seek(0, io.SEEK_END)
@@ -138,13 +170,14 @@ class MetadataStore(RecordStore):
     # waste space and confuse other algos.
     IGNORE_MORE_KEYS = ('metadata_idx', 'syn_idx')
 
-    def __init__(self, workdir, store_id, aes_keys):
+    def __init__(self, workdir, store_id, aes_keys, cache_bytes=None):
         super().__init__(workdir, store_id,
             sparse=True,
             compress=64,
             aes_keys=aes_keys,
             est_rec_size=400,
-            target_file_size=64*1024*1024)
+            target_file_size=64*1024*1024,
+            cache_bytes=cache_bytes)
 
         self.rank_by_date = IntColumn(os.path.join(workdir, 'timestamps'))
         self.thread_ids = IntColumn(os.path.join(workdir, 'threads'))
@@ -397,34 +430,59 @@ class MetadataStore(RecordStore):
             m.thread_id = idx
         return m
 
-    def __delitem__(self, key):
-        # FIXME: Fetch the item, delete all the pointers!
-        super().__delitem__(key)
-        idx = self.key_to_index(key)
-        del self.rank_by_date[idx]
-        del self.thread_ids[idx]
-        del self.mtimes[idx]
+    def del_items(self, keys):
+        # FIXME: Fetch the items, delete all the pointers!
+        idxs = [self.key_to_index(key) for key in keys]
+        super().del_items(idxs)
+        for idx in idxs:
+            del self.rank_by_date[idx]
+            del self.thread_ids[idx]
+            del self.mtimes[idx]
         self.thread_cache = None
 
     def _make_thread_cache(self):
-        pairs = [(t, i) for i, t in self.thread_ids.items()]
-        pairs.sort()
-        cur = [-1]
-        self.thread_cache = {}
-        for t, i in pairs:
-            if t != cur[0]:
-                if len(cur) > 1:
-                    self.thread_cache[cur[0]] = cur
-                cur = [t]
-            if i != t:
-                cur.append(i)
-        if len(cur) > 1:
-            self.thread_cache[cur[0]] = cur
+        # Group message indexes by thread ID; threads of one are omitted.
+        tids = self.thread_ids.array()
+        idxs = numpy.flatnonzero(tids)
+        tids = tids[idxs].astype(numpy.int64)
+        order = numpy.lexsort((idxs, tids))
+        idxs, tids = idxs[order], tids[order]
+        # Built locally and then assigned, so readers in other threads
+        # never see a half-built cache.
+        cache = {}
+        starts = numpy.flatnonzero(numpy.diff(tids, prepend=-1))
+        for beg, end in zip(starts.tolist(), starts[1:].tolist() + [len(tids)]):
+            tid = int(tids[beg])
+            kids = [i for i in idxs[beg:end].tolist() if i != tid]
+            if kids:
+                cache[tid] = [tid] + kids
+        self.thread_cache = cache
+        return cache
 
     def get_thread_idxs(self, thread_id):
-        if self.thread_cache is None:
-            self._make_thread_cache()
-        return self.thread_cache.get(thread_id, [thread_id])
+        cache = self.thread_cache
+        if cache is None:
+            cache = self._make_thread_cache()
+        return cache.get(thread_id, [thread_id])
+
+    def date_sorting_keys(self, idxs):
+        """
+        Gather dates for a numpy array of message indexes, for use with
+        numpy.lexsort((idxs, dates)). Matches date_sorting_keyfunc.
+        """
+        return self.rank_by_date.gather(idxs).astype(numpy.int64)
+
+    def thread_sorting_keys(self, idxs):
+        """
+        Gather thread IDs and dates for a numpy array of message indexes,
+        for use with numpy.lexsort((idxs, dates, tids)). Matches
+        thread_sorting_keyfunc.
+        """
+        dates = self.rank_by_date.gather(idxs).astype(numpy.int64)
+        tids = self.thread_ids.gather(idxs).astype(numpy.int64)
+        have_date = (dates > 0)
+        tids = numpy.where(have_date & (tids > 0), tids, idxs)
+        return (tids, numpy.where(have_date, dates, idxs))
 
     def date_sorting_keyfunc(self, key):
         """
@@ -544,6 +602,14 @@ Subject: Sure, sure
     times = set([t1M //  MetadataStore.TS_RESOLUTION])
     assert(len(list(ms.rank_by_date.items(grep=times.__contains__))) == 1)
 
+    # The vectorized sort keys must match the keyfuncs
+    idxs = numpy.array([i1, 100000, 1000000, 2000000])
+    assert(ms.date_sorting_keys(idxs).tolist() ==
+        [ms.date_sorting_keyfunc(i)[0] for i in idxs.tolist()])
+    tids, dates = ms.thread_sorting_keys(idxs)
+    assert(list(zip(tids.tolist(), dates.tolist(), idxs.tolist())) ==
+        [ms.thread_sorting_keyfunc(i) for i in idxs.tolist()])
+
     del ms[100000]
     try:
         print('Should not exist: %s' % ms[100000])
@@ -1,5 +1,7 @@
 import binascii
+import bisect
 import copy
+import gc
 import hashlib
 import io
 import logging
@@ -10,8 +12,11 @@ import random
 import struct
 import traceback
 
+from collections import OrderedDict
 from mmap import mmap, ACCESS_READ, ACCESS_WRITE
 
+import numpy
+
 from ..crypto.aes_utils import make_aes_key
 from ..util.dumbcode import *
 from .base import BaseStorage
@@ -33,7 +38,77 @@ class ConfigMismatch(ValueError):
     pass
 
 
+class RecordCache:
+    """
+    A byte-budgeted LRU cache of decoded records, keyed by record index.
+
+    Sizes are estimates (usually the encoded length of the record), so the
+    budget is approximate; it is still a budget though, unlike a dict.
+    """
+    OVERHEAD = 64
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, idx):
+        return (idx in self.entries)
+
+    def get(self, idx, default=None):
+        try:
+            size, value = self.entries[idx]
+            self.entries.move_to_end(idx)
+            self.hits += 1
+            return value
+        except KeyError:
+            self.misses += 1
+            return default
+
+    def set(self, idx, value, size):
+        size += self.OVERHEAD
+        self.discard(idx)
+        if size > self.max_bytes:
+            return
+        self.entries[idx] = (size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def discard(self, idx):
+        size_value = self.entries.pop(idx, None)
+        if size_value is not None:
+            self.bytes -= size_value[0]
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def stats(self, prefix='record_cache_'):
+        lookups = self.hits + self.misses
+        return {
+            prefix + 'hits': self.hits,
+            prefix + 'misses': self.misses,
+            prefix + 'hit_rate': (self.hits / lookups) if lookups else 0.0,
+            prefix + 'evictions': self.evictions,
+            prefix + 'entries': len(self.entries),
+            prefix + 'bytes': self.bytes,
+            prefix + 'max_bytes': self.max_bytes}
+
+
 class RecordFile:
+    FREE_MAP_MAGIC = b'RecordFile free map v1\n'
+    FREE_MAP_HEADER = '<QQI'  # File size, compaction time, slot count
+    FREE_MIN_SPLIT = 64
+
     def __init__(self, path, file_id, chunk_records,
             compress=False,
             padding=16,
@@ -70,7 +145,16 @@ class RecordFile:
         self.header_size += (len(self.prefix) + self.int_size + self.long_size)
         self.compress = compress
         self.padding = b' ' * padding
-        self.empties = []
+
+        # The free space map is loaded on demand, see load_free_map()
+        self.free_path = path + '.free'
+        self.free_lists = None
+        self.free_slots = None
+        self.free_ends = None
+        self.free_bytes = 0
+        self.free_saved = False
+        self.free_changes = 0
+        self.compact_stalled = None
 
         self.encoding_kwargs = encoding_kwargs
         if self.encoding_kwargs is None:
@@ -149,9 +233,252 @@ class RecordFile:
         beg = idx * self.int_size + len(self.prefix)
         end = beg + self.int_size
         self.safe_mmap(end)[beg:end] = struct.pack('I', 0)
-        self.offsets[idx] = 0
+        ofs, self.offsets[idx] = self.offsets[idx], 0
+        if ofs > 0:
+            self.add_free_slot(self._slot_length(ofs), ofs)
         # FIXME: Overwrite actual data with zeros? Probably yes.
 
+    def file_size(self):
+        return os.fstat(self.fd.fileno()).st_size
+
+    def _slot_length(self, ofs):
+        end = ofs + 2*self.int_size
+        return struct.unpack('II', self.safe_mmap(end)[ofs:end])[1]
+
+    def _reset_free_map(self):
+        self.free_lists = {}
+        self.free_slots = {}
+        self.free_ends = {}
+        self.free_bytes = 0
+
+    def load_free_map(self):
+        """
+        Load the map of unused slots in this file.
+
+        The map is persisted to a side-car file on close() and deleted as
+        soon as the map changes, so if we crash it will be missing and we
+        rebuild it by walking the record headers instead.
+        """
+        if self.free_slots is not None:
+            return
+        self._reset_free_map()
+        try:
+            with open(self.free_path, 'rb') as fd:
+                data = fd.read()
+            magic = self.FREE_MAP_MAGIC
+            hdr_end = len(magic) + struct.calcsize(self.FREE_MAP_HEADER)
+            f_size, f_ctime, count = struct.unpack(
+                self.FREE_MAP_HEADER, data[len(magic):hdr_end])
+            if ((data[:len(magic)] != magic)
+                    or (f_size != self.file_size())
+                    or (f_ctime != self.compacted_time())):
+                raise ValueError('Stale free space map')
+            slots = numpy.frombuffer(data,
+                dtype='<u4', offset=hdr_end, count=2*count).reshape(-1, 2)
+            live = numpy.array(self.offsets, dtype='<u4')
+            slots = slots[~numpy.isin(slots[:, 1], live)]
+            for ln, ofs in slots.tolist():
+                if self._slot_length(ofs) == ln:
+                    self._insert_free_slot(ln, ofs)
+            self.free_saved = True
+        except (OSError, ValueError, struct.error):
+            self._reset_free_map()
+            self._scan_free_map()
+
+    def _scan_free_map(self):
+        live = set(self.offsets)
+        pos = self.header_size
+        end = self.file_size()
+        mm = self.safe_mmap(end)
+        while pos + 2*self.int_size <= end:
+            ofs, ln = struct.unpack_from('II', mm, pos)
+            if ofs != pos:
+                # Not a record header, we cannot safely go any further.
+                logging.debug('%s: Free space scan stopped at %d/%d'
+                    % (self.path, pos, end))
+                break
+            if pos not in live:
+                self._insert_free_slot(ln, ofs)
+            pos += 2*self.int_size + ln
+
+    def save_free_map(self):
+        if self.free_slots is None:
+            return
+        slots = numpy.array(sorted(self.free_slots.items()), dtype='<u4')
+        slots = slots[:, ::-1] if len(slots) else slots
+        with open(self.free_path + '.tmp', 'wb') as fd:
+            fd.write(self.FREE_MAP_MAGIC)
+            fd.write(struct.pack(self.FREE_MAP_HEADER,
+                self.file_size(), self.compacted_time(), len(slots)))
+            fd.write(slots.tobytes())
+        os.rename(self.free_path + '.tmp', self.free_path)
+        self.free_saved = True
+
+    def _free_map_changed(self):
+        if self.free_saved:
+            if os.path.exists(self.free_path):
+                os.remove(self.free_path)
+            self.free_saved = False
+
+    def _insert_free_slot(self, ln, ofs):
+        bisect.insort(self.free_lists.setdefault(ln.bit_length(), []),
+            (ln, ofs))
+        self.free_slots[ofs] = ln
+        self.free_ends[ofs + 2*self.int_size + ln] = ofs
+        self.free_bytes += ln
+        self.free_changes += 1
+
+    def _remove_free_slot(self, ln, ofs):
+        bucket = self.free_lists[ln.bit_length()]
+        del bucket[bisect.bisect_left(bucket, (ln, ofs))]
+        del self.free_slots[ofs]
+        del self.free_ends[ofs + 2*self.int_size + ln]
+        self.free_bytes -= ln
+        self.free_changes += 1
+
+    def add_free_slot(self, ln, ofs):
+        """
+        Mark a slot as free, merging it with any free neighbours.
+        """
+        self.load_free_map()
+        self._free_map_changed()
+        merged = False
+        nxt = ofs + 2*self.int_size + ln
+        if nxt in self.free_slots:
+            n_ln = self.free_slots[nxt]
+            self._remove_free_slot(n_ln, nxt)
+            ln += 2*self.int_size + n_ln
+            merged = True
+        prv = self.free_ends.get(ofs)
+        if prv is not None:
+            p_ln = self.free_slots[prv]
+            self._remove_free_slot(p_ln, prv)
+            ofs, ln = prv, ln + 2*self.int_size + p_ln
+            merged = True
+        if merged:
+            end = ofs + 2*self.int_size
+            self.safe_mmap(end)[ofs:end] = struct.pack('II', ofs, ln)
+        self._insert_free_slot(ln, ofs)
+
+    def take_free_slot(self, want_len, before=None):
+        """
+        Find the smallest free slot which can hold want_len bytes, and
+        remove it from the map. Large slots are split in two, returning
+        the unused tail to the map. If before is set, only slots starting
+        below that offset are considered. Returns (length, offset) or None.
+        """
+        self.load_free_map()
+        if not self.free_slots:
+            return None
+        for bucket in range(want_len.bit_length(), 33):
+            blist = self.free_lists.get(bucket)
+            if not blist:
+                continue
+            i = bisect.bisect_left(blist, (want_len, 0))
+            if before is not None:
+                while i < len(blist) and blist[i][1] >= before:
+                    i += 1
+            if i < len(blist):
+                ln, ofs = blist[i]
+                self._free_map_changed()
+                self._remove_free_slot(ln, ofs)
+                spare = ln - want_len - 2*self.int_size
+                if spare >= self.FREE_MIN_SPLIT:
+                    t_ofs = ofs + 2*self.int_size + want_len
+                    t_end = t_ofs + 2*self.int_size
+                    self.safe_mmap(t_end)[t_ofs:t_end] = struct.pack(
+                        'II', t_ofs, spare)
+                    self._insert_free_slot(spare, t_ofs)
+                    ln = want_len
+                return (ln, ofs)
+        return None
+
+    def _set_end_marker(self, file_size):
+        beg = self.int_size * self.chunk_records + len(self.prefix)
+        end = beg + self.int_size
+        self.safe_mmap(end)[beg:end] = struct.pack('I', file_size)
+
+    def _truncate_free_tail(self):
+        file_size = self.file_size()
+        ofs = self.free_ends.get(file_size)
+        if ofs is None:
+            return 0
+        self._free_map_changed()
+        self._remove_free_slot(self.free_slots[ofs], ofs)
+        self._set_end_marker(ofs)
+        self.mmap.close()
+        self.fd.truncate(ofs)
+        self.fd.seek(0, io.SEEK_END)
+        self.mmap = mmap(self.fd.fileno(), 0, access=ACCESS_WRITE)
+        return file_size - ofs
+
+    def compact_step(self, max_records=1000):
+        """
+        Incrementally compact the file in place: move up to max_records
+        live records from the end of the file into free slots nearer the
+        start, then truncate whatever free space is left at the end.
+
+        Returns a (records moved, bytes reclaimed) tuple; once no records
+        can be moved, there is nothing more to gain until the free space
+        map or the file changes, see compaction_stalled().
+        """
+        self.load_free_map()
+        offsets = numpy.array(self.offsets, dtype=numpy.int64)
+        tail = numpy.argsort(offsets)[::-1][:max_records]
+        moved = 0
+        freed = []
+        for idx in tail[offsets[tail] > 0].tolist():
+            ofs = self.offsets[idx]
+            rlen = self._slot_length(ofs)
+            slot = self.take_free_slot(rlen, before=ofs)
+            if slot is None:
+                continue
+
+            # Copy the record, padding it out to fill the new slot, then
+            # update the index. Old slots are only recycled at the end of
+            # the step, so nothing moved during this step can land on top
+            # of a record which was just moved out.
+            n_len, n_ofs = slot
+            beg = ofs + 2*self.int_size
+            data = self.safe_mmap(beg + rlen)[beg:beg + rlen]
+            n_end = n_ofs + 2*self.int_size + n_len
+            self.safe_mmap(n_end)[n_ofs:n_end] = (
+                struct.pack('II', n_ofs, n_len)
+                + (b' ' * (n_len - rlen)) + data)
+            beg = idx * self.int_size + len(self.prefix)
+            self.mmap[beg:beg + self.int_size] = struct.pack('I', n_ofs)
+            self.offsets[idx] = n_ofs
+            freed.append((rlen, ofs))
+            moved += 1
+
+        for rlen, ofs in freed:
+            self.add_free_slot(rlen, ofs)
+        reclaimed = self._truncate_free_tail()
+        self.compact_stalled = (
+            None if (moved or reclaimed) else self._compaction_state())
+        return (moved, reclaimed)
+
+    def _compaction_state(self):
+        return (self.free_changes, self.file_size())
+
+    def compaction_stalled(self):
+        """
+        True if the last compact_step() could not do anything, and
+        nothing has changed since which might let another step succeed.
+        """
+        return (self.compact_stalled is not None
+            and self.compact_stalled == self._compaction_state())
+
+    def free_space_stats(self):
+        self.load_free_map()
+        file_bytes = self.file_size()
+        data_bytes = max(1, file_bytes - self.header_size)
+        return {
+            'file_bytes': file_bytes,
+            'free_bytes': self.free_bytes,
+            'free_slots': len(self.free_slots),
+            'fragmentation': self.free_bytes / data_bytes}
+
     def make_aes_iv(self):
         # Notes:
         #  - The counter is mostly there to protect us from clock jumps.
@@ -229,17 +556,11 @@ class RecordFile:
         enc_len = len(encoded)
         moved = append = (ofs < 1) or (enc_len > cur_len)
         pad_len = min(16*1024, max(int(0.15 * enc_len), len(self.padding)))
-        if append:
-            if ofs > 0:
-                self.empties.append((cur_len, ofs))
-            target_len = enc_len + pad_len
-            for pair in self.empties:
-                _ln, _ofs = pair
-                if target_len <= _ln < enc_len*2:
-                    cur_len, ofs, append = _ln, _ofs, False
-                    break
-            if not append:
-                self.empties.remove(pair)
+        old_slot = (cur_len, ofs) if (moved and ofs > 0) else None
+        if append and encode:
+            slot = self.take_free_slot(enc_len + pad_len)
+            if slot is not None:
+                (cur_len, ofs), append = slot, False
 
         padding = b''
         if encode:
@@ -273,14 +594,16 @@ class RecordFile:
             end = beg + self.int_size
             self.mmap[beg:end] = struct.pack('I', ofs)
             self.offsets[idx] = ofs
+        if old_slot is not None:
+            # Only recycle the old slot once nothing refers to it
+            self.add_free_slot(*old_slot)
         if append:
             # Record how long the chunk file should be; if this does not
             # match we know we died mid-operation and may be corrupt.
-            beg = self.int_size * self.chunk_records + len(self.prefix)
-            end = beg + self.int_size
-            self.mmap[beg:end] = struct.pack('I', self.fd.tell())
+            self._set_end_marker(self.fd.tell())
 
     def close(self):
+        self.save_free_map()
         self.mmap.close()
         self.mmap = None
         self.fd.close()
@@ -343,6 +666,9 @@ class RecordFile:
             self._rotate(target, backup)
         self._rotate(tempfile, target)
         compacted.path = target
+        compacted.free_path = target + '.free'
+        compacted.free_saved = True
+        compacted._free_map_changed()
         if backup:
             os.remove(backup)
 
@@ -350,6 +676,8 @@ class RecordFile:
 
 
 class RecordStoreReadOnly:
+    DEFAULT_CACHE_BYTES = 16 * 1024 * 1024
+
     def __init__(self, workdir, store_id,
             salt=None,
             compress=None,
@@ -359,7 +687,8 @@ class RecordStoreReadOnly:
             est_rec_size=1024,
             target_file_size=50*1024*1024,
             encoding_kwargs=None,
-            decoding_kwargs=None):
+            decoding_kwargs=None,
+            cache_bytes=None):
 
         first_aes_key = aes_keys[0] if aes_keys else None
 
@@ -411,9 +740,8 @@ class RecordStoreReadOnly:
                 self.keys_fn, read_prefix, self.prefix))
         self.keys = {}
         self.load_keys()
-        self.cache = {}
-        self.cache_hits = 0
-        self.cache_misses = 0
+        self.cache = RecordCache(self.DEFAULT_CACHE_BYTES
+            if (cache_bytes is None) else cache_bytes)
         self.loaded = self.getmtime()
         self.loaded = os.path.getmtime(self.keys_fn)
         self.keys_fd.seek(0, io.SEEK_END)
@@ -442,26 +770,59 @@ class RecordStoreReadOnly:
             for chunk in self.chunks:
                 self.chunks[chunk].close()
             self.chunks = {}
+            self.cache.clear()
             self.keys = {}
             self.load_keys()
             self.next_idx = self.calculate_next_idx()
             self.loaded = modified
         return self
 
+    def keys_dtype(self):
+        return numpy.dtype([('idx', '=u4'), ('hash', 'V%d' % self.hash_size)])
+
     def load_keys(self):
+        """
+        Load the keys file into self.keys, mapping key hashes to
+        (file position, record index) pairs.
+
+        The file is parsed as a numpy structured array, so the only
+        per-key Python work left is building the dict itself.
+        """
+        dtype = self.keys_dtype()
         beg = len(self.prefix)
-        rec_size = (self.hash_size + self.int_size)
-        with mmap(self.keys_fd.fileno(), 0, access=ACCESS_READ) as m:
-            for slot in range(0, (len(m)-len(self.prefix)) // rec_size):
-                eoi = beg + self.int_size
-                end = beg + rec_size
-                idx = struct.unpack('I', m[beg:eoi])[0]
-                key = bytes(m[eoi:end])
-                self.keys[key] = (beg, idx)
-                beg = end
+        gc_was_enabled = gc.isenabled()
+        gc.disable()  # Millions of tuples make the GC very busy
+        try:
+            with mmap(self.keys_fd.fileno(), 0, access=ACCESS_READ) as m:
+                slots = (len(m) - beg) // dtype.itemsize
+                recs = numpy.frombuffer(m, dtype=dtype, offset=beg, count=slots)
+                hashes = recs['hash'].tolist()
+                idxs = recs['idx'].tolist()
+                del recs
+            positions = range(beg, beg + slots * dtype.itemsize, dtype.itemsize)
+            self.keys.update(zip(hashes, zip(positions, idxs)))
+        finally:
+            if gc_was_enabled:
+                gc.enable()
         if self.hash_zero in self.keys:
             del self.keys[self.hash_zero]
 
+        # The reverse index is built on demand, by the first deletion
+        self._idx_keys = None
+
+    def _get_idx_keys(self):
+        if self._idx_keys is None:
+            idx_keys = self._idx_keys = {}
+            for key, (beg, idx) in self.keys.items():
+                if idx in idx_keys:
+                    idx_keys[idx].add(key)
+                else:
+                    idx_keys[idx] = set([key])
+        return self._idx_keys
+
+    # Reverse index (idx -> key hashes), so deletions need not scan every key
+    idx_keys = property(_get_idx_keys)
+
     def __len__(self):
         return self.next_idx
 
@@ -517,31 +878,38 @@ class RecordStoreReadOnly:
         return chunk.length(idx)
 
     def __getitem__(self, key):
-        pair = (idx, chunk) = self.get_chunk(self.key_to_index(key))
-        if pair in self.cache:
-            self.cache_hits += 1
-            return self.cache[pair]
-        self.cache_misses += 1
+        full_idx = self.key_to_index(key)
+        rv = self.cache.get(full_idx, self.cache)
+        if rv is not self.cache:
+            return rv
+        (idx, chunk) = self.get_chunk(full_idx)
         return chunk[idx]
 
     def get(self, key, decode=True, default=None, aes_key=None, cache=None):
         try:
-            pair = (idx, chunk) = self.get_chunk(self.key_to_index(key))
-            if decode and (cache is not False) and pair in self.cache:
-                self.cache_hits += 1
-                return self.cache[pair]
+            full_idx = self.key_to_index(key)
+            if decode and (cache is not False):
+                rv = self.cache.get(full_idx, self.cache)
+                if rv is not self.cache:
+                    return rv
 
-            self.cache_misses += 1
+            (idx, chunk) = self.get_chunk(full_idx)
             rv = chunk.get(idx,
                 default=default, decode=decode, aes_key=aes_key)
             if cache and decode and (rv != default):
-                self.cache[pair] = rv
+                self.cache.set(full_idx, rv, chunk.length(idx))
             return rv
         except KeyError:
             return default
 
+    def cache_stats(self):
+        return self.cache.stats()
+
 
 class RecordStore(RecordStoreReadOnly):
+    COMPACT_GARBAGE_RATIO = 0.25
+    COMPACT_STEP_RECORDS = 1000
+
     # FIXME: We should probably lock the file, there should only be one
     #        writer. Advisory locks are fine.
     def refresh(self):
@@ -551,7 +919,7 @@ class RecordStore(RecordStoreReadOnly):
         for c in self.chunks:
             self.chunks[c].close()
         self.chunks = {}
-        self.cache = {}
+        self.cache.clear()
 
     def close(self):
         self.flush()
@@ -561,6 +929,7 @@ class RecordStore(RecordStoreReadOnly):
         assert(c1 and not c2 and c3)
         self.keys_fd.close()
         del self.keys
+        self._idx_keys = None
         for c in self.chunks:
             self.chunks[c].close()
         del self.chunks
@@ -569,38 +938,72 @@ class RecordStore(RecordStoreReadOnly):
                 os.remove(os.path.join(self.workdir, f))
 
     def __delitem__(self, key):
-        pair = (idx, chunk) = self.get_chunk(self.key_to_index(key))
-        del chunk[idx]
-        if pair in self.cache:
-            del self.cache[pair]
-        to_delete = [
-            (k, self.keys[k][0]) for k in self.keys if self.keys[k][1] == idx]
+        self.del_items([key])
+
+    def del_items(self, keys):
+        """
+        Delete multiple records, and all the keys pointing at them. The
+        keys file is updated with as few writes as possible.
+        """
+        positions = []
+        for key in keys:
+            full_idx = self.key_to_index(key)
+            (idx, chunk) = self.get_chunk(full_idx)
+            del chunk[idx]
+            self.cache.discard(full_idx)
+            for kh in self.idx_keys.pop(full_idx, []):
+                positions.append(self.keys.pop(kh)[0])
+        self._zero_key_slots(positions)
+
+    def _zero_key_slots(self, positions):
+        rec_size = self.int_size + self.hash_size
+        zero = struct.pack('I', 0) + self.hash_zero
+        positions.sort()
         try:
-            zero = struct.pack('I', 0) + self.hash_zero
-            for kh, beg in to_delete:
-                self.keys_fd.seek(beg, 0)
-                self.keys_fd.write(zero)
-                del self.keys[kh]
+            i = 0
+            while i < len(positions):
+                j = i + 1
+                while (j < len(positions)
+                        and positions[j] == positions[j-1] + rec_size):
+                    j += 1
+                self.keys_fd.seek(positions[i], 0)
+                self.keys_fd.write(zero * (j - i))
+                i = j
         finally:
             self.keys_fd.seek(0, io.SEEK_END)
 
+    def _forget_key(self, hashed_key):
+        beg, idx = self.keys.pop(hashed_key)
+        if self._idx_keys is not None:
+            idx_keys = self._idx_keys.get(idx)
+            if idx_keys is not None:
+                idx_keys.discard(hashed_key)
+                if not idx_keys:
+                    del self._idx_keys[idx]
+        return beg
+
     def del_key(self, key):
-        hashed_key = self.hash_key(key)
-        try:
+        self.del_keys([key])
+
+    def del_keys(self, keys):
+        positions = []
+        for key in keys:
+            hashed_key = self.hash_key(key)
             if hashed_key in self.keys:
-                beg = self.keys[hashed_key][0]
-                self.keys_fd.seek(beg, 0)
-                self.keys_fd.write(struct.pack('I', 0) + self.hash_zero)
-                del self.keys[hashed_key]
-        finally:
-            self.keys_fd.seek(0, io.SEEK_END)
+                positions.append(self._forget_key(hashed_key))
+        self._zero_key_slots(positions)
 
     def set_key(self, key, idx):
         hashed_key = self.hash_key(key)
         try:
             if hashed_key in self.keys:
-                self.keys_fd.seek(self.keys[hashed_key][0], 0)
+                self.keys_fd.seek(self._forget_key(hashed_key), 0)
             self.keys[hashed_key] = (self.keys_fd.tell(), idx)
+            if self._idx_keys is not None:
+                if idx in self._idx_keys:
+                    self._idx_keys[idx].add(hashed_key)
+                else:
+                    self._idx_keys[idx] = set([hashed_key])
             output = struct.pack('I', idx) + hashed_key
             self.keys_fd.write(output)
         finally:
@@ -609,6 +1012,15 @@ class RecordStore(RecordStoreReadOnly):
     def __setitem__(self, key, value):
         self.set(key, value)
 
+    def _cache_update(self, full_idx, c_idx, chunk, value, encode, cache):
+        # Writes only ever refresh the entry we were asked to cache;
+        # anything else is invalidated, since callers may go on to
+        # mutate the value they just stored.
+        if encode and cache:
+            self.cache.set(full_idx, value, chunk.length(c_idx))
+        else:
+            self.cache.discard(full_idx)
+
     def set(self, keys, value,
             encode=True, encrypt=True, aes_key=None, cache=False):
         keys = keys if isinstance(keys, list) else [keys]
@@ -617,11 +1029,10 @@ class RecordStore(RecordStoreReadOnly):
                 raise ValueError('Int keys must be first')
         try:
             full_idx = self.key_to_index(keys[0])
-            pair = (c_idx, chunk) = self.get_chunk(full_idx, create=self.sparse)
+            (c_idx, chunk) = self.get_chunk(full_idx, create=self.sparse)
             chunk.set(c_idx, value,
                 encode=encode, encrypt=encrypt, aes_key=aes_key)
-            if encode and (cache or pair in self.cache):
-                self.cache[pair] = value
+            self._cache_update(full_idx, c_idx, chunk, value, encode, cache)
             for key in keys[1:]:
                 self.set_key(key, full_idx)
             if full_idx >= self.next_idx:
@@ -642,10 +1053,9 @@ class RecordStore(RecordStoreReadOnly):
                     raise KeyError('Keys must not be ints')
 
         full_idx = len(self)
-        pair = (c_idx, chunk) = self.get_chunk(full_idx, create=True)
+        (c_idx, chunk) = self.get_chunk(full_idx, create=True)
         chunk.set(c_idx, value, encode=encode, encrypt=encrypt, aes_key=aes_key)
-        if encode and (cache or pair in self.cache):
-            self.cache[pair] = value
+        self._cache_update(full_idx, c_idx, chunk, value, encode, cache)
         if full_idx >= self.next_idx:
             self.next_idx = full_idx + 1
 
@@ -655,6 +1065,67 @@ class RecordStore(RecordStoreReadOnly):
 
         return full_idx
 
+    def free_space_stats(self):
+        totals = {'file_bytes': 0, 'free_bytes': 0, 'free_slots': 0}
+        chunks = {}
+        for c_idx in range(0, self.next_idx, self.chunk_records):
+            (_, chunk_obj) = self.get_chunk(c_idx)
+            chunks[c_idx // self.chunk_records] = stats = (
+                chunk_obj.free_space_stats())
+            for k in totals:
+                totals[k] += stats[k]
+        totals['fragmentation'] = (
+            totals['free_bytes'] / max(1, totals['file_bytes']))
+        totals['chunks'] = chunks
+        return totals
+
+    def compaction_candidates(self, ratio=None):
+        """
+        Return the list of open chunks where the measured garbage exceeds
+        the given ratio (or COMPACT_GARBAGE_RATIO). Chunks we have not
+        written to have not been measured, and are ignored, as are chunks
+        where compaction has stalled.
+        """
+        if ratio is None:
+            ratio = self.COMPACT_GARBAGE_RATIO
+        return sorted(c for c, chunk_obj in self.chunks.items()
+            if (chunk_obj.free_slots is not None)
+            and not chunk_obj.compaction_stalled()
+            and (chunk_obj.free_space_stats()['fragmentation'] > ratio))
+
+    def compact_incrementally(self, chunks=None, max_records=None, ratio=None):
+        """
+        Compact chunks in place, a bounded number of records at a time.
+
+        This is a generator which yields a progress report after every
+        step, so the caller can release any locks between steps and let
+        other reads and writes proceed.
+        """
+        if chunks is None:
+            chunks = self.compaction_candidates(ratio)
+        max_records = max_records or self.COMPACT_STEP_RECORDS
+        done = []
+        progress = {
+            'compacting': None,
+            'done': done,
+            'total': len(chunks),
+            'incremental': True,
+            'moved': 0,
+            'reclaimed': 0}
+        for chunk_idx in chunks:
+            progress['compacting'] = chunk_idx
+            moved = True
+            while moved:
+                (_, chunk_obj) = self.get_chunk(chunk_idx * self.chunk_records)
+                moved, reclaimed = chunk_obj.compact_step(max_records)
+                progress['moved'] += moved
+                progress['reclaimed'] += reclaimed
+                yield progress
+            done.append(chunk_idx)
+
+        del progress['compacting']
+        yield progress
+
     def compact(self, new_aes_key=False, force=False, partial=False):
         last_chunk_idx = self.next_idx // self.chunk_records
         done = []
@@ -722,6 +1193,62 @@ if __name__ == "__main__":
     rf = rf.compact(new_aes_key=None, padding=0, force=True)
     assert(time.time() - rf.compacted_time() < 1)
 
+    rf.close()
+    rf = RecordFile('/tmp/rs-test/testing-free', 'test', 128, create=True)
+    rnd = lambda n: str(binascii.hexlify(os.urandom(n // 2)), 'latin-1')
+    vals = dict((i, rnd(100 + i)) for i in range(0, 100))
+    for i in range(0, 100):
+        rf[i] = vals[i]
+    size = rf.file_size()
+    assert(rf.free_space_stats()['free_bytes'] == 0)
+    for i in (10, 11, 12):
+        del rf[i]
+    stats = rf.free_space_stats()
+    assert(stats['free_slots'] == 1)  # Neighbours got merged
+    assert(stats['free_bytes'] > 3 * 110)
+    rf[50] = vals[50] = rnd(1000)  # Moves to the end, leaving a hole
+    grown = rf.file_size()
+    assert(rf.free_space_stats()['free_slots'] == 2)
+    rf[20] = vals[20] = rnd(300)  # Takes a slice of the merged hole
+    assert(rf.file_size() == grown)
+    assert(rf.free_space_stats()['free_slots'] == 3)
+    for i in (10, 11, 12):
+        rf[i] = vals[i] = rnd(50)
+    assert(rf.file_size() == grown)
+    assert(rf.free_space_stats()['free_bytes'] < stats['free_bytes'])
+    free_slots = dict(rf.free_slots)
+    rf.close()
+    assert(os.path.exists(rf.free_path))
+    rf = RecordFile('/tmp/rs-test/testing-free', 'test', 128)
+    rf.load_free_map()
+    assert(rf.free_slots == free_slots)
+    assert(rf.free_saved)
+    os.remove(rf.free_path)
+    rf.free_slots = None
+    rf.load_free_map()
+    assert(rf.free_slots == free_slots)
+    assert(all(rf[i] == vals[i] for i in range(0, 100)))
+    for i in [50] + list(range(60, 100, 3)):
+        del rf[i]
+        del vals[i]
+    size = rf.file_size()
+    moved, reclaimed = rf.compact_step(max_records=5)
+    assert(0 < moved <= 5)
+    while moved:
+        moved, r = rf.compact_step(max_records=5)
+        reclaimed += r
+    assert(reclaimed > 0 and rf.file_size() == size - reclaimed)
+    assert(all(rf[i] == vals[i] for i in vals))
+    rf.close()
+    rf = RecordFile('/tmp/rs-test/testing-free', 'test', 128)
+    assert(all(rf[i] == vals[i] for i in vals))
+    rf = rf.compact(force=True)
+    assert(rf.free_space_stats()['free_bytes'] == 0)
+    assert(all(rf[i] == vals[i] for i in vals))
+    rf.close()
+    os.remove('/tmp/rs-test/testing-free')
+    rf = RecordFile('/tmp/rs-test/testing', 'test', 128)
+
     assert(rs.hash_size == 32)
     assert(rs.chunk_records == (1000 * (10*1024*1024 // 1024000)))
     assert(len(rs.hash_key('hello')) == rs.hash_size)
@@ -774,6 +1301,77 @@ if __name__ == "__main__":
     except ConfigMismatch:
         pass
 
+    rc = RecordCache(3 * (RecordCache.OVERHEAD + 10))
+    for i in range(0, 4):
+        rc.set(i, 'v%d' % i, 10)
+    assert(0 not in rc and len(rc) == 3 and rc.evictions == 1)
+    assert(rc.get(1) == 'v1')
+    rc.set(4, 'v4', 10)
+    assert(2 not in rc and 1 in rc)
+    rc.set(5, 'too big', rc.max_bytes)
+    assert(5 not in rc and len(rc) == 3)
+    rc.discard(1)
+    assert(rc.bytes == 2 * (RecordCache.OVERHEAD + 10))
+    assert(rc.get(1) is None)
+    stats = rc.stats()
+    assert(stats['record_cache_hits'] == 1)
+    assert(stats['record_cache_misses'] == 1)
+    assert(stats['record_cache_evictions'] == 2)
+
+    rs.get('hello', cache=True)
+    assert(rs.key_to_index('hello') in rs.cache)
+    rs['hello'] = 'again'
+    assert(rs.key_to_index('hello') not in rs.cache)
+    assert(rs.get('hello', cache=True) == 'again')
+    del rs['hello']
+    assert(rs.get('hello') is None)
+    assert(len(rs.cache) == 0)
+
+    rs.set(['k1', 'k2'], 'multi')
+    rs.set(['k3'], 'other')
+    k1_idx = rs.key_to_index('k1')
+    assert(rs.idx_keys[k1_idx] == set([rs.hash_key('k1'), rs.hash_key('k2')]))
+    rs.set_key('k2', rs.key_to_index('k3'))
+    assert(rs.idx_keys[k1_idx] == set([rs.hash_key('k1')]))
+    rs.del_items(['k1', 'k3'])
+    assert('k1' not in rs and 'k2' not in rs and 'k3' not in rs)
+    assert(k1_idx not in rs.idx_keys)
+    rs.set(['k4', 'k5'], 'bulk')
+    rs.del_keys(['k4', 'k5'])
+    assert(not rs.idx_keys.get(rs.next_idx - 1))
+    rs.flush()
+    rs.keys = {}
+    rs.load_keys()
+    assert(rs.key_to_index('he') in rs.idx_keys)
+    assert('k2' not in rs and 'k4' not in rs)
+
+    for i in range(0, 200):
+        rs.append('%d' % i * 20, keys=('compact-%d' % i))
+    rs.del_items(['compact-%d' % i for i in range(0, 160)])
+    assert(rs.compaction_candidates() == [0])
+    for progress in rs.compact_incrementally(max_records=10):
+        pass
+    assert(progress['done'] == [0] and progress['reclaimed'] > 0)
+    assert(rs.compaction_candidates() == [])
+    assert(all(rs['compact-%d' % i] == ('%d' % i * 20)
+               for i in range(160, 200)))
+
+    # If the records at the end will not fit in any of the holes, a
+    # compaction pass makes no progress; don't retry until things change.
+    for i in range(0, 60):
+        rs.append(os.urandom(500).hex(), keys=('small-%d' % i))
+        rs.append('keep', keys=('keep-%d' % i))
+    for i in range(0, 10):
+        rs.append(os.urandom(1000).hex(), keys=('large-%d' % i))
+    rs.del_items(['small-%d' % i for i in range(0, 60)])
+    assert(rs.compaction_candidates() == [0])
+    for progress in rs.compact_incrementally(max_records=5):
+        pass
+    assert(progress['moved'] == 0)
+    assert(rs.compaction_candidates() == [])
+    rs.del_items(['large-%d' % i for i in range(0, 9)])
+    assert(rs.compaction_candidates() == [0])
+
     print('Tests passed OK, starting load test')
     rs.close()
     rs2.close()
@@ -818,7 +1416,14 @@ if __name__ == "__main__":
             except KeyError:
                 pass
         t4 = time.time()
-        assert(rs.cache_hits > 0)
+        rs.del_items(['%d' % i for i in range(0, load, 2)])
+        t5 = time.time()
+        keys = rs.keys
+        rs.keys = {}
+        rs.load_keys()
+        t6 = time.time()
+        assert(keys == rs.keys)
+        assert(rs.cache.hits > 0)
 
         if True:
             rs.delete_everything(True, False, True)
@@ -828,5 +1433,7 @@ if __name__ == "__main__":
             os.rmdir('/tmp/rs-test')
 
         print(('%s: '
-              '%d appends/upd/key-reads/reads in %.2f/%.2f/%.2f/%.2f secs'
-            ) % (description, load, t1-t0, t2-t1, t3-t2, t4-t3))
+              '%d appends/upd/key-reads/reads/%d dels/load_keys in '
+              '%.2f/%.2f/%.2f/%.2f/%.2f/%.3f secs'
+            ) % (description, load, load//2,
+                 t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5))
@@ -21,6 +21,10 @@
 # but we'll use JSON any time we expect to expose our data to the outside
 # word.
 #
+# The to_msgpack and from_msgpack methods are a binary alternative to JSON,
+# used between our own processes. They produce the same results as JSON,
+# but embed dumb_encode_bin() output (no base64) for moggie-specific things.
+#
 import binascii
 import json
 import logging
@@ -37,6 +41,8 @@ from ..crypto.aes_utils import aes_ctr_encrypt, aes_ctr_decrypt, make_aes_key
 
 DUMB_DECODERS = {}
 
+MSGPACK_EXT_DUMB = 76
+
 
 def zlib_compress(data):
     return zlib.compress(data, level=1)
@@ -308,15 +314,120 @@ def from_json(data, dumb_decode=True):
         return json.loads(data)
 
 
-def register_dumb_decoder(char, func):
+def _msgpack_default(obj):
+    try:
+        return msgpack.ExtType(MSGPACK_EXT_DUMB, dumb_encode_bin(obj))
+    except ValueError:
+        if hasattr(obj, '__iter__'):
+            return list(obj)
+    raise TypeError('Cannot msgpack serialize %s' % obj.__class__.__name__)
+
+
+def _msgpack_ext_hook(code, data):
+    if code == MSGPACK_EXT_DUMB:
+        return dumb_decode(data)
+    return msgpack.ExtType(code, data)
+
+
+def _json_keys(obj):
+    # JSON only has string keys, convert the others the same way it would,
+    # so both encodings give the same results.
+    if isinstance(obj, dict):
+        return dict(
+            (k if isinstance(k, str) else json.dumps(k), _json_keys(v))
+            for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [_json_keys(v) for v in obj]
+    return obj
+
+
+def to_msgpack(data, json_keys=True):
+    return msgpack.packb(_json_keys(data) if json_keys else data,
+        use_bin_type=True, default=_msgpack_default)
+
+
+def from_msgpack(data):
+    return msgpack.unpackb(data,
+        raw=False, strict_map_key=False, ext_hook=_msgpack_ext_hook)
+
+
+def register_dumb_decoder(char, func, both_cases=True):
     global DUMB_DECODERS
-    for ch in (char.upper(), char.lower()):
+    for ch in ((char.upper(), char.lower()) if both_cases else (char,)):
         DUMB_DECODERS[ch] = func
         DUMB_DECODERS[bytes(ch, 'latin-1')] = func
 
 
 if __name__ == '__main__':
-    print('FIXME: Create a encode/decode CLI tool?')
+    import random
+    import sys
+    import time
+    from . import dumbcode
+    from ..email.metadata import Metadata
+    from ..util.intset import IntSet
+
+    # Decoders get registered with the package module, not __main__
+    DUMB_DECODERS.update(dumbcode.DUMB_DECODERS)
+
+    if 'benchmark' not in sys.argv[1:]:
+        print('Usage: python3 -m moggie.util.dumbcode benchmark')
+    else:
+        # Compare bytes-on-wire and encode/decode time for typical RPC
+        # traffic, JSON+ASCII vs. msgpack+binary.
+        rnd = random.Random(0)
+        hits = IntSet(rnd.sample(range(0, 500000), 50000))
+        tags = dict(('in:tag%d' % i, IntSet(rnd.sample(list(hits), 2000)))
+            for i in range(0, 20))
+        hdrs = ('From: Someone <someone@example.org>\nTo: bre@example.org\n'
+            'Subject: This is a typical subject line\n'
+            'Message-Id: <abcdefghijklmnop@example.org>\n'
+            'Date: Mon, 01 Jan 2024 12:00:00 +0000\n')
+        mds = [Metadata(1700000000 + i, i,
+                [Metadata.PTR(0, b'/home/bre/Mail/inbox.mbx', 2000 + i)],
+                hdrs, i, i, {'tags': ['inbox', 'read'], 'thread': [i, i+1]})
+            for i in range(0, 100)]
+
+        search_asc = {'hits': dumb_encode_asc(hits, compress=256),
+            'tags': dict((t, ({}, dumb_encode_asc(s, compress=128)))
+                for t, s in tags.items())}
+        search_bin = {'hits': dumb_encode_bin(hits, compress=256),
+            'tags': dict((t, ({}, dumb_encode_bin(s, compress=128)))
+                for t, s in tags.items())}
+        md_args_asc = [None, hits, search_asc['tags'], 0, 0, 50]
+        md_args_bin = [None, hits, search_bin['tags'], 0, 0, 50]
+        metadata = {'skip': 0, 'limit': 100, 'total': 100, 'metadata': mds}
+
+        def _json_reply(data):
+            return from_json(to_json(data).encode('utf-8'))
+        def _msgpack_reply(data):
+            return from_msgpack(to_msgpack(data))
+        def _url_args(args):
+            enc = '/'.join(dumb_encode_asc(a) for a in args).encode('latin-1')
+            return [dumb_decode(a) for a in enc.split(b'/')], enc
+        def _msgpack_args(args):
+            enc = to_msgpack(args, json_keys=False)
+            return from_msgpack(enc), enc
+
+        for desc, func, data, size in (
+                ('search reply, JSON', _json_reply, search_asc,
+                     lambda d: len(to_json(d))),
+                ('search reply, msgpack', _msgpack_reply, search_bin,
+                     lambda d: len(to_msgpack(d))),
+                ('metadata args, URL', _url_args, md_args_asc,
+                     lambda d: len(_url_args(d)[1])),
+                ('metadata args, msgpack', _msgpack_args, md_args_bin,
+                     lambda d: len(_msgpack_args(d)[1])),
+                ('metadata reply, JSON', _json_reply, metadata,
+                     lambda d: len(to_json(d))),
+                ('metadata reply, msgpack', _msgpack_reply, metadata,
+                     lambda d: len(to_msgpack(d)))):
+            count, t0 = 200, time.time()
+            for i in range(0, count):
+                func(data)
+            t1 = time.time()
+            print('%-24s %8d bytes %8.3fms' % (
+                desc, size(data), 1000 * (t1 - t0) / count))
+
     if False:
         import time
         from ..storage.metadata import METADATA_ZDICT
@@ -333,4 +444,3 @@ if __name__ == '__main__':
         t2 = time.time()
         print('%2.2fs %d bytes vs. %2.2fs %d bytes'
             % (t2-t1, c1, t1-t0, c0))
-        print('Tests passed OK')
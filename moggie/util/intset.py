@@ -7,11 +7,30 @@ from base64 import urlsafe_b64decode as us_b64decode
 from .dumbcode import register_dumb_decoder
 
 
+if hasattr(numpy, 'bitwise_count'):
+    _popcount = lambda npa: int(numpy.bitwise_count(npa).sum())
+else:
+    _popcount = lambda npa: int(numpy.unpackbits(npa.view(numpy.uint8)).sum())
+
+
 class IntSet:
     ENC_BIN = b'i'
     ENC_ASC = 'I'
 
-    BIN_VERSION = b'\x01'
+    # Version 1 is a (zero-stripped) raw bitmap, version 2 splits the set
+    # into containers of CONTAINER_BITS values each, which are encoded as
+    # sorted arrays of 16-bit offsets, lists of runs or raw bitmaps;
+    # whichever is smallest. We can read both, but only write version 1
+    # when asked for an unstripped dump.
+    BIN_VERSION = b'\x02'
+    BIN_VERSION_BITMAP = b'\x01'
+    BIN_VERSION_CONTAINERS = b'\x02'
+
+    CONTAINER_BITS = 65536
+    CONTAINER_HEADER = '<IBH'
+    C_ARRAY = 0x61   # a
+    C_RUNS = 0x72    # r
+    C_BITMAP = 0x62  # b
 
     # We could change these to match the CPU we are running on, but
     # doing so would make our data files non-portable. File portability
@@ -43,7 +62,7 @@ class IntSet:
                 self |= copy
 
         elif binary is not None:
-            self.frombinary(binary)
+            self.frombytes(binary)
 
         elif init:
             self.npa = numpy.zeros(init or 1, dtype=self.dtype)
@@ -77,17 +96,43 @@ class IntSet:
             result = cls(clone=sets[0])
         else:
             result = cls(copy=sets[0])
+        scratch = None
         for s in sets[1:]:
-            result -= s
+            if not result:
+                break
+            if isinstance(s, IntSet):
+                # Invert into a single scratch buffer, instead of allocating
+                # a new inverted array for every set we subtract.
+                if scratch is None:
+                    scratch = numpy.empty(len(result.npa), dtype=result.dtype)
+                maxlen = min(len(result.npa), len(s.npa))
+                numpy.invert(s.npa[:maxlen], out=scratch[:maxlen])
+                result.npa[:maxlen] &= scratch[:maxlen]
+            else:
+                result -= s
         return result
 
     @classmethod
     def And(cls, *sets, clone=False):
         if clone:
             result = cls(clone=sets[0])
+        elif (len(sets) > 1
+                and isinstance(sets[0], IntSet)
+                and isinstance(sets[1], IntSet)):
+            # AND the first two sets straight into a new buffer, instead of
+            # copying the first and then modifying the copy.
+            maxlen = min(len(sets[0].npa), len(sets[1].npa))
+            result = cls(init=None, bits=sets[0].bits, dtype=sets[0].dtype)
+            result.npa = numpy.zeros(max(1, maxlen), dtype=result.dtype)
+            numpy.bitwise_and(
+                sets[0].npa[:maxlen], sets[1].npa[:maxlen],
+                out=result.npa[:maxlen])
+            sets = sets[1:]
         else:
             result = cls(copy=sets[0])
         for s in sets[1:]:
+            if not result:
+                break
             result &= s
         return result
 
@@ -95,9 +140,15 @@ class IntSet:
     def Or(cls, *sets, clone=False):
         if clone:
             result = cls(clone=sets[0])
+            sets = sets[1:]
         else:
-            result = cls(copy=sets[0])
-        for s in sets[1:]:
+            # Start with a copy of the largest set, so we never need to grow
+            # (copy) the buffer as we go.
+            largest = max(range(0, len(sets)), key=lambda i: (
+                len(sets[i].npa) if isinstance(sets[i], IntSet) else -1))
+            result = cls(copy=sets[largest])
+            sets = sets[:largest] + sets[largest+1:]
+        for s in sets:
             result |= s
         return result
 
@@ -154,6 +205,11 @@ class IntSet:
         return self.ENC_ASC + str(us_b64encode(self.tobytes()), 'latin-1')
 
     def frombytes(self, binary):
+        if binary[:1] == self.BIN_VERSION_CONTAINERS:
+            return self._frombytes_containers(binary)
+        elif binary[:1] != self.BIN_VERSION_BITMAP:
+            raise ValueError('Unsupported IntSet version')
+
         stripped = struct.unpack('<I', binary[1:5])[0]
         binary = (b'\x00' * stripped) + binary[5:]
         if len(binary) % 64:
@@ -161,16 +217,97 @@ class IntSet:
         self.npa = numpy.copy(numpy.frombuffer(binary, dtype=self.dtype))
         return self
 
+    def _frombytes_containers(self, binary):
+        c_words = self.CONTAINER_BITS // self.bits
+        c_bytes = self.CONTAINER_BITS // 8
+        hdr_size = struct.calcsize(self.CONTAINER_HEADER)
+
+        count = struct.unpack('<I', binary[1:5])[0]
+        containers = []
+        beg = 5
+        for i in range(0, count):
+            key, ctype, n = struct.unpack(
+                self.CONTAINER_HEADER, binary[beg:beg+hdr_size])
+            beg += hdr_size
+            if ctype == self.C_ARRAY:
+                end = beg + 2*n
+                bits = numpy.zeros(self.CONTAINER_BITS, dtype=bool)
+                bits[numpy.frombuffer(binary[beg:end], dtype='<u2')] = True
+                words = numpy.packbits(bits, bitorder='little')
+            elif ctype == self.C_RUNS:
+                end = beg + 4*n
+                bits = numpy.zeros(self.CONTAINER_BITS, dtype=bool)
+                runs = numpy.frombuffer(binary[beg:end], dtype='<u2')
+                for j in range(0, len(runs), 2):
+                    start = int(runs[j])
+                    bits[start:start + int(runs[j+1]) + 1] = True
+                words = numpy.packbits(bits, bitorder='little')
+            elif ctype == self.C_BITMAP:
+                end = beg + c_bytes
+                words = binary[beg:end]
+            else:
+                raise ValueError('Invalid IntSet container')
+            containers.append((key, numpy.frombuffer(words, dtype=self.dtype)))
+            beg = end
+
+        # Only allocate as much space as the highest set bit requires,
+        # rounded up to 64 bytes like the version 1 decoder does.
+        size = 0
+        if containers:
+            key, words = containers[-1]
+            used = numpy.flatnonzero(words)
+            if len(used):
+                size = key * c_words + int(used[-1]) + 1
+        size += (-size) % (512 // self.bits)
+
+        self.npa = numpy.zeros(size or 1, dtype=self.dtype)
+        for key, words in containers:
+            ofs = key * c_words
+            words = words[:max(0, size - ofs)]
+            self.npa[ofs:ofs+len(words)] = words
+        return self
+
     def tobytes(self, strip=True):
-        binary = self.npa.tobytes()
         if strip:
-            binary = binary.rstrip(b'\x00')
-            full_size = len(binary)
-            binary = binary.lstrip(b'\x00')
-            stripped = full_size - len(binary)
-        else:
-            stripped = 0
-        return self.BIN_VERSION + struct.pack('<I', stripped) + binary
+            return self._tobytes_containers()
+        return (self.BIN_VERSION_BITMAP
+            + struct.pack('<I', 0)
+            + self.npa.tobytes())
+
+    def _tobytes_containers(self):
+        c_words = self.CONTAINER_BITS // self.bits
+        c_bytes = self.CONTAINER_BITS // 8
+
+        chunks = []
+        used = numpy.flatnonzero(self.npa)
+        for key in numpy.unique(used // c_words):
+            key = int(key)
+            words = self.npa[key*c_words:(key+1)*c_words]
+            bits = numpy.unpackbits(words.view(numpy.uint8), bitorder='little')
+
+            offsets = numpy.flatnonzero(bits)
+            edges = numpy.diff(bits.astype(numpy.int8), prepend=0, append=0)
+            starts = numpy.flatnonzero(edges == 1)
+            if 2*len(offsets) <= min(4*len(starts), c_bytes):
+                ctype, n = self.C_ARRAY, len(offsets)
+                payload = offsets.astype('<u2').tobytes()
+            elif 4*len(starts) < c_bytes:
+                ctype, n = self.C_RUNS, len(starts)
+                runs = numpy.empty(2*n, dtype='<u2')
+                runs[0::2] = starts
+                runs[1::2] = numpy.flatnonzero(edges == -1) - starts - 1
+                payload = runs.tobytes()
+            else:
+                ctype, n = self.C_BITMAP, 0
+                payload = words.tobytes()
+                payload += b'\x00' * (c_bytes - len(payload))
+
+            chunks.append(struct.pack(self.CONTAINER_HEADER, key, ctype, n))
+            chunks.append(payload)
+
+        return b''.join([
+            self.BIN_VERSION_CONTAINERS,
+            struct.pack('<I', len(chunks) // 2)] + chunks)
 
     def __len__(self):
         # Estimate how large a naive binary encoding will be:
@@ -178,6 +315,14 @@ class IntSet:
         # decide whether to compress or not.
         return len(self.npa) * (self.bits // 8)
 
+    def clip(self, count):
+        # Discard all values >= count, in place.
+        pos = count // self.bits
+        if pos < len(self.npa):
+            self.npa[pos+1:] = 0
+            self.npa[pos] = int(self.npa[pos]) & ((1 << (count % self.bits)) - 1)
+        return self
+
     def __contains__(self, val):
         pos = val // self.bits
         if pos >= len(self.npa):
@@ -227,7 +372,7 @@ class IntSet:
                 self.npa.resize(len(other.npa) + self.DEF_GROW)
             self.npa[:len(other.npa)] |= other.npa
 
-        elif other in (None, []):
+        elif other is None:
             return self
 
         elif isinstance(other, int):
@@ -238,16 +383,13 @@ class IntSet:
             bit = val % self.bits
             self.npa[pos] = int(self.npa[pos]) | (1 << bit)
 
-        elif isinstance(other, (tuple, list, set)):
+        elif isinstance(other, (tuple, list, set, numpy.ndarray)):
             if len(other) > 0:
-                maxint = max(other)
-                bitmask = [0] * (1 + (maxint // self.bits))
-                for i in other:
-                    bitmask[i // self.bits] |= (1 << (i % self.bits))
+                bitmask = self._bitmask(other)
                 if len(bitmask) > len(self.npa):
                     self.npa.resize(len(bitmask) + self.DEF_GROW)
 
-                self.npa[:len(bitmask)] |= numpy.array(bitmask, dtype=self.dtype)
+                self.npa[:len(bitmask)] |= bitmask
         else:
             raise ValueError('Bad type %s' % type(other))
         return self
@@ -258,7 +400,7 @@ class IntSet:
                 self.npa.resize(len(other.npa) + self.DEF_GROW)
             self.npa[:len(other.npa)] |= other.npa
 
-        elif other in (None, []):
+        elif other is None:
             return self
 
         elif isinstance(other, int):
@@ -269,56 +411,140 @@ class IntSet:
             bit = val % self.bits
             self.npa[pos] = int(self.npa[pos]) ^ (1 << bit)
 
-        elif isinstance(other, (tuple, list, set)):
+        elif isinstance(other, (tuple, list, set, numpy.ndarray)):
             if len(other) > 0:
-                maxint = max(other)
-                bitmask = [0] * (1 + (maxint // self.bits))
-                for i in other:
-                    bitmask[i // self.bits] |= (1 << (i % self.bits))
+                bitmask = self._bitmask(other)
                 if len(bitmask) > len(self.npa):
                     self.npa.resize(len(bitmask) + self.DEF_GROW)
 
-                self.npa[:len(bitmask)] ^= numpy.array(bitmask, dtype=self.dtype)
+                self.npa[:len(bitmask)] ^= bitmask
         else:
             raise ValueError('Bad type %s' % type(other))
         return self
 
+    def _bitmask(self, ints):
+        if not isinstance(ints, numpy.ndarray):
+            if isinstance(ints, set):
+                ints = numpy.fromiter(ints, dtype=numpy.int64, count=len(ints))
+            else:
+                ints = numpy.asarray(ints, dtype=numpy.int64)
+        words = 1 + int(ints.max()) // self.bits
+        bits = numpy.zeros(words * self.bits, dtype=bool)
+        bits[ints] = True
+        return numpy.packbits(bits, bitorder='little').view(self.dtype)
+
+    def _positions(self, beg=0, end=None):
+        # Returns a numpy array of the ints set in words [beg:end]; only
+        # words with bits set get unpacked, so sparse sets are cheap.
+        words = self.npa[beg:end]
+        used = numpy.flatnonzero(words)
+        if not len(used):
+            return numpy.zeros(0, dtype=numpy.int64)
+        bits = numpy.unpackbits(
+            words[used].view(numpy.uint8), bitorder='little'
+            ).reshape(len(used), self.bits)
+        rows, cols = numpy.nonzero(bits)
+        return (used[rows] + beg) * self.bits + cols
+
+    @classmethod
+    def from_numpy(cls, ints):
+        iset = cls()
+        if len(ints) > 0:
+            iset.npa = numpy.copy(iset._bitmask(ints))
+        return iset
+
+    def to_numpy(self):
+        return self._positions()
+
+    def gather(self, ints):
+        # Test many ints for membership at once, returning a numpy array
+        # of booleans in the same order.
+        ints = numpy.asarray(ints, dtype=numpy.int64)
+        pos = ints // self.bits
+        found = (ints >= 0) & (pos < len(self.npa))
+        words = self.npa[numpy.where(found, pos, 0)]
+        shift = (ints % self.bits).astype(self.dtype)
+        return found & ((words >> shift) & 1).astype(bool)
+
+    @classmethod
+    def GatherBinary(cls, binary, ints):
+        # Like gather(), but tests membership directly in the output of
+        # tobytes(), only looking at the containers which matter. This is
+        # much cheaper than decoding a large set to check a few ints.
+        ints = numpy.asarray(ints, dtype=numpy.int64)
+        if binary[:1] == cls.BIN_VERSION_BITMAP:
+            stripped = struct.unpack('<I', binary[1:5])[0]
+            data = numpy.frombuffer(binary, dtype=numpy.uint8, offset=5)
+            pos = ints // 8 - stripped
+            found = (pos >= 0) & (pos < len(data))
+            data = data[numpy.where(found, pos, 0)]
+            shift = (ints % 8).astype(numpy.uint8)
+            return found & ((data >> shift) & 1).astype(bool)
+        elif binary[:1] != cls.BIN_VERSION_CONTAINERS:
+            raise ValueError('Unsupported IntSet version')
+
+        c_bytes = cls.CONTAINER_BITS // 8
+        hdr_size = struct.calcsize(cls.CONTAINER_HEADER)
+        keys = ints // cls.CONTAINER_BITS
+        offsets = ints % cls.CONTAINER_BITS
+        wanted = set(keys.tolist())
+        found = numpy.zeros(len(ints), dtype=bool)
+
+        count = struct.unpack('<I', binary[1:5])[0]
+        beg = 5
+        for i in range(0, count):
+            key, ctype, n = struct.unpack_from(cls.CONTAINER_HEADER, binary, beg)
+            beg += hdr_size
+            if ctype == cls.C_ARRAY:
+                end = beg + 2*n
+            elif ctype == cls.C_RUNS:
+                end = beg + 4*n
+            elif ctype == cls.C_BITMAP:
+                end = beg + c_bytes
+            else:
+                raise ValueError('Invalid IntSet container')
+            if (key in wanted) and (n or (ctype == cls.C_BITMAP)):
+                sel = (keys == key)
+                ofs = offsets[sel]
+                if ctype == cls.C_ARRAY:
+                    found[sel] = numpy.isin(ofs, numpy.frombuffer(
+                        binary, dtype='<u2', count=n, offset=beg))
+                elif ctype == cls.C_RUNS:
+                    runs = numpy.frombuffer(
+                        binary, dtype='<u2', count=2*n, offset=beg
+                        ).astype(numpy.int64)
+                    j = numpy.searchsorted(runs[0::2], ofs, side='right') - 1
+                    k = numpy.maximum(j, 0)
+                    found[sel] = (j >= 0) & (
+                        ofs <= runs[0::2][k] + runs[1::2][k])
+                else:
+                    data = numpy.frombuffer(
+                        binary, dtype=numpy.uint8, count=c_bytes, offset=beg)
+                    shift = (ofs % 8).astype(numpy.uint8)
+                    found[sel] = ((data[ofs // 8] >> shift) & 1).astype(bool)
+            beg = end
+        return found
+
     def chunks(self, size=1024, reverse=True):
-        result = []
+        positions = self._positions()
         if reverse:
-            rrange = lambda a,b: reversed(range(a, b))
-        else:
-            rrange = lambda a,b: range(a, b)
-        for i in rrange(0, len(self.npa)):
-            u64 = int(self.npa[i])
-            if u64:
-                for j in rrange(0, self.bits):
-                    if (u64 & (1 << j)):
-                        result.append((i * self.bits) + j)
-            while len(result) >= size:
-                yield result[:size]
-                result = result[size:]
-        if result:
-            yield result
+            positions = positions[::-1]
+        for beg in range(0, len(positions), size):
+            yield positions[beg:beg+size].tolist()
 
     def __iter__(self):
-        for i in range(0, len(self.npa)):
-            u64 = int(self.npa[i])
-            if u64:
-                for j in range(0, self.bits):
-                    if (u64 & (1 << j)):
-                        yield (i * self.bits) + j
+        # Unpack a block of words at a time, so iterating over huge sets
+        # neither loops over every bit in Python nor allocates everything
+        # up front.
+        step = 16 * 1024
+        for beg in range(0, len(self.npa), step):
+            yield from self._positions(beg, beg + step).tolist()
 
     def __bool__(self):
-        for i in range(0, len(self.npa)):
-            u64 = int(self.npa[i])
-            if u64:
-                return True
-        return False
+        return bool(self.npa.any())
 
     def count(self):
-        return sum(1 for hit in self)
-
+        return _popcount(self.npa)
 
 register_dumb_decoder(IntSet.ENC_ASC, IntSet.DumbDecode)
 
@@ -347,6 +573,20 @@ if __name__ == "__main__":
     assert(b3 != some)
     assert(b3 != list(reversed(few)))
 
+    rare = IntSet([2000001, 2000005])
+    assert(len(rare.tobytes()) < 32)
+    assert(IntSet(binary=rare.tobytes()) == [2000001, 2000005])
+    assert(IntSet(binary=b1.tobytes()) == b1)
+    assert(IntSet(binary=b1.tobytes(strip=False)) == b1)
+
+    assert(b3.count() == len(few))
+    assert(list(IntSet.from_numpy(b2.to_numpy())) == some)
+    assert(list(b3.chunks(size=3)) == [[1024000-10, 9990, 1020], [0]])
+    assert(list(b3.chunks(size=3, reverse=False)) == [[0, 1020, 9990], [1024000-10]])
+    assert(bool(b3) and not bool(IntSet()))
+    assert(list(b3.gather([1020, 1021, 0, -1, 99999999])) == [
+        True, False, True, False, False])
+
     print('Tests passed OK')
 
     count = 10
@@ -388,3 +628,35 @@ if __name__ == "__main__":
     print(' * bitmask_to_ints x %d = %.2fs' % (3 * count, t4-t3))
     t4 = time.time()
 
+    for i in range(0, 100*count):
+        c1 = b1.count()
+        c2 = b2.count()
+        c3 = b3.count()
+        bool(b1)
+    t5 = time.time()
+    assert((c1, c2, c3) == (len(many), len(some), len(few)))
+    print(' * bitmask_count x %d  = %.2fs' % (300 * count, t5-t4))
+
+    # For comparison, this is how we used to iterate and count: one
+    # Python-level operation per 64-bit word and per bit.
+    def _python_iter(iset):
+        for i in range(0, len(iset.npa)):
+            u64 = int(iset.npa[i])
+            if u64:
+                for j in range(0, iset.bits):
+                    if (u64 & (1 << j)):
+                        yield (i * iset.bits) + j
+
+    t5 = time.time()
+    l1 = list(_python_iter(b1))
+    t6 = time.time()
+    c1 = sum(1 for hit in _python_iter(b1))
+    t7 = time.time()
+    l1 = list(b1)
+    t8 = time.time()
+    c1 = b1.count()
+    t9 = time.time()
+    print((' * %d-bit set, python vs. numpy: list() %.2fs vs. %.3fs, '
+           'count() %.2fs vs. %.4fs')
+        % (len(b1.npa) * b1.bits, t6-t5, t8-t7, t7-t6, t9-t8))
+
@@ -0,0 +1,73 @@
+# Helpers for keeping an eye on how much memory we are using.
+#
+# We avoid depending on psutil; on Linux /proc/self/statm tells us our
+# current resident set size, elsewhere we fall back to the peak RSS
+# reported by resource.getrusage(), which is better than nothing.
+#
+import os
+import sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def rss_bytes():
+    """
+    Return the current resident set size of this process, in bytes.
+    Returns 0 if we have no way of knowing.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as fd:
+            return int(fd.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        pass
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS reports bytes
+        return maxrss if (sys.platform == 'darwin') else (maxrss * 1024)
+    return 0
+
+
+def physical_memory():
+    """
+    Return the amount of physical memory on this machine, in bytes.
+    Returns 0 if we have no way of knowing.
+    """
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * PAGE_SIZE
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+def memory_budget(megabytes=None, fraction=0.25, minimum=128, maximum=4096):
+    """
+    Return a memory budget in bytes. If megabytes is set, it wins,
+    otherwise the budget is a fraction of physical memory, bounded by
+    the minimum and maximum (also in megabytes).
+    """
+    if megabytes:
+        return int(float(megabytes) * 1024 * 1024)
+    budget = int(physical_memory() * fraction) // (1024 * 1024)
+    return max(minimum, min(maximum, budget or minimum)) * 1024 * 1024
+
+
+if __name__ == '__main__':
+    rss = rss_bytes()
+    assert(rss > 1024 * 1024)
+    junk = bytearray(64 * 1024 * 1024)
+    assert(rss_bytes() > rss + 32 * 1024 * 1024)
+
+    assert(memory_budget(100) == 100 * 1024 * 1024)
+    assert(memory_budget('0.5') == 512 * 1024)
+    assert(128 * 1024 * 1024 <= memory_budget() <= 4096 * 1024 * 1024)
+    assert(memory_budget(maximum=128) == 128 * 1024 * 1024)
+
+    print('Tests passed OK')
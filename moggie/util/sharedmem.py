@@ -0,0 +1,204 @@
+# Shared memory handoff for large values passed between local workers.
+#
+# A worker which wants to hand a large blob to another process on the
+# same host can place it in a multiprocessing.shared_memory segment and
+# send a short reference instead. The reference is a valid dumb-encoded
+# value, so recipients just call dumb_decode() like they always did.
+#
+# The producer owns the segments: they are never unlinked by readers,
+# because a single result often gets passed along and read by more than
+# one process (e.g. search worker -> app -> metadata worker). Instead,
+# segments expire after a while, the oldest get evicted if we are using
+# too much memory, and they are all removed when the producer shuts down.
+# Should the producer crash, the multiprocessing resource tracker cleans
+# up after it.
+#
+import hashlib
+import logging
+import mmap
+import os
+import re
+import threading
+import time
+
+from multiprocessing import shared_memory
+
+try:
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
+
+from .dumbcode import dumb_decode, dumb_encode_asc, register_dumb_decoder
+
+
+SHARED_MARKER = 'M'
+
+# Only attach to segments named the way SharedMemory(create=True) names
+# them, so decoding untrusted input cannot read arbitrary shared memory.
+SHARED_NAME_RE = re.compile(r'^psm_[0-9a-f]+$')
+
+
+def is_shared_ref(v):
+    return (isinstance(v, (str, bytes))
+        and (v[:1] in (SHARED_MARKER, SHARED_MARKER.encode('latin-1'))))
+
+
+def read_shared(ref):
+    """
+    Return a copy of the data referenced by a shared memory reference.
+    Raises FileNotFoundError if the segment has expired.
+    """
+    if isinstance(ref, bytes):
+        ref = str(ref, 'latin-1')
+    name, size = ref[1:].rsplit('/', 1)
+    size = int(size, 16)
+    if not SHARED_NAME_RE.match(name):
+        raise ValueError('Not a moggie shared memory segment: %s' % name)
+    if _posixshmem is not None:
+        # Attach directly, instead of using SharedMemory(); before Python
+        # 3.13 that would register the segment with our resource tracker,
+        # which would then unlink it when we exit. It is not ours!
+        fd = _posixshmem.shm_open('/' + name, os.O_RDONLY, mode=0o600)
+        try:
+            with mmap.mmap(fd, size, prot=mmap.PROT_READ) as mm:
+                return mm[:size]
+        finally:
+            os.close(fd)
+    else:
+        shm = shared_memory.SharedMemory(name)
+        try:
+            return bytes(shm.buf[:size])
+        finally:
+            shm.close()
+
+
+def unshare(v, compress=256):
+    """
+    Convert a shared memory reference (or binary dumb-encoded value, as
+    found in msgpack replies) back into a plain dumb-encoded string, for
+    sending to recipients which may not be local.
+    """
+    if is_shared_ref(v) or isinstance(v, bytes):
+        return dumb_encode_asc(dumb_decode(v), compress=compress)
+    return v
+
+
+def _dumb_decode_shared(encoded):
+    return dumb_decode(read_shared(encoded))
+
+
+class SharedValues:
+    """
+    A collection of shared memory segments owned by this process.
+    Sharing the same data twice reuses the existing segment.
+    """
+    TTL = 120
+    MAX_BYTES = 128 * 1024 * 1024
+
+    def __init__(self, ttl=None, max_bytes=None):
+        self.ttl = self.TTL if (ttl is None) else ttl
+        self.max_bytes = self.MAX_BYTES if (max_bytes is None) else max_bytes
+        self.segments = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.segments)
+
+    def share(self, data):
+        """
+        Place data in shared memory, returning a reference which
+        dumb_decode() (or read_shared) will understand.
+        """
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        now = time.time()
+        with self.lock:
+            seg = self.segments.pop(digest, None)
+            if seg is None:
+                shm = shared_memory.SharedMemory(
+                    create=True, size=max(1, len(data)))
+                shm.buf[:len(data)] = data
+                ref = '%s%s/%x' % (SHARED_MARKER, shm.name, len(data))
+                seg = [shm, ref, 0]
+                self.bytes += shm.size
+            seg[2] = now + self.ttl
+            self.segments[digest] = seg  # Most recently used go last
+            self._expire(now, keep=digest)
+            return seg[1]
+
+    def _expire(self, now, keep=None):
+        for digest, (shm, ref, expires) in list(self.segments.items()):
+            if digest == keep:
+                continue
+            if (expires < now) or (self.bytes > self.max_bytes):
+                self._remove(digest)
+
+    def _remove(self, digest):
+        shm = self.segments.pop(digest)[0]
+        self.bytes -= shm.size
+        try:
+            shm.close()
+            shm.unlink()
+        except (OSError, BufferError):
+            logging.exception('Failed to remove shared memory %s' % shm.name)
+
+    def expire(self):
+        with self.lock:
+            self._expire(time.time())
+
+    def close(self):
+        with self.lock:
+            for digest in list(self.segments):
+                self._remove(digest)
+
+
+register_dumb_decoder(SHARED_MARKER, _dumb_decode_shared, both_cases=False)
+
+
+if __name__ == '__main__':
+    from .intset import IntSet
+    from .dumbcode import dumb_encode_bin
+
+    sv = SharedValues(ttl=0.2, max_bytes=3 * mmap.PAGESIZE)
+    iset = IntSet(list(range(0, 100000, 7)))
+    ref = sv.share(dumb_encode_bin(iset))
+    assert(is_shared_ref(ref))
+    assert(dumb_decode(ref) == iset)
+    assert(dumb_decode(bytes(ref, 'latin-1')) == iset)
+    assert(dumb_decode(unshare(ref)) == iset)
+    assert(unshare('Ifoo') == 'Ifoo')
+    assert(unshare(dumb_encode_bin(iset)) == unshare(ref))
+    for bogus in ('Mfoo/10', 'M../psm_1/10', 'Mpsm_1/../x/10'):
+        try:
+            dumb_decode(bogus)
+            assert(not 'reached')
+        except ValueError:
+            pass
+
+    # Sharing the same thing twice reuses the segment
+    assert(sv.share(dumb_encode_bin(iset)) == ref)
+    assert(len(sv) == 1)
+
+    # Going over budget evicts the oldest segments
+    r1 = sv.share(b'u1')
+    r2 = sv.share(b'u2')
+    r3 = sv.share(b'u3')
+    assert(dumb_decode(r3) == '3')
+    try:
+        read_shared(ref)
+        assert(not 'reached')
+    except FileNotFoundError:
+        pass
+
+    # Old segments expire
+    time.sleep(0.3)
+    sv.expire()
+    assert(len(sv) == 0)
+    try:
+        read_shared(r3)
+        assert(not 'reached')
+    except FileNotFoundError:
+        pass
+
+    sv.close()
+    print('Tests passed OK')
@@ -2,3 +2,4 @@ __version__ = "1.1b3+moggie"
 __date__ = "Oct 14, 2023"     # Previous date: "Nov 23, 2017"
 
 from .classifier import Classifier
+from .tokenstore import TokenStore
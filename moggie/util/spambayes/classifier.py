@@ -42,6 +42,8 @@
 
 import math
 
+import numpy
+
 from .chi2 import chi2Q
 
 
@@ -189,15 +191,18 @@ class Classifier:
             yield word, info.spamcount, info.hamcount
 
     def decay(self, ratio):
-        dropping = []
         scale = 1.0 - ratio
+        self.nspam = int(scale * self.nspam)
+        self.nham = int(scale * self.nham)
+        if hasattr(self.wordinfo, 'decay'):
+            return self.wordinfo.decay(ratio)
+
+        dropping = []
         for word, info in self.wordinfo.items():
             info.spamcount = scale * info.spamcount
             info.hamcount = scale * info.hamcount
             if (info.spamcount < 0.5) and (info.hamcount < 0.5):
                 dropping.append(word)
-        self.nspam = int(scale * self.nspam)
-        self.nham = int(scale * self.nham)
         for word in dropping:
             del self.wordinfo[word]
         return len(dropping)
@@ -212,6 +217,17 @@ class Classifier:
         self.nham = totals.hamcount
         return self
 
+    def load_store(self, store):
+        """Use a TokenStore (or similar) as our word database."""
+        self.wordinfo = store
+        self.probcache = {}
+        self.nspam, self.nham = (int(t) for t in store.totals)
+        return self
+
+    def save_store(self, path=None):
+        """Save our TokenStore word database, along with the totals."""
+        self.wordinfo.save(path, totals=(self.nspam, self.nham))
+
     # spamprob() implementations.  One of the following is aliased to
     # spamprob, depending on option settings.
     # Currently only chi-squared is available, but maybe there will be
@@ -301,6 +317,62 @@ class Classifier:
         else:
             return prob
 
+    def chi2_spamprobs(self, wordstreams):
+        """Return a list of spam probabilities, one for each wordstream.
+
+        This gives the same results as chi2_spamprob(), but each distinct
+        word's probability is only calculated once, and the chi-squared
+        combining step is done with numpy for all the wordstreams at once,
+        which is much faster when classifying many messages.
+        """
+        count = len(wordstreams)
+        if not count:
+            return []
+
+        distances = {}
+        if hasattr(self.wordinfo, 'get_many'):
+            # Databases which can look up many words at once, should.
+            words = set()
+            for ws in wordstreams:
+                words.update(ws)
+            for word, record in zip(words, self.wordinfo.get_many(words)):
+                distances[word] = self._recorddistance(word, record)
+
+        def _worddistanceget(word):
+            try:
+                return distances[word]
+            except KeyError:
+                tup = distances[word] = self._worddistanceget(word)
+                return tup
+
+        # Gather the clues for each message into a matrix, one row per
+        # message, padded with NaNs which nansum() then ignores. Summing
+        # logs directly means we need no frexp() underflow tricks.
+        clues = [[p for p, w, r in self._getclues(ws, _worddistanceget)]
+                 for ws in wordstreams]
+        n = numpy.array([len(c) for c in clues])
+        probs = numpy.full((count, max(1, n.max())), numpy.nan)
+        for i, c in enumerate(clues):
+            probs[i, :len(c)] = c
+        probs = numpy.clip(probs, 1e-10, 1 - 1e-10)
+        S = numpy.nansum(numpy.log(1.0 - probs), axis=1)
+        H = numpy.nansum(numpy.log(probs), axis=1)
+
+        # This is chi2Q(), for each row; rows with fewer degrees of
+        # freedom stop accumulating terms early.
+        def _chi2Q(x2):
+            m = x2 / 2.0
+            total = term = numpy.exp(-m)
+            for i in range(1, n.max()):
+                term = numpy.where(i < n, term * m / i, 0.0)
+                total = total + term
+            return numpy.minimum(total, 1.0)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            S = 1.0 - _chi2Q(-2.0 * S)
+            H = 1.0 - _chi2Q(-2.0 * H)
+        return numpy.where(n > 0, (S - H + 1.0) / 2.0, 0.5).tolist()
+
     def learn(self, wordstream, is_spam):
         """Teach the classifier by example.
 
@@ -463,8 +535,9 @@ class Classifier:
     # the strongest (farthest from 0.5) spamprobs of all tokens in wordstream.
     # Tokens with spamprobs less than minimum_prob_strength away from 0.5
     # aren't returned.
-    def _getclues(self, wordstream):
+    def _getclues(self, wordstream, worddistanceget=None):
         mindist = self.minimum_prob_strength
+        worddistanceget = worddistanceget or self._worddistanceget
 
         if self.use_bigrams:
             # This scheme mixes single tokens with pairs of adjacent tokens.
@@ -499,7 +572,7 @@ class Classifier:
                 for clue, indices in (token, (i,)), (pair, (i-1, i)):
                     if clue not in seen:    # as always, skip duplicates
                         seen[clue] = 1
-                        tup = self._worddistanceget(clue)
+                        tup = worddistanceget(clue)
                         if tup[0] >= mindist:
                             push((tup, indices))
 
@@ -527,7 +600,7 @@ class Classifier:
             clues = []
             push = clues.append
             for word in set(wordstream):
-                tup = self._worddistanceget(word)
+                tup = worddistanceget(word)
                 if tup[0] >= mindist:
                     push(tup)
             clues.sort()
@@ -538,7 +611,9 @@ class Classifier:
         return [t[1:] for t in clues]
 
     def _worddistanceget(self, word):
-        record = self._wordinfoget(word)
+        return self._recorddistance(word, self._wordinfoget(word))
+
+    def _recorddistance(self, word, record):
         if record is None:
             prob = self.unknown_word_prob
         else:
@@ -0,0 +1,419 @@
+# A compact token database for the spambayes Classifier.
+#
+# The Classifier's default database is a dict of WordInfo objects, which
+# costs a few hundred bytes per token, and has to be rebuilt from JSON
+# every time it is loaded. The TokenStore instead keeps a sorted array of
+# 64-bit token hashes, with parallel arrays of spam and ham counts, all
+# memory-mapped from a binary file. Recent changes live in a small dict
+# (the delta), and are appended to the end of the file as a log when we
+# save; the arrays are only rewritten when the log grows too large.
+#
+# File format (little-endian):
+#
+#    header:  magic (8 bytes), token count N, nspam, nham (doubles)
+#    hashes:  N * uint64, sorted
+#    spam:    N * float32
+#    ham:     N * float32
+#    log:     (hash uint64, spam float32, ham float32) records
+#
+# In the log, zero counts mean the token was deleted, and hash 0 records
+# updates to the nspam/nham totals.
+#
+# Tokens are stored by hash, so the words themselves cannot be recovered;
+# iterating over a TokenStore yields integer hashes instead of words.
+# Counts are stored as float32, which is exact for integers up to 2**24.
+#
+import bisect
+import hashlib
+import mmap
+import os
+import sys
+import tempfile
+
+import numpy
+
+from .classifier import WordInfo
+
+
+class TokenStore:
+    """
+    A dict-like mapping of words to WordInfo records, suitable for use
+    as a Classifier's wordinfo database.
+    """
+    MAGIC = b'SBTOKS01'
+    HEADER = numpy.dtype([
+        ('magic', 'S8'), ('count', '<u8'), ('nspam', '<f8'), ('nham', '<f8')])
+    RECORD = numpy.dtype([('hash', '<u8'), ('spam', '<f4'), ('ham', '<f4')])
+    LOG_MIN = 10000
+
+    def __init__(self, path=None):
+        self.path = None
+        self.totals = (0, 0)
+        self.logged = 0
+        self.rewrite = True
+        self.clear()
+        if path is not None:
+            self.open(path)
+
+    @classmethod
+    def FromItems(cls, items):
+        """Create a new TokenStore from (word, WordInfo) pairs."""
+        store = cls()
+        for word, record in items:
+            store[word] = record
+        store.merge()
+        return store
+
+    @classmethod
+    def Hash(cls, word):
+        if isinstance(word, int):
+            return word
+        h = hashlib.blake2b(bytes(word, 'utf-8'), digest_size=8).digest()
+        return int.from_bytes(h, 'little') or 1  # 0 is reserved for totals
+
+    def clear(self):
+        self.hashes = numpy.zeros(0, dtype='<u8')
+        self.spam = numpy.zeros(0, dtype='<f4')
+        self.ham = numpy.zeros(0, dtype='<f4')
+        self.delta = {}
+        self.dirty = set()
+        self._index()
+
+    def _index(self):
+        # Single lookups are much faster using bisect and memoryviews
+        # than they are using numpy, which has a lot of per-call overhead.
+        arrays = (self.hashes, self.spam, self.ham)
+        if sys.byteorder != 'little':
+            arrays = [a.astype(a.dtype.newbyteorder('=')) for a in arrays]
+        self._hashes, self._spam, self._ham = (
+            memoryview(a).cast('B').cast(c) for a, c in zip(arrays, 'Qff'))
+
+    def open(self, path):
+        """
+        Memory-map a token database from disk, replaying any changes
+        which were logged after the arrays were written.
+        """
+        with open(path, 'rb') as fd:
+            if os.fstat(fd.fileno()).st_size < self.HEADER.itemsize:
+                raise ValueError('Truncated token store: %s' % path)
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = numpy.frombuffer(mm, dtype=self.HEADER, count=1)[0]
+        if header['magic'] != self.MAGIC:
+            raise ValueError('Not a token store: %s' % path)
+        count = int(header['count'])
+        beg = self.HEADER.itemsize
+        end = beg + count * 16
+        if len(mm) < end:
+            raise ValueError('Truncated token store: %s' % path)
+
+        self.clear()
+        self.hashes = numpy.frombuffer(mm, dtype='<u8', count=count, offset=beg)
+        beg += count * 8
+        self.spam = numpy.frombuffer(mm, dtype='<f4', count=count, offset=beg)
+        beg += count * 4
+        self.ham = numpy.frombuffer(mm, dtype='<f4', count=count, offset=beg)
+        self.totals = (float(header['nspam']), float(header['nham']))
+        self._index()
+
+        # Replay the log; a partially written final record is ignored.
+        log = numpy.frombuffer(mm, dtype=self.RECORD,
+            count=(len(mm) - end) // self.RECORD.itemsize, offset=end)
+        for h, spam, ham in log.tolist():
+            if h == 0:
+                self.totals = (spam, ham)
+            elif spam or ham:
+                self.delta[h] = WordInfo(spam, ham)
+            else:
+                self.delta[h] = None
+        self.path = path
+        self.logged = len(log)
+        self.rewrite = False
+        return self
+
+    def save(self, path=None, totals=None):
+        """
+        Save the token database. If we are saving to the file we loaded
+        from, recent changes get appended as a log instead of rewriting
+        the entire file.
+        """
+        path = path or self.path
+        totals = self.totals if (totals is None) else totals
+        if (not self.rewrite
+                and path == self.path
+                and os.path.exists(path)
+                and (self.logged + len(self.dirty)
+                     <= max(self.LOG_MIN, len(self.hashes) // 4))):
+            self._append_log(totals)
+        else:
+            self._write(path, totals)
+
+    def _append_log(self, totals):
+        records = numpy.zeros(len(self.dirty) + 1, dtype=self.RECORD)
+        for i, h in enumerate(self.dirty):
+            record = self.delta.get(h)
+            if record is None:
+                records[i] = (h, 0, 0)
+            else:
+                records[i] = (h, record.spamcount, record.hamcount)
+        records[-1] = (0, totals[0], totals[1])
+        with open(self.path, 'ab') as fd:
+            fd.write(records.tobytes())
+        self.logged += len(records)
+        self.dirty = set()
+        self.totals = totals
+
+    def _write(self, path, totals):
+        self.merge()
+        header = numpy.array(
+            [(self.MAGIC, len(self.hashes), totals[0], totals[1])],
+            dtype=self.HEADER)
+        # A unique temporary file, so concurrent writers cannot clobber
+        # each other's half-written output.
+        tfd, tpath = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            with open(tfd, 'wb') as fd:
+                for array in (header, self.hashes, self.spam, self.ham):
+                    fd.write(array.tobytes())
+            os.replace(tpath, path)
+        except:
+            os.remove(tpath)
+            raise
+        self.open(path)
+
+    def merge(self):
+        """
+        Fold the delta into the sorted arrays. The result lives in RAM
+        until the next save().
+        """
+        hashes, spam, ham = (
+            numpy.array(a) for a in (self.hashes, self.spam, self.ham))
+        if self.delta:
+            dh = numpy.fromiter(self.delta.keys(), dtype='<u8',
+                count=len(self.delta))
+            ds = numpy.fromiter(
+                ((r.spamcount if r else 0) for r in self.delta.values()),
+                dtype='<f4', count=len(self.delta))
+            dm = numpy.fromiter(
+                ((r.hamcount if r else 0) for r in self.delta.values()),
+                dtype='<f4', count=len(self.delta))
+
+            pos = numpy.searchsorted(hashes, dh)
+            found = pos < len(hashes)
+            found[found] = hashes[pos[found]] == dh[found]
+            spam[pos[found]] = ds[found]
+            ham[pos[found]] = dm[found]
+
+            hashes = numpy.concatenate((hashes, dh[~found]))
+            spam = numpy.concatenate((spam, ds[~found]))
+            ham = numpy.concatenate((ham, dm[~found]))
+            order = numpy.argsort(hashes, kind='stable')
+            hashes, spam, ham = hashes[order], spam[order], ham[order]
+
+        live = (spam != 0) | (ham != 0)
+        if not live.all():
+            hashes, spam, ham = hashes[live], spam[live], ham[live]
+        self.hashes, self.spam, self.ham = hashes, spam, ham
+        self.delta = {}
+        self.dirty = set()
+        self.rewrite = True
+        self._index()
+
+    def decay(self, ratio):
+        """
+        Scale down all counts by ratio, dropping tokens which fall below
+        0.5. Returns the number of tokens dropped.
+        """
+        self.merge()
+        scale = 1.0 - ratio
+        self.spam *= scale
+        self.ham *= scale
+        keep = (self.spam >= 0.5) | (self.ham >= 0.5)
+        dropped = len(keep) - int(keep.sum())
+        self.hashes = self.hashes[keep]
+        self.spam = self.spam[keep]
+        self.ham = self.ham[keep]
+        self._index()
+        return dropped
+
+    def _find(self, h):
+        i = bisect.bisect_left(self._hashes, h)
+        if i < len(self._hashes) and self._hashes[i] == h:
+            return i
+        return None
+
+    def get(self, word, default=None):
+        h = self.Hash(word)
+        if h in self.delta:
+            record = self.delta[h]
+            return default if (record is None) else record
+        i = self._find(h)
+        if i is None:
+            return default
+        return WordInfo(self._spam[i], self._ham[i])
+
+    def get_many(self, words):
+        """
+        Look up many words at once, returning a list of WordInfo records
+        (or None for unknown words).
+        """
+        words = list(words)
+        hashes = [self.Hash(w) for w in words]
+        pos = numpy.searchsorted(self.hashes,
+            numpy.array(hashes, dtype='<u8')).tolist()
+        count = len(self._hashes)
+        found = []
+        for h, i in zip(hashes, pos):
+            if h in self.delta:
+                found.append(self.delta[h])
+            elif i < count and self._hashes[i] == h:
+                found.append(WordInfo(self._spam[i], self._ham[i]))
+            else:
+                found.append(None)
+        return found
+
+    def __getitem__(self, word):
+        record = self.get(word)
+        if record is None:
+            raise KeyError(word)
+        return record
+
+    def __setitem__(self, word, record):
+        h = self.Hash(word)
+        self.delta[h] = WordInfo(record.spamcount, record.hamcount)
+        self.dirty.add(h)
+
+    def __delitem__(self, word):
+        h = self.Hash(word)
+        if self.get(h) is None:
+            raise KeyError(word)
+        self.delta[h] = None
+        self.dirty.add(h)
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def pop(self, word, *default):
+        record = self.get(word)
+        if record is None:
+            if default:
+                return default[0]
+            raise KeyError(word)
+        del self[word]
+        return record
+
+    def items(self):
+        for h, spam, ham in zip(
+                self.hashes.tolist(), self.spam.tolist(), self.ham.tolist()):
+            if h not in self.delta:
+                yield h, WordInfo(spam, ham)
+        for h, record in list(self.delta.items()):
+            if record is not None:
+                yield h, record
+
+    def keys(self):
+        return (h for h, record in self.items())
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        count = len(self.hashes)
+        for h, record in self.delta.items():
+            known = self._find(h) is not None
+            if known and record is None:
+                count -= 1
+            elif record is not None and not known:
+                count += 1
+        return count
+
+
+if __name__ == '__main__':
+    import json
+    import random
+    import sys
+    import tempfile
+    import time
+
+    from .classifier import Classifier
+
+    random.seed(1)
+    vocab = ['%x' % random.randint(0, 0xffffffffffff) for i in range(30000)]
+    msgs = [(random.sample(vocab, 200), bool(i % 2)) for i in range(500)]
+
+    sb = Classifier()
+    for words, is_spam in msgs:
+        sb.learn(words, is_spam)
+    tests = [random.sample(vocab, 100) for i in range(50)]
+    expected = [sb.classify(words) for words in tests]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'test.atok')
+        store = TokenStore.FromItems(sb.wordinfo.items())
+        assert(len(store) == len(sb.wordinfo))
+        store.save(path, totals=(sb.nspam, sb.nham))
+
+        sb2 = Classifier().load_store(TokenStore(path))
+        assert(len(sb2.wordinfo) == len(sb.wordinfo))
+        assert([sb2.classify(w) for w in tests] == expected)
+
+        # Learning goes to the delta, and then to the log
+        size = os.path.getsize(path)
+        sb.learn(tests[0], True)
+        sb2.learn(tests[0], True)
+        sb.unlearn(msgs[0][0], msgs[0][1])
+        sb2.unlearn(msgs[0][0], msgs[0][1])
+        sb2.save_store()
+        assert(os.path.getsize(path) > size)
+        assert(not sb2.wordinfo.dirty)
+        expected = [sb.classify(words) for words in tests]
+        assert([sb2.classify(w) for w in tests] == expected)
+
+        sb3 = Classifier().load_store(TokenStore(path))
+        assert((sb3.nspam, sb3.nham) == (sb.nspam, sb.nham))
+        assert(len(sb3.wordinfo) == len(sb.wordinfo))
+        assert([sb3.classify(w) for w in tests] == expected)
+
+        # A large log triggers a rewrite
+        sb3.wordinfo.LOG_MIN = 0
+        for words, is_spam in msgs:
+            sb3.learn(words, is_spam)
+        sb3.save_store()
+        assert(sb3.wordinfo.logged == 0 and not sb3.wordinfo.delta)
+        assert(len(TokenStore(path)) == len(sb3.wordinfo))
+
+        # Decay drops rare tokens
+        count = len(sb3.wordinfo)
+        dropped = sb3.decay(0.9)
+        assert(dropped > 0)
+        assert(len(sb3.wordinfo) == count - dropped)
+
+        # Benchmark: a large database, JSON vs. binary
+        big = Classifier()
+        for i in range(100000):
+            big.wordinfo['%x' % random.randint(0, 0xffffffffffff)
+                ] = WordInfo(random.randint(0, 9), random.randint(1, 9))
+        big.wordinfo['*'] = WordInfo(big.nspam, big.nham)
+        jpath = os.path.join(tmpdir, 'big.json')
+        with open(jpath, 'w') as fd:
+            json.dump([[w, i.spamcount, i.hamcount]
+                for w, i in big.wordinfo.items()], fd)
+        del big.wordinfo['*']
+        bpath = os.path.join(tmpdir, 'big.atok')
+        TokenStore.FromItems(big.wordinfo.items()).save(bpath)
+
+        t0 = time.time()
+        with open(jpath, 'r') as fd:
+            js = Classifier().load(json.load(fd))
+        t1 = time.time()
+        bs = Classifier().load_store(TokenStore(bpath))
+        t2 = time.time()
+
+        dict_bytes = sys.getsizeof(js.wordinfo) + sum(
+            sys.getsizeof(w) + sys.getsizeof(i) for w, i in js.wordinfo.items())
+        print('%d tokens: JSON load %.3fs, ~%d bytes/token; '
+              'binary load %.4fs, %d bytes/token on disk'
+            % (len(js.wordinfo), t1-t0, dict_bytes // len(js.wordinfo),
+               t2-t1, os.path.getsize(bpath) // len(bs.wordinfo)))
+
+    print('Tests passed OK')
@@ -17,17 +17,111 @@ The search function supports MS-DOS style asterisks, where an asterisk
 regular expression engine, it is actually possible to search for complex
 regep patterns to generate keyword candiates. Whether this will prove
 useful is unknown at this time, but it's a neat trick!)
+
+Scanning the entire blob gets slow when there are millions of keywords,
+so a WordblobIndex (a trigram index of the blob's keywords) can be used
+to narrow down which keywords need checking. This only works for simple
+terms, anything which looks like a complex regexp falls back to a scan.
 """
 import re
 import random
+import threading
+
+from array import array
+
+
+class WordblobIndex:
+    """
+    A trigram index of the keywords in a blob. Keep it in sync with the
+    blob by calling update() whenever the blob changes; only the words
+    which were added or removed get (re)indexed. Updates and lookups
+    may happen in different threads.
+    """
+    GRAM = 3
+    COMPLEX_RE = re.compile(br'[\\^$+?{}\[\]|()]')
+    INTERSECTIONS = 3
+
+    def __init__(self, blob=b''):
+        self.words = []   # id -> word, None if removed
+        self.ids = {}     # word -> id
+        self.grams = {}   # trigram -> array of ids
+        self.dead = 0
+        self.lock = threading.Lock()
+        self.update(blob)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _grams(self, word):
+        word = word.lower()
+        return set(word[i:i+self.GRAM]
+            for i in range(0, len(word) - self.GRAM + 1))
+
+    def _add(self, word):
+        wid = self.ids[word] = len(self.words)
+        self.words.append(word)
+        for gram in self._grams(word):
+            postings = self.grams.get(gram)
+            if postings is None:
+                postings = self.grams[gram] = array('I')
+            postings.append(wid)
+
+    def update(self, blob):
+        """
+        Bring the index up to date with the contents of blob.
+        """
+        words = set(blob.split(b'\n')) if blob else set()
+        words.discard(b'')
+        with self.lock:
+            for word in (self.ids.keys() - words):
+                self.words[self.ids.pop(word)] = None
+                self.dead += 1
+            if self.dead > max(1024, len(self.ids)):
+                # Too many removed words, start over.
+                self.words, self.ids, self.grams, self.dead = [], {}, {}, 0
+            for word in sorted(words - self.ids.keys()):
+                self._add(word)
+        return self
 
+    def candidates(self, keyword):
+        """
+        Return a list of keywords which might match the (bytes) search
+        term, or None if the index cannot narrow things down.
+        """
+        if self.COMPLEX_RE.search(keyword):
+            return None
+        grams = set()
+        for fragment in keyword.replace(b'.', b'*').split(b'*'):
+            grams |= self._grams(fragment)
+        if not grams:
+            return None
 
-def wordblob_search(term, blobs, max_results, order=0):
+        with self.lock:
+            postings = []
+            for gram in grams:
+                if gram not in self.grams:
+                    return []
+                postings.append(self.grams[gram])
+            postings.sort(key=len)
+
+            # Intersecting with a few of the shortest posting lists is
+            # enough, the regexp will weed out any false positives.
+            ids = set(postings[0])
+            for p in postings[1:self.INTERSECTIONS]:
+                ids.intersection_update(p)
+            words = self.words
+            return [words[i] for i in ids if words[i] is not None]
+
+
+def wordblob_search(term, blobs, max_results, order=0, indexes=None):
     """
     Search for <term> in <blob>, returning up the <max_results> matches,
     ordered by how exact the match is. The term itself, stripped of
     asterisks, is always the first match, even if it is not present in
     the blob itself.
+
+    If <indexes> is provided, it should be a list of WordblobIndex
+    objects (or None) corresponding to each of the blobs.
     """
     keyword = term if isinstance(term, bytes) else bytes(term, 'utf-8')
     matches = [(0, keyword.replace(b'*', b''))]
@@ -42,7 +136,22 @@ def wordblob_search(term, blobs, max_results, order=0):
         flags=re.IGNORECASE)
 
     blobs = blobs if isinstance(blobs, list) else [blobs]
-    for blob in blobs:
+    for i, blob in enumerate(blobs):
+        index = indexes[i] if (indexes and (order == 0)) else None
+        words = index.candidates(keyword) if index else None
+        if words is not None:
+            for kw in sorted(words):
+                for m in re.finditer(search_re, kw):
+                    beg, end = m.span()
+                    if (bind_beg and beg > 0) or (bind_end and end < len(kw)):
+                        continue
+                    if kw not in (matches[0][1], matches[-1][1]):
+                        orank = 1000000000
+                        ratio = 10 * len(kw) // len(keyword)
+                        matches.append((ratio + beg + orank, kw))
+                    break
+            continue
+
         for m in re.finditer(search_re, blob):
             beg, end = m.span()
 
@@ -160,3 +269,28 @@ if __name__ == '__main__':
     s4 = n / (t4-t3)
 
     print('Tests pass OK: %d/%d/%d/%d qps in %d byte blob' % (s1, s2, s3, s4, len(blob2)))
+
+    # Compare with the trigram index
+    t0 = time.time()
+    index = WordblobIndex(blob2)
+    t1 = time.time()
+    blob3 = update_wordblob([b'%d' % i for i in range(10000, 20000)], blob2,
+        shortest=5, maxlen=128000, lru=True)
+    index.update(blob3)
+    t2 = time.time()
+    assert(len(index) == len(blob3.split()))
+    for term in ('1234*', '*1234', '*1234*', '12*34*', '1*2', '1[23]*', '10'):
+        assert(wordblob_search(term, blob3, 25)
+            == wordblob_search(term, blob3, 25, indexes=[index])), term
+
+    qs = []
+    for wildcard in ('%d*', '%d*0', '*%d', '*%d*'):
+        t3 = time.time()
+        for i in range(0, n):
+            wordblob_search(
+                wildcard % random.randint(0, 10240), blob3, 10,
+                indexes=[index])
+        qs.append(n / (time.time() - t3))
+
+    print('Indexed: %d/%d/%d/%d qps, index built in %.2fs, updated in %.2fs'
+        % tuple(qs + [t1-t0, t2-t1]))
@@ -4,11 +4,14 @@ import copy
 import inspect
 import logging
 import os
+import selectors
 import socket
 import time
 import threading
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor
+
 try:
     import signal
 except ImportError:
@@ -26,6 +29,7 @@ from ..config import APPNAME, AppConfig, configure_logging
 from ..util.dumbcode import *
 from ..util.fds import close_private_fds
 from ..util.http import url_parts, http1x_connect
+from ..util.sharedmem import SharedValues, read_shared
 
 
 def _qsp(qs_raw):
@@ -36,9 +40,39 @@ class QuitException(Exception):
     pass
 
 
+class _PerThread:
+    """
+    An attribute which has a separate value in each thread, so the state
+    of the request being handled is not shared by concurrent handlers.
+    """
+    def __init__(self, default=None):
+        self.default = default
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj._per_thread, self.name, self.default)
+
+    def __set__(self, obj, value):
+        setattr(obj._per_thread, self.name, value)
+
+
 class BaseWorker(Process):
     """
     An extremely simple authenticated HTTP/1.0 RPC server.
+
+    Callers may ask for the connection to be kept alive, in which case
+    complete replies (with a Content-Length) leave the connection open
+    and the server waits for further requests on it. Callers keep a
+    small pool of such connections for reuse.
+
+    Workers which set THREADED = True will run the functions listed in
+    CONCURRENT_FUNCTIONS on a bounded pool of threads, so slow read-only
+    calls do not stall everyone else. All other functions still run one
+    at a time, and never overlap with the concurrent ones.
     """
     KIND = "base"
     NICE = 0  # Raise this number to lower worker priority
@@ -56,6 +90,25 @@ class BaseWorker(Process):
     READ_BYTES = 1024 * 64
     REQUEST_OVERHEAD = 128  # A conservative estimate
 
+    KEEP_ALIVE = True
+    KEEP_ALIVE_TIMEOUT = 30
+    KEEP_ALIVE_MAX = 32
+    CONN_POOL_MAX = 4
+
+    # Speak msgpack instead of JSON and URL-encoded arguments, when both
+    # ends of a kept-alive connection are moggie workers.
+    BINARY_RPC = True
+
+    # Hand large values to local callers via shared memory, instead of
+    # sending them over the socket.
+    SHARED_MEMORY = True
+    SHARED_MIN_BYTES = 64 * 1024
+    LOCAL_ADDRS = ('127.0.0.1', '::1')
+
+    THREADED = False
+    THREAD_POOL_SIZE = 4
+    CONCURRENT_FUNCTIONS = set([b'noop', b'status'])
+
     BACKGROUND_TASK_SLEEP = 0.1
 
     # Intervals for on_tick() and on_idle() events. Neither are precise.
@@ -71,8 +124,31 @@ class BaseWorker(Process):
     HTTP_500 = b'HTTP/1.0 500 Internal Error\r\nContent-Length: 15\r\n\r\nInternal Error\n'
 
     HTTP_JSON = HTTP_200 + b'Content-Type: application/json\r\n'
+    HTTP_MSGPACK = HTTP_200 + b'Content-Type: application/x-msgpack\r\n'
+    HTTP_KEEP_ALIVE = b'Connection: keep-alive\r\n'
+    HTTP_ACCEPT_MSGPACK = b'Accept: application/x-msgpack\r\n'
+    HTTP_ACCEPT_SHARED = b'X-Shared-Memory: ok\r\n'
+    HTTP_SHARED = HTTP_200 + b'Content-Type: application/x-shared-memory\r\n'
     HTTP_OK   = HTTP_JSON + b'Content-Length: 17\r\n\r\n{"result": true}\n'
 
+    # Only replies of these types are read by length, and can keep the
+    # connection alive; other replies are read by callers until EOF.
+    KA_CONTENT_TYPES = (
+        b'application/json',
+        b'application/x-msgpack',
+        b'application/x-shared-memory')
+
+    # The state of the request currently being handled
+    _caller = _PerThread()
+    _client = _PerThread()
+    _client_args = _PerThread()
+    _client_addrinfo = _PerThread()
+    _client_peeked = _PerThread()
+    _client_method = _PerThread()
+    _client_access = _PerThread()
+    _client_headers = _PerThread()
+    _client_keep_alive = _PerThread(False)
+
     def __init__(self, unique_app_id, status_dir,
             host=None, port=None, name=None, notify=None,
             log_level=logging.ERROR, shutdown_idle=None):
@@ -119,15 +195,21 @@ class BaseWorker(Process):
         self._want_host = host or self.LOCALHOST
         self._want_port = port or 0
         self._sock = None
-        self._caller = None
+        self._per_thread = threading.local()
         self._caller_lock = threading.Lock()
-        self._client = None
-        self._client_args = None
-        self._client_addrinfo = None
-        self._client_peeked = None
-        self._client_method = None
-        self._client_access = None
-        self._client_headers = None
+        self._thread_pool = None
+        self._concurrent = 0
+        self._concurrent_cond = threading.Condition()
+        self._ka_wanted = {}
+        self._msgpack_ok = set()
+        self._shared_ok = set()
+        self._shared_values = None
+        self._ka_parked = []
+        self._ka_lock = threading.Lock()
+        self._ka_wake = None
+        self._conn_pool = []
+        self._conn_pool_pid = None
+        self._conn_pool_lock = threading.Lock()
         self._background_jobs = {'default': []}
         self._background_threads = {}
         self._background_job_lock = threading.Lock()
@@ -260,57 +342,226 @@ class BaseWorker(Process):
         last_active = time.time()
         next_tick = int(last_active + self.TICK_T)
         self._sock.settimeout(self.IDLE_T)
-        while self.keep_running:
-            client = None
-            now = int(time.time())
-            if now >= next_tick:
-                next_tick += (1 + (now-next_tick) // self.TICK_T) * self.TICK_T
-                self.on_tick()
+
+        selector = selectors.DefaultSelector()
+        selector.register(self._sock, selectors.EVENT_READ)
+        wake_r, self._ka_wake = socket.socketpair()
+        wake_r.setblocking(False)
+        selector.register(wake_r, selectors.EVENT_READ)
+        idle = {}
+        if self.THREADED:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.THREAD_POOL_SIZE,
+                thread_name_prefix=self.name)
+        try:
+            while self.keep_running:
+                now = int(time.time())
+                if now >= next_tick:
+                    next_tick += (1 + (now-next_tick) // self.TICK_T) * self.TICK_T
+                    self.on_tick()
+
+                self._ka_watch(selector, idle)
+                events = selector.select(
+                    timeout=min(self.IDLE_T, self.KEEP_ALIVE_TIMEOUT))
+                if not events:
+                    self.on_idle(last_active)
+                    continue
+
+                for key, mask in events:
+                    if key.fileobj is wake_r:
+                        try:
+                            wake_r.recv(self.PEEK_BYTES)
+                        except OSError:
+                            pass
+                        continue
+                    if key.fileobj is self._sock:
+                        try:
+                            (client, c_addrinfo) = self._sock.accept()
+                        except (socket.timeout, OSError):
+                            continue
+                    else:
+                        client = key.fileobj
+                        selector.unregister(client)
+                        c_addrinfo = idle.pop(client)[1]
+                    last_active = time.time()
+                    self._handle_connection(client, c_addrinfo)
+                    if not self.keep_running:
+                        break
+        finally:
+            if self._thread_pool is not None:
+                self._thread_pool.shutdown(wait=True)
+                self._thread_pool = None
+            if self._shared_values is not None:
+                self._shared_values.close()
+            for client in list(idle) + [c for c, a in self._ka_parked]:
+                client.close()
+            selector.close()
+            wake_r.close()
+            self._ka_wake.close()
+            self._ka_wake = None
+
+    def _ka_watch(self, selector, idle):
+        # Start watching connections which were kept alive, and hang up
+        # on the ones that have been idle too long (or if we have too many).
+        now = time.time()
+        with self._ka_lock:
+            parked, self._ka_parked = self._ka_parked, []
+        for client, c_addrinfo in parked:
             try:
-                (client, c_addrinfo) = self._sock.accept()
-                last_active = time.time()
-                peeked = client.recv(self.PEEK_BYTES, socket.MSG_PEEK)
-                if ((peeked[:4] in self.METHODS) and (b'\r\n\r\n' in peeked)):
-                    try:
-                        method, path = peeked.split(b' ', 2)[:2]
-                        secret, args = path.split(b'/', 2)[1:3]
-                    except ValueError:
-                        secret, args = b'', None
-                    access = self._check_access(secret, args)
-                    if access:
-                        self._client, client = client, None
-                        self._client_addrinfo = c_addrinfo
-                        self._client_peeked = peeked
-                        self._client_method = method
-                        self._client_access = access
-                        self._client_args = args
-                        self._client_headers = None
-                        self.handler(str(method, 'latin-1'), args)
+                selector.register(client, selectors.EVENT_READ)
+                idle[client] = (now, c_addrinfo)
+            except (ValueError, OSError):
+                client.close()
+        expired = sorted(idle, key=lambda c: idle[c][0])
+        expired = (expired[:-self.KEEP_ALIVE_MAX]
+            + [c for c in expired[-self.KEEP_ALIVE_MAX:]
+               if idle[c][0] < now - self.KEEP_ALIVE_TIMEOUT])
+        for client in expired:
+            selector.unregister(client)
+            del idle[client]
+            client.close()
+
+    def _ka_park(self, client, c_addrinfo):
+        with self._ka_lock:
+            self._ka_parked.append((client, c_addrinfo))
+        self._wake()
+
+    def _wake(self):
+        # Interrupt the main loop's select(), from another thread
+        if self._ka_wake is not None:
+            try:
+                self._ka_wake.send(b'!')
+            except OSError:
+                pass
+
+    def _ka_discard(self, client, unread):
+        # Skip past any request body the handler did not read, so the
+        # connection is ready for the next request.
+        try:
+            while unread > 0:
+                chunk = client.recv(min(unread, self.READ_BYTES))
+                if not chunk:
+                    return False
+                unread -= len(chunk)
+            return True
+        except OSError:
+            return False
+
+    def _handle_connection(self, client, c_addrinfo):
+        try:
+            peeked = client.recv(self.PEEK_BYTES, socket.MSG_PEEK)
+            if not peeked:
+                # The caller hung up on a kept-alive connection
+                pass
+            elif ((peeked[:4] in self.METHODS) and (b'\r\n\r\n' in peeked)):
+                try:
+                    method, path = peeked.split(b' ', 2)[:2]
+                    secret, args = path.split(b'/', 2)[1:3]
+                except ValueError:
+                    secret, args = b'', None
+                access = self._check_access(secret, args)
+                if access:
+                    hdr = peeked.split(b'\r\n\r\n', 1)[0]
+                    keep_alive = (self.KEEP_ALIVE
+                        and (b'\r\n' + self.HTTP_KEEP_ALIVE) in (hdr + b'\r\n'))
+                    if keep_alive:
+                        # Track how much of the request body is unread
+                        self._ka_wanted[client] = int(self.parse_header(hdr)
+                            .get('Content-Length', 0))
+                    if (keep_alive and self.BINARY_RPC and
+                            (b'\r\n' + self.HTTP_ACCEPT_MSGPACK) in hdr):
+                        self._msgpack_ok.add(client)
+                    else:
+                        self._msgpack_ok.discard(client)
+                    if (keep_alive and self.SHARED_MEMORY
+                            and (c_addrinfo[0] in self.LOCAL_ADDRS)
+                            and (b'\r\n' + self.HTTP_ACCEPT_SHARED) in hdr):
+                        self._shared_ok.add(client)
+                    else:
+                        self._shared_ok.discard(client)
+
+                    request = (client, c_addrinfo,
+                        peeked, method, access, args, keep_alive)
+                    client = None
+                    fn = args.split(b'?', 1)[0].split(b'/', 1)[0]
+                    if ((self._thread_pool is not None)
+                            and (fn in self.CONCURRENT_FUNCTIONS)):
+                        self._concurrent_begin()
+                        self._thread_pool.submit(
+                            self._handle_request, request, concurrent=True)
                     else:
-                        logging.debug(
-                            'Invalid secret (for %s): %s' % (args, secret))
-                        self.status['requests_ignored'] += 1
-                        client.send(
-                            (secret and self.HTTP_403 or self.HTTP_400) +
-                            bytes(self.unique_app_id, 'utf-8'))
+                        self._concurrent_wait()
+                        self._handle_request(request)
                 else:
-                    logging.warning('Bad method or data: %s' % peeked[:20])
+                    logging.debug(
+                        'Invalid secret (for %s): %s' % (args, secret))
                     self.status['requests_ignored'] += 1
-                    client.send(self.HTTP_400)
-            except socket.timeout:
-                self.on_idle(last_active)
-            except OSError:
-                pass
-            except (QuitException, KeyboardInterrupt):
-                self.keep_running = False
-            except:
-                logging.exception('Error in main HTTP loop')
-                self.status['requests_failed'] += 1
-                if client:
-                    client.send(self.HTTP_500)
-            finally:
-                if client:
-                    client.close()
+                    client.send(
+                        (secret and self.HTTP_403 or self.HTTP_400) +
+                        bytes(self.unique_app_id, 'utf-8'))
+            else:
+                logging.warning('Bad method or data: %s' % peeked[:20])
+                self.status['requests_ignored'] += 1
+                client.send(self.HTTP_400)
+        except socket.timeout:
+            pass
+        except OSError:
+            pass
+        except (QuitException, KeyboardInterrupt):
+            self.keep_running = False
+        except:
+            logging.exception('Error in main HTTP loop')
+            self.status['requests_failed'] += 1
+            if client:
+                client.send(self.HTTP_500)
+        finally:
+            if client:
+                client.close()
+
+    def _concurrent_begin(self):
+        # Block until a thread is free, so requests queue up in the
+        # listen backlog instead of in memory.
+        with self._concurrent_cond:
+            while self._concurrent >= self.THREAD_POOL_SIZE:
+                self._concurrent_cond.wait()
+            self._concurrent += 1
+
+    def _concurrent_end(self):
+        with self._concurrent_cond:
+            self._concurrent -= 1
+            self._concurrent_cond.notify_all()
+
+    def _concurrent_wait(self):
+        with self._concurrent_cond:
+            while self._concurrent:
+                self._concurrent_cond.wait()
+
+    def _handle_request(self, request, concurrent=False):
+        (client, c_addrinfo,
+            peeked, method, access, args, keep_alive) = request
+        try:
+            self._client = client
+            self._client_addrinfo = c_addrinfo
+            self._client_peeked = peeked
+            self._client_method = method
+            self._client_access = access
+            self._client_args = args
+            self._client_headers = None
+            self._client_keep_alive = keep_alive
+            self.handler(str(method, 'latin-1'), args)
+        except (socket.timeout, OSError):
+            pass
+        except (QuitException, KeyboardInterrupt):
+            self.keep_running = False
+        except:
+            logging.exception('Error handling request')
+            self.status['requests_failed'] += 1
+        finally:
+            self._client = self._client_peeked = None
+            if concurrent:
+                self._concurrent_end()
+                if not self.keep_running:
+                    self._wake()
 
     def quit(self):
         self.keep_running = False
@@ -525,7 +776,18 @@ class BaseWorker(Process):
         return None
 
     def _call_return(self, hdr, data):
-        if b'application/json' in hdr:
+        if b'application/x-shared-memory' in hdr:
+            data = from_msgpack(read_shared(data.strip()))
+            if isinstance(data, dict) and 'exception' in data:
+                reraise(data)
+            return data
+        elif b'application/x-msgpack' in hdr:
+            if data:
+                data = from_msgpack(data)
+                if isinstance(data, dict) and 'exception' in data:
+                    reraise(data)
+            return data
+        elif b'application/json' in hdr:
             if data:
                 data = from_json(data)
                 if data and 'exception' in data:
@@ -537,6 +799,13 @@ class BaseWorker(Process):
     async def async_call(self, loop, fn, *args,
             qs=None, method='POST', upload=None, data_cb=None, hide_qs=False):
 
+        if self.KEEP_ALIVE and (data_cb is None):
+            remote, parts, path, ka_upload, packed = self._prep_call(
+                fn, args, qs, upload, hide_qs, binary=self.BINARY_RPC)
+            if not remote:
+                return await self._ka_async_call(
+                    loop, path, method, ka_upload, packed=packed)
+
         upload, (conn, conn_args, on_connect) = self.call(fn, *args,
             qs=qs, method=method, upload=upload, hide_qs=hide_qs,
             prep_only=True)
@@ -601,9 +870,173 @@ class BaseWorker(Process):
 
     # FIXME: We really would like this to be available as async, so
     #        we can multiplex things while our workers work.
-    def call(self, fn, *args,
-            qs=None, method='POST', upload=None, prep_only=False,
-            hide_qs=False):
+    def _pool_get(self):
+        with self._conn_pool_lock:
+            if self._conn_pool_pid != os.getpid():
+                # Connections inherited from a parent process are not ours
+                self._conn_pool = []
+                self._conn_pool_pid = os.getpid()
+            return self._conn_pool.pop() if self._conn_pool else None
+
+    def _pool_put(self, conn):
+        with self._conn_pool_lock:
+            if ((self._conn_pool_pid == os.getpid())
+                    and (len(self._conn_pool) < self.CONN_POOL_MAX)):
+                self._conn_pool.append(conn)
+                return
+        conn.close()
+
+    def _ka_request(self, path, method, upload, packed=False):
+        host, port, url_secret = self.url_parts
+        if url_secret[-1:] != '/':
+            url_secret += '/'
+        upload = upload or b''
+        more = str(self.HTTP_KEEP_ALIVE, 'latin-1')
+        if self.BINARY_RPC:
+            more += str(self.HTTP_ACCEPT_MSGPACK, 'latin-1')
+        if self.SHARED_MEMORY and (host in self.LOCAL_ADDRS + ('localhost',)):
+            more += str(self.HTTP_ACCEPT_SHARED, 'latin-1')
+        if packed:
+            more += 'Content-Type: application/x-msgpack\r\n'
+        return (('%s /%s HTTP/1.0\r\nHost: %s\r\n%s%sContent-Length: %d\r\n\r\n'
+            ) % (method, (url_secret + path).lstrip('/'), host,
+                 self._auth_header, more, len(upload))
+            ).encode('latin-1') + upload
+
+    def _ka_response_info(self, hdr):
+        headers = self.parse_header(hdr)
+        length = headers.get('Content-Length')
+        if (length is None) or (headers.get('Connection') != 'keep-alive'):
+            return None
+        return int(length)
+
+    def _ka_call(self, path, method, upload, timeout=60, packed=False):
+        """
+        Make an RPC call over a pooled, kept-alive connection. If a pooled
+        connection turns out to have been closed by the worker, we retry
+        once on a fresh one.
+        """
+        request = self._ka_request(path, method, upload, packed=packed)
+        for attempt in (1, 2):
+            conn = self._pool_get() if (attempt == 1) else None
+            reused = (conn is not None)
+            try:
+                if conn is None:
+                    conn = socket.create_connection(
+                        (self.url_parts[0], int(self.url_parts[1])),
+                        timeout=max(1, timeout//30))
+                conn.settimeout(timeout)
+                conn.sendall(request)
+                peeked = conn.recv(self.PEEK_BYTES, socket.MSG_PEEK)
+            except socket.timeout:
+                logging.warning('TIMED OUT: %s' % (path,))
+                if conn:
+                    conn.close()
+                raise
+            except OSError:
+                if conn:
+                    conn.close()
+                if reused:
+                    continue
+                raise
+            if reused and not peeked:
+                conn.close()
+                continue
+            break
+
+        if not (peeked.startswith(self.HTTP_200)
+                or peeked.startswith(self.HTTP_424)):
+            conn.close()
+            raise PermissionError(str(peeked[:12], 'latin-1'))
+
+        hdr = peeked.split(b'\r\n\r\n', 1)[0]
+        conn.recv(len(hdr) + 4)
+        if not any(ct in hdr for ct in self.KA_CONTENT_TYPES):
+            return (hdr, conn.makefile(mode='rb'))
+
+        length = self._ka_response_info(hdr)
+        if length is None:
+            with conn.makefile(mode='rb') as fd:
+                data = fd.read()
+            conn.close()
+        else:
+            data = []
+            want = length
+            while want > 0:
+                chunk = conn.recv(min(want, self.READ_BYTES))
+                if not chunk:
+                    break
+                data.append(chunk)
+                want -= len(chunk)
+            data = b''.join(data)
+            if want:
+                conn.close()
+            else:
+                self._pool_put(conn)
+        return self._call_return(hdr, data)
+
+    async def _ka_async_call(self, loop, path, method, upload, packed=False):
+        request = self._ka_request(path, method, upload, packed=packed)
+        for attempt in (1, 2):
+            conn = self._pool_get() if (attempt == 1) else None
+            reused = (conn is not None)
+            try:
+                if conn is None:
+                    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    conn.setblocking(False)
+                    await loop.sock_connect(conn,
+                        (self.url_parts[0], int(self.url_parts[1])))
+                else:
+                    conn.setblocking(False)
+                await loop.sock_sendall(conn, request)
+                data = await loop.sock_recv(conn, self.PEEK_BYTES)
+            except OSError:
+                conn.close()
+                if reused:
+                    continue
+                raise
+            if reused and not data:
+                conn.close()
+                continue
+            break
+
+        try:
+            while data and (b'\r\n\r\n' not in data):
+                chunk = await loop.sock_recv(conn, self.READ_BYTES)
+                if not chunk:
+                    break
+                data += chunk
+        except:
+            conn.close()
+            raise
+
+        if not (data.startswith(self.HTTP_200)
+                or data.startswith(self.HTTP_424)):
+            conn.close()
+            # FIXME: Parse the HTTP response code and raise better exceptions
+            raise PermissionError(str(data[:12], 'latin-1'))
+
+        hdr, data = data.split(b'\r\n\r\n', 1)
+        length = self._ka_response_info(hdr)
+        data = [data]
+        got = len(data[0])
+        try:
+            while (length is None) or (got < length):
+                chunk = await loop.sock_recv(conn, self.READ_BYTES)
+                if not chunk:
+                    break
+                data.append(chunk)
+                got += len(chunk)
+        except:
+            conn.close()
+            raise
+        if (length is not None) and (got == length):
+            self._pool_put(conn)
+        else:
+            conn.close()
+        return self._call_return(hdr, b''.join(data))
+
+    def _prep_call(self, fn, args, qs, upload, hide_qs, binary=False):
         fn = fn.encode('latin-1') if isinstance(fn, str) else fn
         remote = fn[:6] in (b'http:/', b'https:')
         if remote:
@@ -619,6 +1052,11 @@ class BaseWorker(Process):
 
         # Format positional arguments and query string
         args = [caller] + list(args)
+        if binary and (not remote) and argdecode and (upload is None):
+            # Send everything as a msgpack POST body, no URL encoding
+            upload = to_msgpack([args, qs or {}], json_keys=False)
+            return remote, None, fn + '/*', upload, True
+
         if args:
             path += ('/' + '/'.join([dumb_encode_asc(a) for a in args]))
         if qs:
@@ -632,6 +1070,18 @@ class BaseWorker(Process):
             else:
                 raise ValueError('Too many arguments')
 
+        return remote, (parts if remote else None), path, upload, False
+
+    def call(self, fn, *args,
+            qs=None, method='POST', upload=None, prep_only=False,
+            hide_qs=False):
+        ka = self.KEEP_ALIVE and not prep_only
+        remote, parts, path, upload, packed = self._prep_call(
+            fn, args, qs, upload, hide_qs, binary=(ka and self.BINARY_RPC))
+
+        if ka and not remote:
+            return self._ka_call(path, method, upload, packed=packed)
+
         if remote:
             parts[-1] = path
             conn_method = lambda **kw: http1x_connect(*parts, **kw)
@@ -698,14 +1148,23 @@ class BaseWorker(Process):
             client_info_tuple = self.client_info_tuple()
 
         caller, client, cli_ai, cli_args, cli_method = client_info_tuple
+        unread = self._ka_wanted.pop(client, None)
+        self._msgpack_ok.discard(client)
+        self._shared_ok.discard(client)
+        keep_alive = ((unread is not None) and close and data
+            and any(ct in pre for ct in self.KA_CONTENT_TYPES))
         if data:
+            if keep_alive:
+                pre += self.HTTP_KEEP_ALIVE
             pre += b'Content-Length: %d\r\n\r\n' % len(data)
-            client.send(pre + data)
+            client.sendall(pre + data)
             data_len = b'%d' % (len(pre) + len(data))
         else:
             client.send(pre)
             data_len = b'%d' % len(pre)
-        if close:
+        if keep_alive and self._ka_discard(client, unread):
+            self._ka_park(client, cli_ai)
+        elif close:
             client.close()
         else:
             data_len = b'..'
@@ -727,6 +1186,51 @@ class BaseWorker(Process):
             close=False)
         return self._client
 
+    def replying_msgpack(self, client_info_tuple=None):
+        """
+        Returns True if the reply to the current (or given) request will be
+        msgpack encoded, instead of JSON.
+        """
+        if client_info_tuple is None:
+            client_info_tuple = self.client_info_tuple()
+        return (client_info_tuple[1] in self._msgpack_ok)
+
+    def replying_shared(self, client_info_tuple=None):
+        """
+        Returns True if the caller is local and can accept shared memory
+        references in the reply to the current (or given) request.
+        """
+        if client_info_tuple is None:
+            client_info_tuple = self.client_info_tuple()
+        return (client_info_tuple[1] in self._shared_ok)
+
+    def share(self, data):
+        """
+        Place data in shared memory, returning a reference which can be
+        passed to other local processes. These live until they expire.
+        """
+        if self._shared_values is None:
+            self._shared_values = SharedValues()
+        return self._shared_values.share(data)
+
+    def dumb_encode(self, v,
+            compress=False, client_info_tuple=None, share=False):
+        """
+        Encode a value for inclusion in an RPC reply: raw bytes if we are
+        replying with msgpack, an ASCII string otherwise. Either way, the
+        recipient should use dumb_decode() to decode.
+
+        If share is True, large values may be sent to local callers
+        as a shared memory reference instead.
+        """
+        if share and self.replying_shared(client_info_tuple):
+            encoded = dumb_encode_bin(v)
+            if len(encoded) >= self.SHARED_MIN_BYTES:
+                return self.share(encoded)
+        if self.replying_msgpack(client_info_tuple):
+            return dumb_encode_bin(v, compress=compress)
+        return dumb_encode_asc(v, compress=compress)
+
     def reply_json(self, data, client_info_tuple=None, http_code=None):
         if isinstance(data, dict):
             if client_info_tuple and client_info_tuple[0]:
@@ -734,13 +1238,26 @@ class BaseWorker(Process):
             elif self._caller:
                 data['_caller'] = self._caller
         http_code = self.HTTP_200 if (http_code is None) else http_code
+        if self.replying_msgpack(client_info_tuple):
+            try:
+                data = to_msgpack(data)
+            except (TypeError, ValueError, OverflowError):
+                pass  # Fall back to JSON, it copes with big ints
+            else:
+                if ((len(data) >= self.SHARED_MIN_BYTES)
+                        and self.replying_shared(client_info_tuple)):
+                    return self.reply(http_code + self.HTTP_SHARED,
+                        self.share(data).encode('latin-1'),
+                        client_info_tuple=client_info_tuple)
+                return self.reply(http_code + self.HTTP_MSGPACK, data,
+                    client_info_tuple=client_info_tuple)
         self.reply(http_code + self.HTTP_JSON,
             to_json(data).encode('utf-8') + b'\n',
             client_info_tuple=client_info_tuple)
 
     def parse_header(self, hdr):
         hdr_lines = str(hdr, 'latin-1').replace('\r', '').splitlines()
-        return dict([ln.split(': ') for ln in hdr_lines[1:]])
+        return dict([ln.split(': ', 1) for ln in hdr_lines[1:] if ': ' in ln])
 
     def request_headers(self):
         if not self._client_headers:
@@ -749,13 +1266,26 @@ class BaseWorker(Process):
         return self._client_headers
 
     def get_upload_size_and_fd(self):
+        # The file object may read ahead, so this connection cannot be reused
+        self._ka_wanted.pop(self._client, None)
         return (
             int(self.request_headers().get('Content-Length', 0)),
             self._client.makefile('rb'))
 
     def get_uploaded_data(self):
-        ln, fd = self.get_upload_size_and_fd()
-        return fd.read(ln)
+        # Read exactly Content-Length bytes; on a kept-alive connection
+        # there may be another request right behind this one.
+        ln = int(self.request_headers().get('Content-Length', 0))
+        if self._client in self._ka_wanted:
+            self._ka_wanted[self._client] = 0
+        data = []
+        while ln > 0:
+            chunk = self._client.recv(min(ln, self.READ_BYTES))
+            if not chunk:
+                break
+            data.append(chunk)
+            ln -= len(chunk)
+        return b''.join(data)
 
     def decode_args(self, args):
         return [dumb_decode(a) for a in args]
@@ -767,19 +1297,25 @@ class BaseWorker(Process):
 
         def prep(method):
             kwargs = {}
-            if method == 'POST':
+            if method == 'POST' or self._client_keep_alive:
+                # Only consume the header, anything after it belongs to
+                # the request body (or the next request).
                 hdr = self._client_peeked.split(b'\r\n\r\n')[0]
                 self._client.recv(len(hdr) + 4)
-                kwargs['method'] = method
             else:
                 self._client.recv(len(self._client_peeked))
+            if method == 'POST':
+                kwargs['method'] = method
             return kwargs
 
         qs_pairs = _qsp(a_and_q[1]) if (len(a_and_q) > 1) else []
+        packed = (self.BINARY_RPC and (self.request_headers()
+            .get('Content-Type') == 'application/x-msgpack'))
         return self.common_rpc_handler(fn,
              method, args, qs_pairs,
              prep,
-             self.get_uploaded_data)
+             self.get_uploaded_data,
+             packed=packed)
 
     # FIXME: This duplicates the code below almost completely, it would
     #        be nice to refactor and avoid that...
@@ -854,7 +1390,7 @@ class BaseWorker(Process):
             async_reply(self.HTTP_404)
 
     def common_rpc_handler(self,
-            fn, method, args, qs_pairs, prep, uploaded):
+            fn, method, args, qs_pairs, prep, uploaded, packed=False):
         t0 = time.time()
         kwargs = None
         argdecode_and_func = self.functions.get(fn)
@@ -865,20 +1401,32 @@ class BaseWorker(Process):
                 kwargs = prep(method)
 
                 # Support arbitrarily large arguments, via POST
+                packed = packed and argdecode
                 if method == 'POST' and (len(args) == 1) and (args[0] == b'*'):
                     posted = uploaded()
-                    a_and_q = posted.split(b'?', 1)
-                    args = a_and_q[0][len(fn):].split(b'/')[1:]
-                    qs_pairs = _qsp(a_and_q[1]) if (len(a_and_q) > 1) else []
+                    if packed:
+                        args, qs = from_msgpack(posted)
+                        kwargs.update(qs)
+                        qs_pairs = []
+                    else:
+                        a_and_q = posted.split(b'?', 1)
+                        args = a_and_q[0][len(fn):].split(b'/')[1:]
+                        qs_pairs = (
+                            _qsp(a_and_q[1]) if (len(a_and_q) > 1) else [])
                     del kwargs['method']
+                else:
+                    packed = False
 
                 kwargs.update(dict(
                     (str(p[0], 'latin-1'), dumb_decode(p[1]))
                     for p in qs_pairs))
 
-                self._caller = dumb_decode(args.pop(0)) if args else None
-                if argdecode:
-                    args = [dumb_decode(a) for a in args]
+                if packed:
+                    self._caller = args.pop(0) if args else None
+                else:
+                    self._caller = dumb_decode(args.pop(0)) if args else None
+                    if argdecode:
+                        args = [dumb_decode(a) for a in args]
                 rv = func(*args, **kwargs)
 
                 t = 1000 * (time.time() - t0)
@@ -1156,7 +1704,12 @@ if __name__ == '__main__':
         def __init__(self, *args, **kwargs):
             BaseWorker.__init__(self, *args, **kwargs)
             self.functions.update({
-                b'ping': (None, self.api_ping)})
+                b'ping': (None, self.api_ping),
+                b'text': (None, self.api_text)})
+
+        def api_text(self, *args, **kwargs):
+            self.reply(self.HTTP_200 + b'Content-Type: text/plain\r\n',
+                b'Hello world\n')
 
         def api_ping(self, *args, pong='PONG', method='GET'):
             args = self.decode_args(args)
@@ -1189,6 +1742,13 @@ if __name__ == '__main__':
             except ValueError:
                 pass
 
+            # Non-JSON replies are read until EOF, so must not keep-alive
+            t0 = time.time()
+            hdr, fd = tw.call('text')
+            assert(fd.read() == b'Hello world\n')
+            assert(time.time() - t0 < 1)
+            assert(tw.call('ping')['PONG'] == [])
+
             print('** Tests passed, waiting... **')
             tw.join()
         finally:
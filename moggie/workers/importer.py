@@ -4,35 +4,64 @@
 #    instead of implictly on del_results.
 #  - Add some flags/args for skipping filters etc. This will have to be
 #    implemented using/consulting tags in addition to in:_mp_incoming.
-#  - Make it possible to set a cap on memory usage; we get more efficient
-#    (faster) imports by batching lots of mail together, but there need to
-#    be limits here when running on smaller devices. It appears using a
-#    BATCH_SIZE_FULL of 50k messages results in about half a GIG of RAM
-#    getting consumed. What happens if we check resources.getrusage()?
-#    And os.sysconf?  Or use psutil?
 #
-# https://stackoverflow.com/questions/938733/total-memory-used-by-python-process
-# https://stackoverflow.com/questions/22102999/get-total-physical-memory-in-python
+# Memory use: we get more efficient (faster) imports by batching lots of
+# mail together, but there need to be limits when running on smaller
+# devices; a BATCH_SIZE_FULL of 50k messages consumes about half a GIG of
+# RAM. So batches are sized based on a memory budget (the App setting
+# `import_memory_mb`, default is a fraction of physical RAM) and how much
+# we are actually using (our RSS). If we go over budget, accumulated
+# keywords get spilled to a temporary file on disk, which the keyword
+# loop then streams to the search engine.
+#
+# Parsing: extracting keywords is CPU bound, so unless configured not to
+# (the App setting `import_parsers`, 0 disables), messages are parsed by a
+# pool of helper processes, one per spare core.
 #
 import asyncio
 import base64
 import logging
+import multiprocessing
 import os
 import random
+import struct
+import tempfile
 import time
 import traceback
 import threading
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 from .base import BaseWorker
 from ..api.requests import *
-from ..util.dumbcode import dumb_encode_asc, dumb_decode
+from ..util.dumbcode import dumb_encode_asc, dumb_encode_bin, dumb_decode
 from ..util.intset import IntSet
+from ..util.memory import rss_bytes, memory_budget
 from ..storage.files import FileStorage
 from ..search.extractor import KeywordExtractor
 from ..search.filters import FilterEngine, FilterError
 from ..app.cli.email import CommandParse
 
 
+_PARSER_LOOP = None
+
+def _parse_for_import(email, metadata, settings, allow_network):
+    """
+    Parse an e-mail for indexing, returning the parse result and the
+    (possibly updated) metadata. This runs in the parser pool.
+    """
+    global _PARSER_LOOP
+    if _PARSER_LOOP is None:
+        _PARSER_LOOP = asyncio.new_event_loop()
+        asyncio.set_event_loop(_PARSER_LOOP)
+    result = _PARSER_LOOP.run_until_complete(CommandParse.Parse(None, email,
+        metadata=metadata,
+        settings=settings,
+        allow_network=allow_network))
+    return result['parsed'], metadata
+
+
 class ImportWorker(BaseWorker):
     """
     """
@@ -42,6 +71,15 @@ class ImportWorker(BaseWorker):
 
     BATCH_SIZE = 5000
     BATCH_SIZE_FULL = 50000
+    BATCH_SIZE_FULL_MAX = 250000
+
+    BYTES_PER_EMAIL = 10 * 1024   # Initial guess, updated as we go
+    SPILL_MIN_POSTINGS = 100000
+    SPILL_CHUNK = struct.Struct('>BI')
+
+    PARSERS_MAX = 8
+    PARSER_QUEUE = 4  # Messages in flight, per parser
+    AUTOTAG_BATCH = 1000
 
     TICK_T = 300
     IDLE_T = 15
@@ -52,6 +90,8 @@ class ImportWorker(BaseWorker):
             search_worker=None,
             metadata_worker=None,
             notify=None,
+            memory_mb=None,
+            parsers=None,
             name=KIND,
             log_level=logging.ERROR):
 
@@ -63,11 +103,6 @@ class ImportWorker(BaseWorker):
             b'autotag_classify': (True, self.api_autotag_classify),
             b'import_search': (True, self.api_import_search)})
 
-        self.filters = FilterEngine()  # FIXME: add moggie, encryption keys?
-        self.filters.load(
-            os.path.normpath(os.path.join(status_dir, '..', 'filters')),
-            quick=False, create=True)
-
         self.fs = fs_worker
         self.app = app_worker
         self.search = search_worker
@@ -82,20 +117,53 @@ class ImportWorker(BaseWorker):
         self.keyword_batch_no = 0
         self.keyword_thread = None
         self.keywords = {}
+        self.keyword_postings = 0
+        self.keyword_cap = None
+        self.keyword_spills = []
         self.annotations = {}
 
+        self.memory_budget = memory_budget(memory_mb)
+        self.bytes_per_email = self.BYTES_PER_EMAIL
+
+        # FIXME: add moggie, encryption keys?
+        self.filters = FilterEngine(obfuscated_bytes=min(
+            FilterEngine.OBFUSCATED_BYTES, self.memory_budget // 32))
+        self.filters.load(
+            os.path.normpath(os.path.join(status_dir, '..', 'filters')),
+            quick=False, create=True)
+
         self.parser_settings = CommandParse.Settings(with_keywords=True)
         self.parser_settings.with_openpgp = False
         self.allow_network = True  # FIXME: Make configurable?
 
+        if parsers in (None, ''):
+            parsers = min(self.PARSERS_MAX, (os.cpu_count() or 1) - 1)
+        self.parsers = max(0, int(parsers))
+        self.parser_pool = None
+
         assert(self.fs and self.search)
 
     def run(self, *args, **kwargs):
         for thing in (self.fs, self.app, self.search, self.metadata):
             if hasattr(thing, 'forked'):
                 thing.forked()
-
-        return super().run(*args, **kwargs)
+        try:
+            return super().run(*args, **kwargs)
+        finally:
+            if self.parser_pool is not None:
+                self.parser_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _get_parser_pool(self):
+        if self.parsers and self.parser_pool is None:
+            # Our process has threads, so avoid fork() if we can
+            methods = multiprocessing.get_all_start_methods()
+            method = 'forkserver' if ('forkserver' in methods) else 'spawn'
+            self.parser_pool = ProcessPoolExecutor(
+                max_workers=self.parsers,
+                mp_context=multiprocessing.get_context(method))
+            logging.info('[import] Started %d parser processes (%s)'
+                % (self.parsers, method))
+        return self.parser_pool
 
     def get_app(self):
         if self.app is None:
@@ -239,30 +307,47 @@ class ImportWorker(BaseWorker):
             unloadable = checked = tagged = untagged = 0
             moggie_parse, moggie_parse_async = self._mk_parsers()
             res = self.metadata.metadata(hits, tags=None, threads=False)
+
+            # Messages are classified in batches, against all the taggers
+            # at once; this is much faster than one at a time.
+            batch_idxs, batch_kws = [], []
+            def _classify_batch():
+                nonlocal tagged, untagged
+                ranks = self.filters.classify_many(
+                    [at.tag for at in autotaggers], batch_kws)
+                for at in autotaggers:
+                    for idx, rank in zip(batch_idxs, ranks[at.tag]):
+                        if rank > at.threshold:
+                            add_tags.setdefault(at.tag, []).append(idx)
+                            tagged += 1
+                        else:
+                            rm_tags.setdefault(at.tag, []).append(idx)
+                            untagged += 1
+                batch_idxs[:] = []
+                batch_kws[:] = []
+
             for md in res['metadata']:
                 try:
                     eml = self._get_email(md)
                     if eml:
                         checked += 1
                         kws = moggie_parse(eml, md)['parsed']['_KEYWORDS']
-                        for at in autotaggers:
-                            if at.classify(kws) > at.threshold:
-                                t = add_tags[at.tag] = add_tags.get(at.tag, [])
-                                t.append(md.idx)
-                                tagged += 1
-                            else:
-                                u = rm_tags[at.tag] = rm_tags.get(at.tag, [])
-                                u.append(md.idx)
-                                untagged += 1
+                        batch_idxs.append(md.idx)
+                        batch_kws.append(kws)
                     else:
                         unloadable += 1
                 except:
                     unloadable += 1
                     logging.exception('[autotag] Failed to parse %d' % md.idx)
+                if len(batch_idxs) >= self.AUTOTAG_BATCH:
+                    _classify_batch()
+            if batch_idxs:
+                _classify_batch()
             msg = ('Checked %d messages (%d failed), add/remove %d/%d tags.'
                 % (checked, unloadable, tagged, untagged))
             logging.info('[autotag] ' + msg)
             results.append(msg)
+            self.filters.release_caches()
 
         tagops = []
         tagops.extend(
@@ -291,7 +376,7 @@ class ImportWorker(BaseWorker):
             auto = False
             logging.debug(
                 '[autotag] Requested training for %s using "%s" (%d hits)'
-                % (tags, result['terms'], sum(1 for hit in all_hits)))
+                % (tags, result['terms'], all_hits.count()))
         else:
             auto = True
             result = all_hits = None
@@ -399,6 +484,7 @@ class ImportWorker(BaseWorker):
                 autotagger.compact()
             self.filters.save_autotagger(tag)
 
+        self.filters.release_caches()
         self.reply_json(results)
 
     def api_autotag_classify(self, tag_ns, tags, keywords, **kwargs):
@@ -479,13 +565,16 @@ class ImportWorker(BaseWorker):
         while self.keep_running:
             self.progress['kw'] = ''
             time.sleep(0.25)
-            if not (self.keywords or self.keyword_batches or self.annotations):
+            if not (self.keywords or self.keyword_batches or self.annotations
+                    or self.keyword_spills):
                 logging.debug('[import] keyword loop: exiting')
                 return
 
             logging.debug(
-                '[import] keyword loop: Looping (keywords=%d, annotations=%d)'
-                % (len(self.keywords), len(self.annotations)))
+                '[import] keyword loop: Looping (keywords=%d, annotations=%d,'
+                ' spills=%d)' % (
+                    len(self.keywords), len(self.annotations),
+                    len(self.keyword_spills)))
 
             # Annotate messages
             for msg_idx in list(self.annotations.keys()):
@@ -509,6 +598,7 @@ class ImportWorker(BaseWorker):
                     ('tags', True, 'in:'), ('rare keywords', False, ''),
                     ('tags', True, 'in:'), ('rare keywords', False, ''),
                     ('common keywords', False, '')):
+                spills = []
                 with self.lock:
                     keywords = self.keywords
                     batch = [k for k in keywords if k.startswith(prefix)]
@@ -517,19 +607,29 @@ class ImportWorker(BaseWorker):
                         pass
                     elif what == 'common keywords':
                         self.keyword_batch_no += 1
+                        spills, self.keyword_spills = self.keyword_spills, []
                     else:
                         batch = [k for k in batch if len(keywords[k]) < 3]
 
+                # Anything spilled to disk must reach the index before we
+                # mark batches as complete.
+                for spill in spills:
+                    self._unspill_keywords(spill)
+                    if not self.keep_running:
+                        logging.debug('[import] keyword loop: exiting early')
+                        return
+
                 pairs, pc, kc = [], 0, 0
                 for i, kw in enumerate(sorted(batch)):
                     last_kw = (i == (len(batch)-1))
 
                     with self.lock:
-                        idxs = keywords[kw]
-                        pairs.append([idxs, kw])
-                        del keywords[kw]
+                        idxs = keywords.pop(kw, None)
+                        if idxs:
+                            pairs.append([idxs, kw])
+                            self.keyword_postings -= len(idxs)
 
-                    pc += len(idxs)
+                    pc += len(idxs or [])
                     kc += 1
 
                     if last_kw or (pc >= 25000) or (len(pairs) >= 150):
@@ -538,7 +638,9 @@ class ImportWorker(BaseWorker):
                             (100 * kc) // len(batch),
                             kc, len(batch)))
 
-                        self.search.add_results(pairs, wait=True, touch=touch)
+                        if pairs:
+                            self.search.add_results(
+                                pairs, wait=True, touch=touch)
                         pairs, pc = [], 0
 
                         if int(time.time()) > ntime:
@@ -552,7 +654,7 @@ class ImportWorker(BaseWorker):
 
             self.progress['kw'] = ''
             with self.lock:
-                if self.keywords:
+                if self.keywords or self.keyword_spills:
                     done_no = self.keyword_batch_no
                     _all = self.keyword_batches
                     done = [batch for batch in _all if batch[0] < done_no]
@@ -572,6 +674,98 @@ class ImportWorker(BaseWorker):
             # 6. Report progress
             self._notify_progress(self.progress)
 
+    def _spill_keywords(self):
+        """
+        Move all accumulated keywords out of RAM, to a temporary file
+        which the keyword loop will stream to the search engine.
+
+        This holds the lock while writing, so the keyword loop cannot
+        mark batches as complete while their keywords are in limbo.
+        """
+        with self.lock:
+            if not self.keywords:
+                return
+            spill = tempfile.TemporaryFile(
+                dir=self.status_dir, prefix='import-spill-')
+            try:
+                for touch, prefix in ((1, 'in:'), (0, '')):
+                    batch = sorted(k for k in self.keywords
+                        if k.startswith(prefix))
+                    pairs, pc = [], 0
+                    for i, kw in enumerate(batch):
+                        idxs = self.keywords.pop(kw)
+                        pairs.append([idxs, kw])
+                        pc += len(idxs)
+                        if (i == len(batch)-1) or (pc >= 25000) or (
+                                len(pairs) >= 150):
+                            data = dumb_encode_bin(pairs, compress=None)
+                            spill.write(self.SPILL_CHUNK.pack(touch, len(data)))
+                            spill.write(data)
+                            pairs, pc = [], 0
+                spill.flush()
+            except:
+                spill.close()
+                raise
+            logging.info(
+                '[import] Spilled %d keyword postings to disk (%d bytes)'
+                % (self.keyword_postings, spill.tell()))
+            self.keyword_postings = 0
+            self.keyword_spills.append(spill)
+
+    def _unspill_keywords(self, spill):
+        with spill:
+            size, done = spill.tell(), 0
+            spill.seek(0)
+            while True:
+                header = spill.read(self.SPILL_CHUNK.size)
+                if not header:
+                    break
+                touch, length = self.SPILL_CHUNK.unpack(header)
+                pairs = dumb_decode(spill.read(length))
+                done += len(header) + length
+                self.progress['kw'] = 'spilled keywords %d%%, %d/%d' % (
+                    (100 * done) // size, done, size)
+                self.search.add_results(
+                    pairs, wait=True, touch=bool(touch))
+                if not self.keep_running:
+                    break
+
+    def _check_memory(self):
+        """
+        Spill keywords to disk if we are over our memory budget.
+
+        Python rarely returns memory to the OS, so once we have gone over
+        budget, our RSS will stay high. So we also remember how many
+        postings we had at that point, and keep spilling whenever we
+        accumulate that many again.
+        """
+        rss = rss_bytes()
+        with self.lock:
+            postings = self.keyword_postings
+            if rss > self.memory_budget:
+                if self.keyword_cap is None:
+                    self.keyword_cap = max(self.SPILL_MIN_POSTINGS, postings)
+                    logging.info(
+                        '[import] Over memory budget (%dMB > %dMB), capping'
+                        ' keywords at %d postings' % (
+                            rss // (1024 * 1024),
+                            self.memory_budget // (1024 * 1024),
+                            self.keyword_cap))
+            elif rss < (self.memory_budget * 3) // 4:
+                self.keyword_cap = None
+            spill = self.keyword_cap and (postings >= self.keyword_cap)
+        if spill:
+            self._spill_keywords()
+
+    def _full_batch_size(self):
+        """
+        Decide how many e-mails we can process in one go, based on our
+        memory budget and how much memory each e-mail seems to cost.
+        """
+        headroom = self.memory_budget - rss_bytes()
+        batch_size = headroom // max(1, self.bytes_per_email)
+        return max(self.BATCH_SIZE, min(self.BATCH_SIZE_FULL_MAX, batch_size))
+
     def _start_keyword_loop(self, after=None):
         with self.lock:
             if self.keyword_thread and self.keyword_thread.is_alive():
@@ -605,12 +799,15 @@ class ImportWorker(BaseWorker):
             return
 
         progress['emails_new'] = len(email_idxs)
-        email_idxs = email_idxs[:self.BATCH_SIZE_FULL]
+        email_idxs = email_idxs[:self._full_batch_size()]
         progress['pending'] += 1
+        rss0, spills0 = rss_bytes(), len(self.keyword_spills)
 
         ntime, bc, ec = int(time.time()), 0, 0
 
         moggie_parse, moggie_parse_async = self._mk_parsers()
+        parser_pool = self._get_parser_pool()
+        in_flight = max(25, self.parsers * self.PARSER_QUEUE)
         self.filters.load()
         message_batches = []
         for i in range(0, len(email_idxs), self.BATCH_SIZE):
@@ -639,7 +836,21 @@ class ImportWorker(BaseWorker):
 
                 # Parse the e-mail and extract keywords and annotations.
                 # This uses the same logic as `moggie parse`.
-                email = (await moggie_parse_async(email, md))['parsed']
+                nonlocal parser_pool
+                if parser_pool is not None:
+                    try:
+                        email, md = await loop.run_in_executor(parser_pool,
+                            _parse_for_import,
+                            email, md, self.parser_settings, self.allow_network)
+                    except BrokenProcessPool:
+                        logging.exception(
+                            '[import] Parser pool failed, parsing in-process')
+                        if self.parser_pool is parser_pool:
+                            self.parsers, self.parser_pool = 0, None
+                            parser_pool.shutdown(wait=False)
+                        parser_pool = None
+                if parser_pool is None:
+                    email = (await moggie_parse_async(email, md))['parsed']
                 kws = set(email['_KEYWORDS'])
 
                 # 3. Run the filtering logic to mutate keywords/tags/annotations
@@ -652,8 +863,10 @@ class ImportWorker(BaseWorker):
                             annotations.append(kw)
                         elif kw in self.keywords:
                             self.keywords[kw].append(md.idx)
+                            self.keyword_postings += 1
                         else:
                             self.keywords[kw] = [md.idx]
+                            self.keyword_postings += 1
                     if annotations:
                         self.annotations[md.idx] = annotations
 
@@ -677,7 +890,7 @@ class ImportWorker(BaseWorker):
 
                 task = loop.create_task(process_email(md, added))
                 tasks.append(task)
-                self._async_run(await_completed(tasks, 25))
+                self._async_run(await_completed(tasks, in_flight))
 
                 bc += 1
                 ec += 1
@@ -685,6 +898,7 @@ class ImportWorker(BaseWorker):
                     progress['pct'] = ('reading %d%%, %d/%d' % (
                         (100 * ec) // len(email_idxs), ec, len(email_idxs)))
                     bc = 0
+                    self._check_memory()
                     if int(time.time()) > ntime:
                         ntime = int(time.time())
                         self._notify_progress(progress)
@@ -701,6 +915,15 @@ class ImportWorker(BaseWorker):
                 self.keyword_batches.append(
                     (self.keyword_batch_no, incoming, added))
 
+        # Learn how much memory each e-mail costs us, unless spilling
+        # (or a small sample) would make the numbers meaningless.
+        rss1 = rss_bytes()
+        if (ec >= 1000) and (rss1 > rss0) and (
+                spills0 == len(self.keyword_spills) and not self.keyword_cap):
+            self.bytes_per_email = max(1024, (rss1 - rss0) // ec)
+            logging.debug('[import] Estimated %d bytes of RAM per e-mail'
+                % self.bytes_per_email)
+
         progress['pct'] = ''
         for i in range(0, 4 * 300):
             if ((not self.keyword_batches and len(self.keywords) < 50000)
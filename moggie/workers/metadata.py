@@ -1,10 +1,16 @@
 import copy
+import hashlib
 import logging
 import os
 import time
 import traceback
 import threading
 
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy
+
 if __name__ == '__main__':
     from .. import sys_path_helper
 
@@ -14,6 +20,126 @@ from ..util.intset import IntSet
 from .base import BaseWorker
 
 
+def _rank_keys(*columns):
+    """
+    Combine non-negative integer columns into a single int64 sort key,
+    ordering lexicographically by the first column, then the second, etc.
+    Falls back to a full lexsort if the combined key would overflow.
+    """
+    keys = numpy.zeros(len(columns[0]), dtype=numpy.int64)
+    span = 1
+    for col in columns:
+        c_span = (int(col.max()) + 1) if len(col) else 1
+        if span * c_span >= 2**62:
+            ranks = numpy.zeros(len(keys), dtype=numpy.int64)
+            ranks[numpy.lexsort(columns[::-1])] = numpy.arange(len(keys))
+            return ranks
+        keys = keys * c_span + col
+        span *= c_span
+    return keys
+
+
+def _tag_masks(idxs, tag_sets):
+    """
+    Gather membership of every id in idxs in every IntSet in tag_sets,
+    returning one row of packed bits (little-endian, one per tag) for
+    each id.
+    """
+    member = numpy.zeros((len(idxs), len(tag_sets)), dtype=bool)
+    for col, iset in enumerate(tag_sets):
+        member[:, col] = iset.gather(idxs)
+    return numpy.packbits(member, axis=1, bitorder='little')
+
+
+def _tag_lists(idxs, tags):
+    """
+    Convert a (tag => (comment, encoded IntSet)) dictionary into a
+    dictionary of (id => [tag, ...]) for the given ids.
+    """
+    if not len(idxs):
+        return {}
+    names = list(tags)
+    masks = _tag_masks(
+        numpy.asarray(idxs, dtype=numpy.int64),
+        [dumb_decode(tags[tag][1]) for tag in names])
+    bits = numpy.unpackbits(masks, axis=1, count=len(names), bitorder='little')
+    rows, cols = numpy.nonzero(bits)
+    tag_lists = dict((i, []) for i in idxs)
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        tag_lists[idxs[row]].append(names[col])
+    return tag_lists
+
+
+class ReadWriteLock:
+    """
+    Many readers or a single writer. Waiting writers block new readers,
+    so a steady stream of reads cannot starve them.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writers = 0  # Waiting or active
+
+    @contextmanager
+    def shared(self):
+        with self.cond:
+            while self.writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                self.cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self.cond:
+            self.writers += 1
+            while self.readers:
+                self.cond.wait()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writers -= 1
+                self.cond.notify_all()
+
+
+class SortedResults:
+    """
+    A lazily sorted result set: we only sort as much of it as has been
+    requested so far, using argpartition to find the top-K before sorting
+    them. Sort keys must be unique, so the results are deterministic.
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.order = keys[:0]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def page(self, skip, limit):
+        # These get shared between threads; we sort outside the lock, and
+        # only ever replace self.order with a longer one.
+        total = len(self.keys)
+        need = min(total, skip + limit) if limit else total
+        order = self.order
+        if need > len(order):
+            want = min(total, max(need, 2 * len(order)))
+            if want * 4 >= total:
+                order = numpy.argsort(self.keys)
+            else:
+                top = numpy.argpartition(self.keys, want - 1)[:want]
+                order = top[numpy.argsort(self.keys[top])]
+            with self.lock:
+                if len(order) > len(self.order):
+                    self.order = order
+        return order[skip:need]
+
+
 class MetadataWorker(BaseWorker):
     """
     """
@@ -23,13 +149,21 @@ class MetadataWorker(BaseWorker):
     SORT_DATE_ASC = 1
     SORT_DATE_DEC = 2
 
+    SORTED_CACHE_SIZE = 10
+
+    THREADED = True
+    # Note: metadata is not concurrent, as RecordFile flushes re-map the
+    # files it reads from without any locking.
+    CONCURRENT_FUNCTIONS = set([b'noop', b'status', b'info'])
+
     @classmethod
     def Connect(cls, status_dir):
         return cls(status_dir, None, None).connect(autostart=False)
 
     def __init__(self,
             unique_app_id, status_dir, metadata_dir, encryption_keys,
-            name=KIND, notify=None, log_level=logging.ERROR):
+            name=KIND, notify=None, log_level=logging.ERROR,
+            cache_mb=None):
 
         BaseWorker.__init__(self, unique_app_id, status_dir,
             name=name, notify=notify, log_level=log_level)
@@ -47,8 +181,14 @@ class MetadataWorker(BaseWorker):
         #        for k in encryption_keys))
 
         self.change_lock = threading.Lock()
+        self.read_lock = ReadWriteLock()  # Readers vs. compaction
         self.encryption_keys = encryption_keys
         self.metadata_dir = metadata_dir
+        self.cache_bytes = (
+            int(float(cache_mb) * 1024 * 1024) if cache_mb else None)
+        self._compacting = False
+        self._sorted_cache = OrderedDict()
+        self._sorted_cache_lock = threading.Lock()
         self._metadata = None
 
     def quit(self, *args, **kwargs):
@@ -60,7 +200,8 @@ class MetadataWorker(BaseWorker):
         self._metadata = MetadataStore(
             os.path.join(self.metadata_dir, self.name),
             'metadata',
-            self.encryption_keys)
+            self.encryption_keys,
+            cache_bytes=self.cache_bytes)
         del self.encryption_keys
         return super()._main_httpd_loop()
 
@@ -208,9 +349,10 @@ class MetadataWorker(BaseWorker):
     async def async_metadata(self, loop, hits,
             tags=None, threads=False, only_ids=False,
             sort=SORT_NONE, skip=0, limit=None, raw=False,
-            data_cb=None):
+            data_cb=None, version=None):
         res = await self.async_call(loop, 'metadata',
             hits, tags, threads, only_ids, sort, skip, limit,
+            qs=({'version': version} if (version is not None) else None),
             data_cb=data_cb)
         if only_ids or raw or (data_cb is not None):
             return res
@@ -223,9 +365,10 @@ class MetadataWorker(BaseWorker):
 
     def metadata(self, hits,
             tags=None, threads=False, only_ids=False,
-            sort=SORT_NONE, skip=0, limit=None, raw=False):
+            sort=SORT_NONE, skip=0, limit=None, raw=False, version=None):
         res = self.call('metadata',
-            hits, tags, threads, only_ids, sort, skip, limit)
+            hits, tags, threads, only_ids, sort, skip, limit,
+            qs=({'version': version} if (version is not None) else None))
         if only_ids or raw:
             return res
         if threads:
@@ -238,17 +381,49 @@ class MetadataWorker(BaseWorker):
     def info(self):
         return self.call('info')
 
+    def api_status(self, *args, **kwargs):
+        if self._metadata is not None:
+            self.status.update(self._metadata.cache_stats())
+        return super().api_status(*args, **kwargs)
+
     def api_info(self, **kwas):
-        self.reply_json({
-            'maxint': len(self._metadata)})
+        with self.read_lock.shared():
+            maxint = len(self._metadata)
+        self.reply_json({'maxint': maxint})
 
-    def api_compact(self, full, callback_chain, **kwargs):
-        def background_compact():
+    def on_tick(self):
+        if (self._metadata is not None) and not self._compacting:
             with self.change_lock:
-                for progress in self._metadata.compact(partial=not full):
-                    progress['full'] = full
-                    self.results_to_callback_chain(callback_chain, progress)
-        self.add_background_job(background_compact)
+                auto = self._metadata.compaction_candidates()
+            if auto:
+                logging.info('[metadata] Auto-compacting chunks %s' % (auto,))
+                self._compacting = True
+                self.add_background_job(
+                    lambda: self._background_compact(False, None))
+
+    def _background_compact(self, full, callback_chain):
+        if full:
+            steps = self._metadata.compact(partial=False)
+        else:
+            steps = self._metadata.compact_incrementally()
+        try:
+            while True:
+                # Compaction moves records around and re-maps files, so
+                # readers must wait for each step to complete.
+                with self.change_lock, self.read_lock.exclusive():
+                    progress = next(steps, None)
+                if progress is None:
+                    break
+                progress['full'] = full
+                self.results_to_callback_chain(
+                    list(callback_chain or []), progress)
+        finally:
+            self._compacting = False
+
+    def api_compact(self, full, callback_chain, **kwargs):
+        self._compacting = True
+        self.add_background_job(
+            lambda: self._background_compact(full, callback_chain))
         self.reply_json({'running': True})
 
     def api_add_metadata(self, update, metadata, **kwas):
@@ -274,6 +449,9 @@ class MetadataWorker(BaseWorker):
                     if ptrs:
                          id_map[ptrs[0].ptr_path] = idx
 
+        if added or updated:
+            # New messages may change thread membership or dates
+            self._sorted_cache_clear()
         self.reply_json({'added': added, 'updated': updated, 'ids': id_map})
 
     def api_annotate(self, msgids, annotations, **kwas):
@@ -349,51 +527,100 @@ class MetadataWorker(BaseWorker):
 
         self.reply_json(updated)
 
-    def _md_threaded(self, hits, only_ids, sort_order, urgent):
-        hits = [self._metadata.thread_sorting_keyfunc(h) for h in hits]
-        hits.sort()
-        if sort_order == self.SORT_DATE_DEC:
-            hits.reverse()
-
-        groups = []
-        last_tid = 0
-        for tid, ts, idx in hits:
-            if tid != last_tid:
-                groups.append({'hits': [idx], '_ts': ts, 'thread': tid})
-                last_tid = tid
-            else:
-                groups[-1]['_ts'] = min(groups[-1]['_ts'], ts)
-                groups[-1]['hits'].append(idx)
-
-        if sort_order != self.SORT_NONE:
-            groups.sort(key=lambda g: g['_ts'])
-        if sort_order == self.SORT_DATE_DEC:
-            groups.reverse()
-
-        if urgent and (sort_order != self.SORT_NONE):
-            return (
-                [g for g in groups if g['thread'] in urgent] +
-                [g for g in groups if g['thread'] not in urgent])
-
-        return groups
+    def _urgent_mask(self, idxs, urgent):
+        if isinstance(urgent, IntSet):
+            urgent = urgent.to_numpy()
+        else:
+            urgent = numpy.array(list(urgent), dtype=numpy.int64)
+        return numpy.isin(idxs, urgent)
 
-    def _md_messages(self, hits, only_ids, sort_order, urgent):
-        if sort_order != self.SORT_NONE:
-            hits.sort(key=self._metadata.date_sorting_keyfunc)
+    def _md_threaded(self, hits, sort_order, urgent):
+        tids, dates = self._metadata.thread_sorting_keys(hits)
+        order = numpy.lexsort((hits, dates, tids))
         if sort_order == self.SORT_DATE_DEC:
-            hits.reverse()
-
-        if urgent and (sort_order != self.SORT_NONE):
-            return (
-                [h for h in hits if h in urgent] +
-                [h for h in hits if h not in urgent])
-
-        return hits
-
-    def api_metadata(self,
+            order = order[::-1]
+        hits, dates, tids = hits[order], dates[order], tids[order]
+
+        # Group consecutive hits by thread ID; each group is dated by its
+        # oldest message.
+        starts = numpy.flatnonzero(numpy.diff(tids, prepend=-1))
+        ends = numpy.append(starts[1:], len(tids))
+        g_ts = numpy.minimum.reduceat(dates, starts)
+        g_tids = tids[starts]
+        g_pos = numpy.arange(len(starts))
+
+        if sort_order == self.SORT_NONE:
+            ranked = SortedResults(g_pos)
+        else:
+            if sort_order == self.SORT_DATE_DEC:
+                g_ts_key, g_pos = g_ts.max() - g_ts, g_pos[::-1]
+            else:
+                g_ts_key = g_ts
+            if urgent:
+                not_urgent = ~self._urgent_mask(g_tids, urgent)
+                ranked = SortedResults(_rank_keys(not_urgent, g_ts_key, g_pos))
+            else:
+                ranked = SortedResults(_rank_keys(g_ts_key, g_pos))
+
+        def groups(g_order):
+            # Only the requested page of groups gets converted to Python
+            return [{
+                    'hits': hits[beg:end].tolist(),
+                    '_ts': ts,
+                    'thread': tid}
+                for beg, end, ts, tid in zip(
+                    starts[g_order].tolist(),
+                    ends[g_order].tolist(),
+                    g_ts[g_order].tolist(),
+                    g_tids[g_order].tolist())]
+
+        return ranked, groups
+
+    def _md_messages(self, hits, sort_order, urgent):
+        if sort_order == self.SORT_NONE:
+            ranked = SortedResults(numpy.arange(len(hits)))
+        else:
+            dates = self._metadata.date_sorting_keys(hits)
+            if sort_order == self.SORT_DATE_DEC:
+                keys = (dates.max() - dates, hits.max() - hits)
+            else:
+                keys = (dates, hits)
+            if urgent:
+                keys = (~self._urgent_mask(hits, urgent),) + keys
+            ranked = SortedResults(_rank_keys(*keys))
+
+        return ranked, lambda order: hits[order].tolist()
+
+    def _sorted_cache_key(self, hits, tags, threads, sort_order, version):
+        if not isinstance(hits, (str, bytes)):
+            return None
+        digest = hashlib.sha256()
+        for blob in (hits, ((tags or {}).get('in:urgent') or [0, ''])[1]):
+            digest.update(blob if isinstance(blob, bytes)
+                else bytes(str(blob), 'utf-8'))
+        return (version, bool(threads), sort_order, digest.digest())
+
+    def _sorted_cache_clear(self):
+        with self._sorted_cache_lock:
+            self._sorted_cache.clear()
+
+    def api_metadata(self, *args, **kwargs):
+        with self.read_lock.shared():
+            return self._api_metadata(*args, **kwargs)
+
+    def _api_metadata(self,
             hits, tags, threads, only_ids, sort_order, skip, limit,
-            **kwargs):
-        if not isinstance(hits, (list, IntSet)):
+            version=None, **kwargs):
+        cache_key = self._sorted_cache_key(
+            hits, tags, threads, sort_order, version)
+        with self._sorted_cache_lock:
+            cached = self._sorted_cache.get(cache_key)
+            if cached is not None:
+                self._sorted_cache.move_to_end(cache_key)
+        if cached is not None:
+            ranked, fetch = cached
+            hits = None
+        elif not isinstance(hits, (list, IntSet)):
             hits = dumb_decode(hits)
         if isinstance(hits, list):
             for i, h in enumerate(hits):
@@ -401,40 +628,50 @@ class MetadataWorker(BaseWorker):
                     hits[i] = self._metadata.key_to_index(h)
                 except KeyError:
                     pass
-            hits = list(set([h for h in hits if isinstance(h, int)]))
-        else:
-            hits = list(hits)
+            hits = numpy.array(
+                list(set([h for h in hits if isinstance(h, int)])),
+                dtype=numpy.int64)
+        if isinstance(hits, IntSet):
+            hits = hits.to_numpy()
 
-        if not hits:
+        if (hits is not None) and not len(hits):
             return self.reply_json({'total': 0, 'metadata': []})
 
-        urgent = (tags or {}).get('in:urgent')
-        if urgent:
-            urgent = dumb_decode(urgent[1])
-        else:
-            urgent = set()
+        if hits is not None:
+            urgent = (tags or {}).get('in:urgent')
+            if urgent:
+                urgent = dumb_decode(urgent[1])
+            else:
+                urgent = set()
 
-        if threads:
-            result = self._md_threaded(hits, only_ids, sort_order, urgent)
-        else:
-            result = self._md_messages(hits, only_ids, sort_order, urgent)
+            if threads:
+                ranked, fetch = self._md_threaded(hits, sort_order, urgent)
+            else:
+                ranked, fetch = self._md_messages(hits, sort_order, urgent)
+
+            if cache_key is not None:
+                with self._sorted_cache_lock:
+                    self._sorted_cache[cache_key] = (ranked, fetch)
+                    while len(self._sorted_cache) > self.SORTED_CACHE_SIZE:
+                        self._sorted_cache.popitem(last=False)
 
-        total = len(result)
+        total = len(ranked)
+        result = fetch(ranked.page(skip, limit))
         if not limit:
             limit = total - skip
-        result = [r for r in result[skip:skip+limit]]
 
-        if tags:
-            for tag in tags:
-                tags[tag] = dumb_decode(tags[tag][1])
+        if tags and not only_ids:
+            if threads:
+                page = [i for grp in result
+                    for i in self._metadata.get_thread_idxs(grp['thread'])]
+            else:
+                page = result
+            tag_lists = _tag_lists(page, tags)
             def _metadata(i):
                 md = self._metadata.get(i, default=None)
                 if md is None:
                     return None
-                md.more['tags'] = tlist = []
-                for tag in tags:
-                    if i in tags[tag]:
-                        tlist.append(tag)
+                md.more['tags'] = tag_lists.get(i, [])
                 return md
         else:
             def _metadata(i):
@@ -473,6 +710,31 @@ class MetadataWorker(BaseWorker):
 if __name__ == '__main__':
     import sys
     logging.basicConfig(level=logging.DEBUG)
+
+    keys = _rank_keys(numpy.array([1, 0, 1, 0]), numpy.array([5, 7, 3, 7]))
+    assert(list(numpy.argsort(keys)) == [1, 3, 2, 0])
+    sr = SortedResults(numpy.arange(1000, 0, -1))
+    assert(list(sr.page(10, 3)) == [989, 988, 987])
+    assert(len(sr.order) == 13)
+    assert(list(sr.page(0, None)[:2]) == [999, 998])
+    tl = _tag_lists([3, 70, 5], {
+        'in:inbox': ({}, dumb_encode_asc(IntSet([3, 5]))),
+        'in:read': ({}, dumb_encode_asc(IntSet([70, 5, 900])))})
+    assert(tl == {3: ['in:inbox'], 70: ['in:read'], 5: ['in:inbox', 'in:read']})
+
+    # Readers share the lock, writers wait for them and then exclude them
+    rwl, events = ReadWriteLock(), []
+    def _writer():
+        with rwl.exclusive():
+            events.append('w')
+    with rwl.shared(), rwl.shared():
+        writer = threading.Thread(target=_writer)
+        writer.start()
+        time.sleep(0.1)
+        events.append('r')
+    writer.join()
+    assert(events == ['r', 'w'])
+
     os.system('rm -rf /tmp/moggie-md-test')
     mw = MetadataWorker('/tmp', '/tmp', [b'1234'], name='moggie-md-test').connect()
     if mw:
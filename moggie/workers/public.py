@@ -241,6 +241,7 @@ class WorkerHTTPD(HTTPD):
 
 class PublicWorker(BaseWorker):
     KIND = 'public'
+    BINARY_RPC = False  # Our web RPC handler only speaks JSON
     STATIC_PATH = '.'
     PUBLIC_PATHS = []
     PUBLIC_PREFIXES = []
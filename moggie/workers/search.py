@@ -4,6 +4,7 @@ import time
 import traceback
 import threading
 
+from ..search import MASK_TAGS
 from ..util.dumbcode import dumb_encode_asc, dumb_decode
 from ..util.intset import IntSet
 from .base import BaseWorker
@@ -19,10 +20,15 @@ class SearchWorker(BaseWorker):
         '/etc/dictionaries-common/words',
         '/usr/share/dict/words']
 
-    MASK_TAGS = ('in:trash', 'in:junk', 'in:hidden')
+    MASK_TAGS = MASK_TAGS
 
     EXACT_SEARCHES = ('msgid', 'message-id', 'id', 'mid')
 
+    # The engine does its own locking, so read-only queries can overlap
+    THREADED = True
+    CONCURRENT_FUNCTIONS = set([b'noop', b'status',
+        b'term_search', b'explain', b'tag_counts', b'search'])
+
     SORT_NONE = 0
     SORT_DATE_ASC = 1
     SORT_DATE_DEC = 2
@@ -42,7 +48,8 @@ class SearchWorker(BaseWorker):
 
     def __init__(self,
             unique_app_id, status_dir, engine_dir, metadata, encryption_keys,
-            name=KIND, defaults=None, notify=None, log_level=logging.ERROR):
+            name=KIND, defaults=None, notify=None, log_level=logging.ERROR,
+            cache_mb=None):
 
         BaseWorker.__init__(self, unique_app_id, status_dir,
             name=name, notify=notify, log_level=log_level)
@@ -54,14 +61,18 @@ class SearchWorker(BaseWorker):
             b'update_terms': (True, self.api_update_terms),
             b'term_search':  (True, self.api_term_search),
             b'explain':      (True, self.api_explain),
+            b'tag_counts':   (True, self.api_tag_counts),
             b'search':       (True, self.api_search)})
 
         self.change_lock = threading.Lock()
         self.encryption_keys = encryption_keys
         self.engine_dir = engine_dir
         self.defaults = defaults
+        self.cache_bytes = (
+            int(float(cache_mb) * 1024 * 1024) if cache_mb else None)
         self.metadata = metadata
         self.maxint = metadata.info()['maxint']
+        self._compacting = False
         self._engine = None
 
     def quit(self, *args, **kwargs):
@@ -76,7 +87,8 @@ class SearchWorker(BaseWorker):
             name=self.name,
             encryption_keys=self.encryption_keys,
             defaults=self.defaults,
-            maxint=self.maxint)
+            maxint=self.maxint,
+            cache_bytes=self.cache_bytes)
 
         self._engine.magic_term_map.update({
             'tid': self._magic_thread,
@@ -127,6 +139,12 @@ class SearchWorker(BaseWorker):
     def explain(self, terms):
         return self.call('explain', terms)
 
+    async def async_tag_counts(self, loop, tag_namespace=None):
+        return await self.async_call(loop, 'tag_counts', tag_namespace)
+
+    def tag_counts(self, tag_namespace=None):
+        return self.call('tag_counts', tag_namespace)
+
     async def async_search(self, loop, terms,
             tag_namespace=None,
             mask_deleted=True, mask_tags=None, more_terms=None,
@@ -246,20 +264,50 @@ class SearchWorker(BaseWorker):
                 mutations,
                 record_history=rec_hist,
                 tag_namespace=tag_namespace)
-            result['changed'] = dumb_encode_asc(result['changed'], compress=256)
+            result['changed'] = self.dumb_encode(result['changed'], compress=256)
             self.reply_json(result)
 
+    def api_status(self, *args, **kwargs):
+        if self._engine is not None:
+            self.status.update(self._engine.records.cache_stats())
+        return super().api_status(*args, **kwargs)
+
+    def on_tick(self):
+        if (self._engine is not None) and not self._compacting:
+            with self._engine.lock:
+                auto = self._engine.records.compaction_candidates()
+            if auto:
+                logging.info('[search] Auto-compacting chunks %s' % (auto,))
+                self._compacting = True
+                self.add_background_job(
+                    lambda: self._background_compact(False, None))
+
+    def _background_compact(self, full, callback_chain):
+        records = self._engine.records
+        if full:
+            steps = records.compact(partial=False)
+        else:
+            steps = records.compact_incrementally()
+        try:
+            while True:
+                # Locks are only held for one step at a time, so searches,
+                # imports and tagging can proceed while we work.
+                with self.change_lock, self._engine.lock:
+                    progress = next(steps, None)
+                if progress is None:
+                    break
+                progress['full'] = full
+                self.notify(
+                    '[search] Compacting: %s' % (progress,), data=progress)
+                self.results_to_callback_chain(
+                    list(callback_chain or []), progress)
+        finally:
+            self._compacting = False
+
     def api_compact(self, full, callback_chain, **kwargs):
-        def report_progress(progress):
-            progress['full'] = full
-            self.notify('[search] Compacting: %s' % (progress,), data=progress)
-            self.results_to_callback_chain(callback_chain, progress)
-        def background_compact():
-            with self.change_lock:
-                self._engine.records.compact(
-                    partial=not full,
-                    progress_callback=report_progress)
-        self.add_background_job(background_compact)
+        self._compacting = True
+        self.add_background_job(
+            lambda: self._background_compact(full, callback_chain))
         self.reply_json({'running': True})
 
     def api_add_results(self, results, touch, callback_chain, wait, **kwargs):
@@ -295,6 +343,11 @@ class SearchWorker(BaseWorker):
     def api_explain(self, terms, **kwargs):
         self.reply_json(self._engine.explain(terms))
 
+    def api_tag_counts(self, tag_namespace, **kwargs):
+        if tag_namespace:
+            tag_namespace = tag_namespace.lower()
+        self.reply_json(self._engine.tag_counts(tag_namespace or ''))
+
     def api_search(self,
             terms, mask_deleted, mask_tags, more_terms,
             tag_namespace, with_tags,
@@ -328,7 +381,7 @@ class SearchWorker(BaseWorker):
         if _internal:
             result['hits'] = hits
         else:
-            result['hits'] = dumb_encode_asc(hits, compress=256)
+            result['hits'] = self.dumb_encode(hits, compress=256, share=True)
 
         if with_tags:
             tag_info = self._engine.search_tags(
@@ -341,7 +394,8 @@ class SearchWorker(BaseWorker):
                     pass
                 return comment
             result['tags'] = dict(
-                (tag, (_dec_comment(com), dumb_encode_asc(iset, compress=128)))
+                (tag, (_dec_comment(com),
+                       self.dumb_encode(iset, compress=128, share=True)))
                 for tag, (com, iset) in tag_info.items())
 
         if _internal:
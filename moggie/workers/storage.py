@@ -108,6 +108,11 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
     PARSE_CACHE_MIN = 1000
     PARSE_CACHE_TTL = 180
 
+    # Reading and parsing mail can be slow, let those calls overlap
+    THREADED = True
+    CONCURRENT_FUNCTIONS = set([
+        b'noop', b'status', b'info', b'mailbox', b'email', b'get', b'json'])
+
     def __init__(self, unique_app_id, status_dir, backend,
             name=KIND, notify=None, log_level=logging.ERROR,
             shutdown_idle=None):
@@ -128,19 +133,22 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
 
         self.parsed_mailboxes = {}
         self.background_thread = None
+        self.background_lock = threading.Lock()
 
     def _expire_parse_cache(self):
         et = time.time() - self.PARSE_CACHE_TTL
-        expired = [k for k, v in self.parsed_mailboxes.items() if v[0] <= et]
+        expired = [
+            k for k, v in list(self.parsed_mailboxes.items()) if v[0] <= et]
         for key in expired:
-            del self.parsed_mailboxes[key]
+            self.parsed_mailboxes.pop(key, None)
 
     def _background(self, task):
-        if self.background_thread is not None:
-            self.background_thread.join()
-        self.background_thread = threading.Thread(target=task)
-        self.background_thread.daemon = True
-        self.background_thread.start()
+        with self.background_lock:
+            if self.background_thread is not None:
+                self.background_thread.join()
+            self.background_thread = threading.Thread(target=task)
+            self.background_thread.daemon = True
+            self.background_thread.start()
 
     def pue_to_needinfo(self, pue):
         logging.debug('Need unlock, raising NeedInfoException')
@@ -218,12 +226,11 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
             logging.debug('Expiring cache, maybe yo: limit=%s' % limit)
             self._expire_parse_cache()
 
-        if cache_key in self.parsed_mailboxes and not wanted_ids:
-            while (not self.parsed_mailboxes[cache_key][1]
-                    and self.background_thread is not None):
-                time.sleep(0.1)
+        parse_cache = self.parsed_mailboxes.get(cache_key)
+        if parse_cache and not wanted_ids:
+            parse_cache[1].wait()
             logging.debug('%s: Returning from self.parsed_mailboxes' % key)
-            pm = _filter(self.parsed_mailboxes[cache_key][-1])
+            pm = _filter(parse_cache[-1])
             beg = skip
             end = skip + (limit or (len(pm)-skip))
             return self.reply_json(pm[beg:end])
@@ -239,15 +246,17 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
                 sync_id=sync_id, username=username, password=password)
 
             # Ideally, we wouldn't cache anything. But some ops are slow.
+            # Entries are only published once their event is guaranteed
+            # to get set, since concurrent requests wait on it.
             collect = []
-            parse_cache = [time.time(), False, collect]
+            parse_cache = [time.time(), threading.Event(), collect]
 
             if limit is None:
                 collect.extend(msg for msg in parser)
                 logging.debug(
                     '%s: Returning %d messages (u)' % (key, len(collect)))
                 if not wanted_ids:
-                    parse_cache[1] = True
+                    parse_cache[1].set()
                     if len(collect) > self.PARSE_CACHE_MIN:
                         self.parsed_mailboxes[cache_key] = parse_cache
                 return self.reply_json(_filter(collect))
@@ -260,8 +269,6 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
                 result.extend(_filter([msg]))
 
             logging.debug('%s: Returning %d messages' % (key, len(result)))
-            if not wanted_ids:
-                self.parsed_mailboxes[cache_key] = parse_cache
             self.reply_json(result)
 
         except PleaseUnlockError as pue:
@@ -277,15 +284,19 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
         # Finish in background thread
         if limit and (len(result) >= limit) and not wanted_ids:
             def finish():
-                logging.debug('%s: Background completing scan' % key)
-                collect.extend(msg for msg in parser)
-                update_metadata_pointers()
-                parse_cache[1] = True
-                self.background_thread = None
+                try:
+                    logging.debug('%s: Background completing scan' % key)
+                    collect.extend(msg for msg in parser)
+                    update_metadata_pointers()
+                finally:
+                    parse_cache[1].set()
+                    self.background_thread = None
             self._background(finish)
         else:
             self._background(update_metadata_pointers)
-            parse_cache[1] = True
+            parse_cache[1].set()
+        if not wanted_ids:
+            self.parsed_mailboxes[cache_key] = parse_cache
 
     def api_email(self,
             metadata, text, data, full_raw, parts, username, password,
@@ -350,7 +361,7 @@ class StorageWorker(BaseWorker, StorageWorkerApi):
             for chunk in range(0, 1 + length//self.BLOCK):
                 c.send(value[p:min(p+self.BLOCK, begin+length)])
                 p += self.BLOCK
-            self._client.close()
+            c.close()
 
         if length > self.BLOCK * 5:
             self._background(sendit)
@@ -439,7 +450,9 @@ class StorageWorkers(WorkerPool, StorageWorkerApi):
                 relative_to=os.path.expanduser('~'),
                 ask_secret=kwargs.get('ask_secret'),
                 set_secret=kwargs.get('set_secret'),
-                metadata=kwargs.get('metadata'))
+                metadata=kwargs.get('metadata'),
+                offset_index_dir=os.path.normpath(
+                    os.path.join(worker_dir, '..', 'mbox_offsets')))
         self.fs = storage
         fs_args = (unique_app_id, worker_dir, self.fs)
         fs_kwa = {
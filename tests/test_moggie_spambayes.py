@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 
 import moggie.util.spambayes
@@ -31,6 +33,39 @@ class SpambayesTests(unittest.TestCase):
         self.assertLess(sb2.classify('Hello world this is ham'.split()), 0.5)
         self.assertLess(sb2.classify('This is a great world'.split()), 0.5)
 
+    def test_token_store(self):
+        sb = moggie.util.spambayes.Classifier()
+        sb.learn('hello world this is great'.split(), False)
+        sb.learn('I like spam and ham is good too'.split(), True)
+        tests = [t.split() for t in (
+            'This is great spam I like', 'Hello world this is ham')]
+        expected = [sb.classify(t) for t in tests]
+
+        TokenStore = moggie.util.spambayes.TokenStore
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'test.atok')
+            st = moggie.util.spambayes.Classifier()
+            st.nspam, st.nham = sb.nspam, sb.nham
+            st.wordinfo = TokenStore.FromItems(sb.wordinfo.items())
+            st.save_store(path)
+
+            st = moggie.util.spambayes.Classifier().load_store(
+                TokenStore(path))
+            self.assertEqual([st.classify(t) for t in tests], expected)
+            self.assertEqual(st.chi2_spamprobs(tests), expected)
+
+            for c in (sb, st):
+                c.learn('spam spam wonderful spam'.split(), True)
+                c.unlearn('I like spam and ham is good too'.split(), True)
+            st.save_store()
+
+            expected = [sb.classify(t) for t in tests]
+            st = moggie.util.spambayes.Classifier().load_store(
+                TokenStore(path))
+            self.assertEqual((st.nspam, st.nham), (sb.nspam, sb.nham))
+            self.assertEqual(len(st.wordinfo), len(sb.wordinfo))
+            self.assertEqual([st.classify(t) for t in tests], expected)
+
 
 class AutoTaggerTests(unittest.TestCase):
     TEST_JSON = """\
@@ -99,3 +134,64 @@ class AutoTaggerTests(unittest.TestCase):
         self.assertLess(clues['this'], 0.5)
         self.assertLess(clues['great'], 0.5)
         self.assertLess(0.5, clues['spam'])
+
+    def test_autotagger_classify_many(self):
+        at = moggie.search.filters.AutoTagger(salt='Testing')
+        at.min_trained = 0
+        self.assertEquals(at.classify_many([([], [])] * 2), [0.5, 0.5])
+
+        at.learn(1, 'hello world this is great'.split(), is_spam=False)
+        at.learn(2, 'I like spam and ham is good too'.split(), is_spam=True)
+        at.learn(3, 'from:bre@example.org to:x@y.z subject:hi ok'.split(),
+            is_spam=False)
+
+        messages = [
+            'this is great spam'.split(),
+            'I like the world of spam'.split(),
+            'from:bre@example.org to:x@y.z subject:hi hello'.split(),
+            'nothing we know about'.split(),
+            [],
+            'I like ham too'.split() * 100]
+        prepared = [at.prepare_keywords(kws) for kws in messages]
+        for single, batch in zip(
+                [at.classify(kws) for kws in messages],
+                at.classify_many(prepared)):
+            self.assertAlmostEqual(single, batch, places=9)
+
+    def test_autotagger_obfuscated_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fe = moggie.search.filters.FilterEngine(obfuscated_bytes=2000)
+            fe.load(tmpdir, create=True)
+            at = fe.get_autotagger('spam', create=True)
+            plain = moggie.search.filters.AutoTagger(salt=at.salt)
+
+            words = ['word%d' % i for i in range(100)]
+            self.assertEqual(at.obfuscate(words), plain.obfuscate(words))
+            self.assertLessEqual(fe.obfuscated.bytes, 2000)
+            self.assertLess(0, len(fe.obfuscated))
+            self.assertEqual(at.obfuscate(words), plain.obfuscate(words))
+
+            fe.unload_autotaggers()
+            self.assertEqual(len(fe.obfuscated), 0)
+            self.assertEqual(fe.autotaggers, {})
+            self.assertIsNotNone(fe.load().get_autotagger('spam'))
+
+    def test_autotagger_token_store(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fe = moggie.search.filters.FilterEngine()
+            fe.load(tmpdir, create=True)
+            at = fe.get_autotagger('spam', create=True)
+            at.min_trained = 0
+            at.TOKEN_STORE_MIN = 5
+            at.learn(1, 'hello world this is great'.split(), is_spam=False)
+            at.learn(2, 'I like spam and ham is good too'.split(), is_spam=True)
+            self.assertTrue(fe.save_autotagger('spam'))
+            self.assertIn('tokens', at.info)
+            self.assertNotIn('"data"', at.to_json())
+
+            rank = at.classify('this is great spam'.split())
+            fe2 = moggie.search.filters.FilterEngine().load(tmpdir)
+            at2 = fe2.get_autotagger('spam')
+            self.assertIsInstance(
+                at2.classifier.wordinfo, moggie.util.spambayes.TokenStore)
+            self.assertEqual(at2.classify('this is great spam'.split()), rank)
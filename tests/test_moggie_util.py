@@ -1,3 +1,7 @@
+import numpy
+import struct
+import sys
+import threading
 import unittest
 import doctest
 
@@ -11,6 +15,7 @@ import moggie.util.sendmail
 from moggie.util.dumbcode import *
 from moggie.util.friendly import *
 from moggie.util.intset import IntSet
+from moggie.util.sharedmem import SharedValues, is_shared_ref, unshare
 from moggie.util.wordblob import *
 from moggie.util.sendmail import *
 
@@ -105,6 +110,24 @@ class DummbCodeTests(unittest.TestCase):
                 IntSet([1, 2, 3, 4])):
             self.assertEqual(from_json(to_json(thing)), thing)
 
+    def test_dumbcode_msgpack(self):
+        for thing in (
+                True, False, 1, "hello", None,
+                b'binary stuff',
+                IntSet([1, 2, 3, 4]),
+                set([1, 2]),
+                [1, 2, 3],
+                {'hi': [1, 2], 'hello': 'world'}):
+            self.assertEqual(from_msgpack(to_msgpack(thing)), thing)
+
+        # By default we mimic JSON, which only has string keys
+        thing = {1: (2, 3), 'bin': b'\0'}
+        self.assertEqual(from_msgpack(to_msgpack(thing)),
+            from_json(to_json(thing)))
+        self.assertEqual(
+            from_msgpack(to_msgpack(thing, json_keys=False)),
+            {1: [2, 3], 'bin': b'\0'})
+
 
 class FriendlyTests(unittest.TestCase):
     def test_secs_to_friendly_time(self):
@@ -221,6 +244,92 @@ class IntsetTest(unittest.TestCase):
         d_is1 = dumb_decode(e_is1)
         self.assertTrue(list(d_is1) == list(is1))
 
+    def test_intset_numpy(self):
+        ints = [0, 63, 64, 1000, 65535, 65536, 2000001]
+        iset = IntSet.from_numpy(numpy.array(ints))
+        self.assertEqual(list(iset), ints)
+        self.assertEqual(iset.to_numpy().tolist(), ints)
+        self.assertEqual(iset.count(), len(ints))
+        self.assertEqual(list(iset.chunks(size=4)), [
+            [2000001, 65536, 65535, 1000], [64, 63, 0]])
+        self.assertTrue(bool(iset))
+        self.assertFalse(bool(IntSet()))
+        self.assertEqual(IntSet().count(), 0)
+
+        iset = IntSet(numpy.array([1, 5, 9]))
+        self.assertEqual(list(iset), [1, 5, 9])
+        iset |= numpy.array([3, 4])
+        self.assertEqual(list(iset), [1, 3, 4, 5, 9])
+        iset ^= numpy.array([3, 9])
+        self.assertEqual(list(iset), [1, 4, 5])
+
+    def test_intset_containers(self):
+        sparse = IntSet([2000001, 2000005, 2000100])
+        runs = IntSet(list(range(5, 200000)))
+        dense = IntSet(list(range(0, 1000000, 2)))
+        for iset, max_len in (
+                (sparse, 32),
+                (runs, 64),
+                (dense, 16 * (8192 + 7) + 5)):
+            binary = iset.tobytes()
+            self.assertEqual(binary[:1], IntSet.BIN_VERSION_CONTAINERS)
+            self.assertTrue(len(binary) <= max_len)
+            self.assertEqual(list(IntSet(binary=binary)), list(iset))
+            self.assertEqual(IntSet(binary=binary), iset)
+
+        # Old-style bitmaps must still be readable
+        for iset in (sparse, runs, IntSet([])):
+            binary = iset.tobytes(strip=False)
+            self.assertEqual(binary[:1], IntSet.BIN_VERSION_BITMAP)
+            self.assertEqual(list(IntSet(binary=binary)), list(iset))
+        v1 = b'\x01' + struct.pack('<I', 8) + b'\x02'
+        self.assertEqual(list(IntSet(binary=v1)), [65])
+
+        # Membership can be tested without decoding
+        probe = [0, 1, 5, 6, 2000001, 2000002, 199999, 200000, 999998]
+        for iset in (sparse, runs, dense, IntSet([])):
+            for binary in (iset.tobytes(), iset.tobytes(strip=False)):
+                self.assertEqual(
+                    list(IntSet.GatherBinary(binary, probe)),
+                    [bool(i in iset) for i in probe])
+
+
+class SharedMemoryTest(unittest.TestCase):
+    def test_shared_values(self):
+        sv = SharedValues()
+        try:
+            iset = IntSet([1, 2, 3, 1000000])
+            ref = sv.share(dumb_encode_bin(iset))
+            self.assertTrue(is_shared_ref(ref))
+            self.assertEqual(dumb_decode(ref), iset)
+            self.assertEqual(dumb_decode(unshare(ref)), iset)
+            self.assertEqual(sv.share(dumb_encode_bin(iset)), ref)
+        finally:
+            sv.close()
+        self.assertRaises(FileNotFoundError, dumb_decode, ref)
+        self.assertRaises(ValueError, dumb_decode, 'Msomething_else/10')
+        self.assertEqual(dumb_decode('m' + ref[1:]), 'm' + ref[1:])
+
+
+    def test_unshare_client_format(self):
+        # Search results reach external clients as dumb-encoded ASCII
+        # strings, whether the app got them inline, as raw msgpack bytes
+        # or as a shared memory reference.
+        sv = SharedValues()
+        try:
+            for iset in (IntSet([1, 2, 3]), IntSet(list(range(0, 10**6, 3)))):
+                for v in (
+                        dumb_encode_asc(iset, compress=256),
+                        from_msgpack(to_msgpack(
+                            dumb_encode_bin(iset, compress=256))),
+                        sv.share(dumb_encode_bin(iset))):
+                    client = from_json(to_json({'hits': unshare(v)}))['hits']
+                    self.assertIsInstance(client, str)
+                    self.assertIn(client[:1], ('I', 'Z'))
+                    self.assertEqual(dumb_decode(client), iset)
+        finally:
+            sv.close()
+
 
 class WordblobTest(unittest.TestCase):
     def test_wordblob(self):
@@ -258,6 +367,56 @@ class WordblobTest(unittest.TestCase):
         self.assertEqual(wordblob_search('f*', b1, 10, order=-1), ['f', 'Five', 'Four'])
         self.assertEqual(wordblob_search('f*', b1, 10, order=+1), ['f', 'Four', 'Five'])
 
+    def test_wordblob_index(self):
+        words = [bytes(w, 'utf-8') for w in [
+            'invoice', 'invoices', 'Invoicing', 'voice', 'void', 'avoid',
+            'subject:invoice', 'hello', 'world', 'yellow']]
+        blob = create_wordblob(words, shortest=4)
+        index = WordblobIndex(blob)
+        self.assertEqual(len(index), len(words))
+        for term in ('invoic*', '*voic*', '*oid', 'subject:inv*', '*ell*',
+                'in*ing', 'v*d', 'inv.ice', 'inv[oa]ice', 'nothing*'):
+            self.assertEqual(
+                wordblob_search(term, blob, 10),
+                wordblob_search(term, blob, 10, indexes=[index]))
+        self.assertEqual(index.candidates(b'zzz*'), [])
+        self.assertEqual(index.candidates(b'in*'), None)
+        self.assertEqual(index.candidates(b'inv[oa]ice'), None)
+
+        # Incremental updates
+        blob = update_wordblob([b'invoiced'], blob,
+            blacklist=[b'invoices'], shortest=4, lru=True)
+        index.update(blob)
+        self.assertEqual(len(index), len(words))
+        self.assertEqual(
+            wordblob_search('invoic*', blob, 10, indexes=[index]),
+            ['invoic', 'invoice', 'invoiced', 'Invoicing'])
+
+        # Lookups during updates (including full rebuilds) are safe
+        blobs = [b'\n'.join(b'w%dx%d' % (i, j) for j in range(3000))
+            for i in range(4)]
+        index = WordblobIndex(blobs[0])
+        done, errors = [], []
+        def _search():
+            try:
+                while not done:
+                    for w in index.candidates(b'*x1*') or []:
+                        self.assertIn(b'x1', w)
+            except Exception as e:
+                errors.append(e)
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            thread = threading.Thread(target=_search)
+            thread.start()
+            for i in range(20):
+                index.update(blobs[i % len(blobs)])
+            done.append(True)
+            thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
 
 class ServerAndSenderTests(unittest.TestCase):
     def test_sas_parser(self):